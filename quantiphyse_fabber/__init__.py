@@ -3,15 +3,59 @@ Author: Martin Craig <martin.craig@eng.ox.ac.uk>
 Copyright (c) 2016-2017 University of Oxford, Martin Craig
 """
 import os
+import importlib
 
-from .process import FabberProcess
-from .widget import FabberModellingWidget, SimData
-from .tests import FabberWidgetTest
+class _LazyClass(type):
+    """
+    Metaclass for manifest entries which are only imported on first use
+
+    Importing the widget and test modules pulls in Qt and the Quantiphyse GUI,
+    so the manifest holds stand-in classes instead. Instantiating one, or
+    looking up an attribute which is not defined on the stand-in, imports
+    the real class and forwards to it. Attributes which Quantiphyse needs
+    at registration time (e.g. ``PROCESS_NAME``) are declared on the stand-in
+    so they can be read without triggering the import.
+    """
+
+    def resolve(cls):
+        """
+        :return: The real class, importing its module if required
+        """
+        if cls._lazy_class is None:
+            module = importlib.import_module("." + cls._lazy_module, __name__)
+            cls._lazy_class = getattr(module, cls.__name__)
+        return cls._lazy_class
+
+    def __call__(cls, *args, **kwargs):
+        return cls.resolve()(*args, **kwargs)
+
+    def __getattr__(cls, name):
+        if name.startswith("_lazy"):
+            raise AttributeError(name)
+        return getattr(cls.resolve(), name)
+
+    def __dir__(cls):
+        return dir(cls.resolve())
+
+def _lazy(module, name, **attrs):
+    """
+    :param module: Name of module within this package which defines the class
+    :param name: Class name
+    :param attrs: Attributes which are available without importing the class
+    :return: Stand-in class which imports the real class on first use
+    """
+    attrs.update({"_lazy_module" : module, "_lazy_class" : None})
+    return _LazyClass(str(name), (object,), attrs)
 
 QP_MANIFEST = {
-    "widgets" : [FabberModellingWidget, SimData],
-    "widget-tests" : [FabberWidgetTest],
-    "processes" : [FabberProcess],
+    "widgets" : [_lazy("widget", "FabberModellingWidget"), _lazy("widget", "SimData")],
+    "widget-tests" : [_lazy("tests", "FabberWidgetTest")],
+    "process-tests" : [_lazy("engine_tests", "FabberImportTest"), _lazy("engine_tests", "FabberEngineTest"),
+                       _lazy("tests", "FabberManifestTest"), _lazy("tests", "JobQueueTest"),
+                       _lazy("tests", "ResampleCacheTest"), _lazy("tests", "FabberBenchmarkTest"),
+                       _lazy("tests", "FabberProcessTest")],
+    "processes" : [_lazy("process", "FabberProcess", PROCESS_NAME="Fabber"),
+                   _lazy("process", "FabberSimStudyProcess", PROCESS_NAME="FabberSimStudy")],
     "fabber-dirs" : [os.path.dirname(__file__)],
     "module-dirs" : ["deps",],
 }
@@ -0,0 +1,262 @@
+"""
+Quantiphyse: Asyncio interface to Fabber
+
+Fits are run by the same worker machinery as ``engine.run``, but are driven
+from an asyncio event loop so many fits can be coordinated without blocking.
+All fits submitted to a ``FabberExecutor`` share one pool of worker processes::
+
+    async with FabberExecutor(n_workers=8) as executor:
+        fit = executor.submit(data, mask, {"model" : "poly", "degree" : 2, "save-mean" : True})
+        async for event in fit.events():
+            print(event.kind, event.progress)
+        outputs = await fit
+
+Requires Python 3.7 or later.
+
+Copyright (c) 2016-2017 University of Oxford, Martin Craig
+"""
+
+import asyncio
+import logging
+import functools
+import itertools
+import collections
+import multiprocessing
+
+from . import engine, remote
+
+LOG = logging.getLogger(__name__)
+
+#: Interval in seconds between checks for progress updates from the workers
+PROGRESS_INTERVAL = 0.1
+
+class FabberEvent(collections.namedtuple("FabberEvent", ["kind", "progress", "chunk"])):
+    """
+    Event reported while a fit is running
+
+    :ivar kind: ``PROGRESS``, ``CHUNK`` (a chunk has been fitted), ``DONE`` or ``FAILED``
+    :ivar progress: Fraction of the fit completed
+    :ivar chunk: Index of the chunk which has been fitted, for ``CHUNK`` events
+    """
+    PROGRESS = "progress"
+    CHUNK = "chunk"
+    DONE = "done"
+    FAILED = "failed"
+
+class FabberFit(object):
+    """
+    A fit submitted to a ``FabberExecutor``
+
+    Awaiting the fit returns a mapping from output name to full size Numpy array,
+    as returned by ``engine.run``. If a chunk fails the exception is raised.
+    """
+
+    def __init__(self, loop, cancel_event, log=None):
+        self._plan = None
+        self._log = log
+        self._cancel_event = cancel_event
+        self._future = loop.create_future()
+        self._events = asyncio.Queue()
+        self._done = []
+        self._output = []
+
+    def _set_plan(self, plan):
+        self._plan = plan
+        self._done = [0.0, ] * len(plan.worker_args)
+        self._output = [None, ] * len(plan.worker_args)
+
+    def __await__(self):
+        return self._future.__await__()
+
+    @property
+    def progress(self):
+        """
+        Fraction of the fit completed
+        """
+        if self._plan is None:
+            return 0.0
+        return sum(self._done) / sum(self._plan.chunk_voxels)
+
+    def done(self):
+        """
+        :return: True if the fit has finished, failed or been cancelled
+        """
+        return self._future.done()
+
+    def cancel(self):
+        """
+        Cancel the fit. Chunks which have not started are skipped and running chunks
+        are stopped by the workers at their next progress update
+        """
+        if self._future.cancel():
+            self._cancel_event.set()
+            self._events.put_nowait(FabberEvent(FabberEvent.FAILED, self.progress, None))
+
+    async def events(self):
+        """
+        Asynchronous iterator over progress events, ending when the fit finishes or fails.
+        Only one consumer should iterate over the events of a fit
+        """
+        while True:
+            event = await self._events.get()
+            yield event
+            if event.kind in (FabberEvent.DONE, FabberEvent.FAILED):
+                return
+
+    def partial_output(self):
+        """
+        :return: Mapping from output name to full size Numpy array containing the
+                 output of the chunks fitted so far. Other voxels are zero
+        """
+        if self._plan is None:
+            return {}
+        return self._plan.get_outputs([runs[0] if runs is not None else None for runs in self._output])
+
+    def _progress(self, chunk_idx, done, todo):
+        if self.done():
+            return
+        self._done[chunk_idx] = self._plan.chunk_voxels[chunk_idx] * float(done) / todo
+        self._events.put_nowait(FabberEvent(FabberEvent.PROGRESS, self.progress, None))
+
+    def _chunk_finished(self, chunk_idx, success, output):
+        if self.done():
+            return
+        if not success:
+            self._future.set_exception(output)
+            self._events.put_nowait(FabberEvent(FabberEvent.FAILED, self.progress, chunk_idx))
+            return
+
+        self._output[chunk_idx] = output
+        self._done[chunk_idx] = self._plan.chunk_voxels[chunk_idx]
+        self._events.put_nowait(FabberEvent(FabberEvent.CHUNK, self.progress, chunk_idx))
+        if None not in self._output:
+            runs = [runs[0] for runs in self._output]
+            engine.update_voxel_time(self._plan.timing_key, runs)
+            if self._log is not None:
+                self._plan.write_log(self._output, self._log)
+            self._future.set_result(self._plan.get_outputs(runs))
+            self._events.put_nowait(FabberEvent(FabberEvent.DONE, 1.0, None))
+
+class FabberExecutor(object):
+    """
+    Pool of Fabber worker processes driven from an asyncio event loop
+
+    :param n_workers: Maximum number of worker processes, default is one for each available CPU
+    :param cpu_budget: Maximum number of CPUs to use, default is all available CPUs
+    :param threads_per_worker: Number of threads each worker may use
+    :param pin_workers: If True, pin each worker to its own CPUs
+    :param search_dirs: Additional directories to search for Fabber libraries
+    """
+
+    def __init__(self, n_workers=None, cpu_budget=None, threads_per_worker=1, pin_workers=False, search_dirs=()):
+        self.n_workers = engine.get_pool_size(None, n_workers, cpu_budget, threads_per_worker)
+        self.search_dirs = search_dirs
+        self._pool = engine.make_pool(None, self.n_workers, cpu_budget, threads_per_worker, pin_workers)
+        self._manager = multiprocessing.Manager()
+        self._queue = self._manager.Queue()
+        # Worker IDs are unique across all fits so progress can be routed to the right fit
+        self._worker_ids = itertools.count()
+        self._chunks = {}
+        self._planning = set()
+        self._poller = None
+
+    def submit(self, data, mask=None, options=None, add_data=None, log=None):
+        """
+        Submit a fit to the workers
+
+        Takes the same arguments as ``engine.run``. Must be called from a running event loop.
+        The data is partitioned into chunks in a separate thread so the event loop is not
+        blocked while a large fit is prepared
+
+        :return: ``FabberFit`` which can be awaited to obtain the outputs
+        """
+        if self._pool is None:
+            raise RuntimeError("Executor has been closed")
+        if remote.get_backend(dict(options or {})) is not None:
+            raise ValueError("Remote backend is not supported by FabberExecutor - use engine.run")
+        loop = asyncio.get_running_loop()
+        fit = FabberFit(loop, self._manager.Event(), log)
+        self._planning.add(fit)
+        make_plan = functools.partial(engine._RunPlan, data, mask, options, add_data, self.search_dirs, self.n_workers)
+        fit._start_task = loop.create_task(self._start_fit(fit, make_plan))
+        return fit
+
+    async def _start_fit(self, fit, make_plan):
+        """
+        Partition the data for a fit and send its chunks to the workers
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            plan = await loop.run_in_executor(None, make_plan)
+        except Exception as exc:
+            if not fit.done():
+                fit._future.set_exception(exc)
+                fit._events.put_nowait(FabberEvent(FabberEvent.FAILED, 0.0, None))
+            return
+        finally:
+            self._planning.discard(fit)
+
+        if fit.done() or self._pool is None:
+            # Cancelled, or executor closed, while the data was being partitioned
+            fit.cancel()
+            return
+
+        fit._set_plan(plan)
+        for chunk_idx, args in enumerate(plan.worker_args):
+            worker_id = next(self._worker_ids)
+            self._chunks[worker_id] = (fit, chunk_idx)
+
+            def _callback(result, worker_id=worker_id):
+                loop.call_soon_threadsafe(self._chunk_finished, worker_id, result[1], result[2])
+
+            def _error_callback(exc, worker_id=worker_id):
+                loop.call_soon_threadsafe(self._chunk_finished, worker_id, False, exc)
+
+            # Each fit has its own cancel event as the workers are shared between fits
+            options = dict(args[0], **{"cancel-event" : fit._cancel_event})
+            self._pool.apply_async(engine._run_fabber, [worker_id, self._queue, options] + list(args[1:]),
+                                   callback=_callback, error_callback=_error_callback)
+
+        if self._poller is None or self._poller.done():
+            self._poller = loop.create_task(self._poll_progress())
+
+    async def close(self):
+        """
+        Stop the worker processes. Fits which have not finished are cancelled
+        """
+        for fit, _ in list(self._chunks.values()):
+            fit.cancel()
+        for fit in list(self._planning):
+            fit.cancel()
+        self._chunks = {}
+        if self._poller is not None:
+            self._poller.cancel()
+            self._poller = None
+        if self._pool is not None:
+            pool, self._pool = self._pool, None
+            pool.terminate()
+            await asyncio.get_running_loop().run_in_executor(None, pool.join)
+            self._manager.shutdown()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    def _chunk_finished(self, worker_id, success, output):
+        fit, chunk_idx = self._chunks.pop(worker_id, (None, None))
+        if fit is not None:
+            fit._chunk_finished(chunk_idx, success, output)
+
+    async def _poll_progress(self):
+        """
+        Route progress updates from the workers to their fits while any chunks are running
+        """
+        while self._chunks:
+            await asyncio.sleep(PROGRESS_INTERVAL)
+            while not self._queue.empty():
+                worker_id, done, todo = self._queue.get_nowait()
+                fit, chunk_idx = self._chunks.get(worker_id, (None, None))
+                if fit is not None:
+                    fit._progress(chunk_idx, done, todo)
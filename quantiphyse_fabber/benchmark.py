@@ -0,0 +1,223 @@
+"""
+Quantiphyse: Benchmark suite for Fabber process
+
+Runs ``FabberProcess`` without the GUI on synthetic data generated from the
+polynomial model for a range of data sizes, ROI fill fractions, worker counts
+and inference methods. Wall time, voxels/s, peak memory and the volume of
+data passed to and from the workers are written to a JSON file so performance
+can be tracked between versions.
+
+Usage::
+
+    python -m quantiphyse_fabber.benchmark --output fabber_benchmark.json
+
+Copyright (c) 2016-2017 University of Oxford, Martin Craig
+"""
+
+from __future__ import division, print_function
+
+import sys
+import time
+import json
+import pickle
+import platform
+import argparse
+import multiprocessing
+
+import numpy as np
+
+from PySide2 import QtCore
+
+from quantiphyse.data import ImageVolumeManagement, DataGrid
+from quantiphyse.processes import Process
+
+from .process import FabberProcess
+from .engine import peak_rss
+
+#: Parameter values used to generate the test data. Each varies along one axis
+PARAM_TEST_VALUES = {"c0" : [-100, 0, 100], "c1" : [-10, 0, 10], "c2" : [-1, 0, 1]}
+
+#: Patch sizes - the test data has 3 patches along each axis
+DEFAULT_PATCH_SIZES = [4, 8, 16]
+
+DEFAULT_FILL_FRACTIONS = [0.1, 0.5, 1.0]
+
+DEFAULT_METHODS = ["vb", "spatialvb"]
+
+class _BenchmarkProcess(FabberProcess):
+    """
+    FabberProcess which records the volume of data passed to and from
+    the workers, and their peak memory use
+
+    The worker arguments and output are kept so that their size can be measured
+    by ``measure_ipc`` after the run, outside the timed region
+    """
+
+    def __init__(self, ivm, **kwargs):
+        FabberProcess.__init__(self, ivm, **kwargs)
+        self.ipc_in = 0
+        self.ipc_out = 0
+        self.worker_rss = None
+        self._ipc_args = []
+        self._ipc_output = None
+
+    def split_args(self, n_workers, args):
+        worker_args = FabberProcess.split_args(self, n_workers, args)
+        # First two arguments are the worker ID and the progress queue
+        self._ipc_args = [wargs[2:] for wargs in worker_args]
+        return worker_args
+
+    def finished(self, worker_output):
+        if self.status == Process.SUCCEEDED:
+            self._ipc_output = worker_output
+            worker_rss = [run.stats["peak-rss"] for runs in worker_output for run in runs
+                          if getattr(run, "stats", None) and run.stats["peak-rss"] is not None]
+            if worker_rss:
+                self.worker_rss = max(worker_rss)
+        FabberProcess.finished(self, worker_output)
+
+    def measure_ipc(self):
+        """
+        Set the number of bytes passed to and from the workers from the
+        pickled size of their arguments and output
+        """
+        self.ipc_in = sum([len(pickle.dumps(wargs, pickle.HIGHEST_PROTOCOL)) for wargs in self._ipc_args])
+        if self._ipc_output is not None:
+            self.ipc_out = len(pickle.dumps(self._ipc_output, pickle.HIGHEST_PROTOCOL))
+        self._ipc_args, self._ipc_output = [], None
+
+def _get_test_data(patchsize, nt):
+    """
+    :return: 4D Numpy array of test data from the polynomial model
+    """
+    from fabber import generate_test_data
+    api = FabberProcess.api()
+    test_data = generate_test_data(api, {"model" : "poly", "degree" : 2}, PARAM_TEST_VALUES,
+                                   nt=nt, patchsize=patchsize, noise=10)
+    return test_data["data"]
+
+def _get_mask(shape, fill, random_state):
+    """
+    :return: Random ROI with approximately the given fraction of voxels unmasked
+    """
+    mask = (random_state.random_sample(shape) < fill).astype(np.int32)
+    # Make sure there is at least one unmasked voxel so the bounding box is defined
+    mask.flat[0] = 1
+    return mask
+
+def run_case(app, data, mask, method, num_workers):
+    """
+    Run a single benchmark case
+
+    :return: Dictionary of benchmark results
+    """
+    grid = DataGrid(data.shape[:3], np.identity(4))
+    ivm = ImageVolumeManagement()
+    ivm.add(data, grid=grid, name="data")
+    ivm.add(mask, grid=grid, name="mask", roi=True)
+
+    process = _BenchmarkProcess(ivm)
+    done = []
+    process.sig_finished.connect(lambda *args: done.append(True))
+    options = {
+        "data" : "data",
+        "roi" : "mask",
+        "model" : "poly",
+        "degree" : 2,
+        "method" : method,
+        "noise" : "white",
+        "save-mean" : True,
+        "num-workers" : num_workers,
+    }
+
+    start = time.time()
+    process.execute(options)
+    while not done:
+        app.processEvents()
+        time.sleep(0.01)
+    wall_time = time.time() - start
+    process.measure_ipc()
+
+    nvoxels = int(np.count_nonzero(mask))
+    return {
+        "voxels" : nvoxels,
+        "method" : method,
+        "workers" : num_workers,
+        "status" : "success" if process.status == Process.SUCCEEDED else "failed",
+        "wall-time" : wall_time,
+        "voxels-per-second" : nvoxels / wall_time if wall_time > 0 else 0,
+        "worker-peak-rss" : process.worker_rss,
+        "peak-rss" : peak_rss(),
+        "ipc-in-bytes" : process.ipc_in,
+        "ipc-out-bytes" : process.ipc_out,
+    }
+
+def run_benchmarks(patch_sizes=None, fills=None, workers=None, methods=None, nt=10, seed=0, log=sys.stdout):
+    """
+    Run benchmark cases for all combinations of the given settings
+
+    Spatial VB always runs in a single worker so is only run once
+    for each data size and fill fraction
+
+    :return: List of dictionaries of benchmark results
+    """
+    if patch_sizes is None:
+        patch_sizes = DEFAULT_PATCH_SIZES
+    if fills is None:
+        fills = DEFAULT_FILL_FRACTIONS
+    if workers is None:
+        workers = sorted(set([1, 2, 4, multiprocessing.cpu_count()]))
+    if methods is None:
+        methods = DEFAULT_METHODS
+
+    app = QtCore.QCoreApplication.instance()
+    if app is None:
+        app = QtCore.QCoreApplication(sys.argv)
+
+    random_state = np.random.RandomState(seed)
+    results = []
+    for patchsize in patch_sizes:
+        data = _get_test_data(patchsize, nt)
+        for fill in fills:
+            mask = _get_mask(data.shape[:3], fill, random_state)
+            for method in methods:
+                if method == "spatialvb":
+                    method_workers = [1,]
+                else:
+                    method_workers = workers
+                for num_workers in method_workers:
+                    result = run_case(app, data, mask, method, num_workers)
+                    result.update({"shape" : list(data.shape), "fill" : fill})
+                    log.write("%s\n" % json.dumps(result, sort_keys=True))
+                    log.flush()
+                    results.append(result)
+    return results
+
+def main():
+    """
+    Command line entry point
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the Quantiphyse Fabber process")
+    parser.add_argument("--output", help="JSON file to write results to", default="fabber_benchmark.json")
+    parser.add_argument("--patch-sizes", help="Test data patch sizes", type=int, nargs="+", default=DEFAULT_PATCH_SIZES)
+    parser.add_argument("--fills", help="ROI fill fractions", type=float, nargs="+", default=DEFAULT_FILL_FRACTIONS)
+    parser.add_argument("--workers", help="Worker counts", type=int, nargs="+", default=None)
+    parser.add_argument("--methods", help="Inference methods", nargs="+", default=DEFAULT_METHODS)
+    parser.add_argument("--nt", help="Number of time points in test data", type=int, default=10)
+    parser.add_argument("--seed", help="Random seed for ROI generation", type=int, default=0)
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.patch_sizes, args.fills, args.workers, args.methods, args.nt, args.seed)
+    with open(args.output, "w") as outfile:
+        json.dump({
+            "timestamp" : time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "platform" : platform.platform(),
+            "python" : platform.python_version(),
+            "cpu-count" : multiprocessing.cpu_count(),
+            "results" : results,
+        }, outfile, indent=2, sort_keys=True)
+    print("Results written to %s" % args.output)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,1239 @@
+"""
+Quantiphyse: Fabber execution engine
+
+Functions which run Fabber on Numpy arrays in parallel worker processes. These
+are used by the Quantiphyse processes but do not depend on Quantiphyse or Qt,
+so Fabber can be run in the same way on headless systems, e.g.::
+
+    from quantiphyse_fabber import engine
+    outputs = engine.run(data, mask, {"model" : "poly", "degree" : 2, "save-mean" : True})
+
+Copyright (c) 2016-2017 University of Oxford, Martin Craig
+"""
+
+import sys
+import os
+import re
+import time
+import logging
+import itertools
+import multiprocessing
+
+import numpy as np
+
+from .logs import LogSummary, summarise_log, get_log_file
+
+LOG = logging.getLogger(__name__)
+
+#: Directory containing Fabber libraries bundled with the plugin
+FABBER_DIR = os.path.dirname(__file__)
+
+#: Name of output mask identifying voxels which could not be fitted
+FAILED_OUTPUT = "fabber_failed"
+
+#: Name of output mask giving the number of Fabber warnings for each voxel
+WARNING_OUTPUT = "fabber_warnings"
+
+#: Outputs which are ROIs rather than data
+ROI_OUTPUTS = [FAILED_OUTPUT, WARNING_OUTPUT]
+
+#: Minimum chunk size when the time per voxel is not yet known
+MIN_CHUNK_VOXELS = 100
+
+#: Minimum fitting time in seconds for a chunk, used to choose the chunk size once
+#: the time per voxel is known
+MIN_CHUNK_TIME = 1.0
+
+#: Weight given to the latest run when updating the estimated time per voxel
+VOXEL_TIME_WEIGHT = 0.5
+
+# Estimated fitting time per voxel from previous runs, see get_voxel_time
+_VOXEL_TIMES = {}
+
+# Thread pool limits applied in worker processes, see limit_threads
+_THREAD_LIMITS = None
+
+#: Environment variables which limit the number of threads used by numerical libraries
+THREAD_ENV_VARS = ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS",
+                   "VECLIB_MAXIMUM_THREADS", "NUMEXPR_NUM_THREADS"]
+
+#: Name of output giving the fitting time for each voxel in seconds
+RUNTIME_OUTPUT = "fabber_runtime"
+
+#: Number of single voxel failures, with no successful fits, after which a chunk is treated as failed
+MAX_ISOLATED_FAILURES = 8
+
+# Event set by the coordinating process to cancel the run, in worker processes
+_CANCEL_EVENT = None
+
+#: Name of ROI output marking voxels excluded by screening, with the reason for exclusion
+SCREENED_OUTPUT = "fabber_screened"
+
+#: Reasons for excluding voxels by screening, indexed by the value in ``SCREENED_OUTPUT``
+SCREEN_REASONS = {1 : "non-finite values", 2 : "all-zero signal", 3 : "constant signal"}
+
+#: Default number of voxels fitted in a pilot run
+PILOT_VOXELS = 500
+
+#: Number of signal intensity strata used to sample voxels for a pilot run
+PILOT_STRATA = 10
+
+def get_model_group_name(lib):
+    """ Get the model group name from a library name"""
+    match = re.match(r".*fabber_models_(.+)\..+", lib, re.I)
+    if match:
+        return match.group(1).lower()
+    else:
+        return lib.lower()
+
+def get_api(search_dirs=(), model_group=None):
+    """
+    Return a Fabber API object
+
+    If a model group is given only the models executable for that group is
+    used, rather than querying every installed model group, which reduces
+    start up time when many model groups are installed. If the group is not
+    found all model groups are used as usual so Fabber can report the problem.
+
+    :param search_dirs: Sequence of directories to search for Fabber libraries and executables
+    :param model_group: Name of model group which will be used
+    """
+    from fabber import Fabber, FabberCl, find_fabber
+    if model_group:
+        _, core_exe, _, model_exes = find_fabber(*search_dirs)
+        model_group = get_model_group_name(model_group)
+        if model_group in model_exes:
+            return FabberCl(core_exe=core_exe, model_exes={model_group : model_exes[model_group]})
+        LOG.debug("Model group %s not found - using all model groups", model_group)
+    return Fabber(*search_dirs)
+
+def peak_rss():
+    """
+    :return: Peak resident memory of the current process in bytes, or None if not available
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform.startswith("darwin"):
+        return peak
+    else:
+        # Reported in kB on Linux
+        return peak * 1024
+
+def get_available_cpus():
+    """
+    :return: Number of CPUs this process is allowed to run on
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return multiprocessing.cpu_count()
+
+def get_pool_size(n_tasks=None, max_workers=None, cpu_budget=None, threads_per_worker=1):
+    """
+    Get the number of worker processes to run at once
+
+    Each worker may use ``threads_per_worker`` threads so the number of workers is
+    limited so the total number of threads does not exceed the CPU budget
+
+    :param n_tasks: Number of tasks, if known. There is no point in more workers than tasks
+    :param max_workers: Optional maximum number of workers
+    :param cpu_budget: Number of CPUs which may be used. Default is all available CPUs
+    :param threads_per_worker: Number of threads each worker may use
+    """
+    if not cpu_budget:
+        cpu_budget = get_available_cpus()
+    pool_size = max(1, int(cpu_budget) // max(1, int(threads_per_worker)))
+    if max_workers:
+        pool_size = min(pool_size, int(max_workers))
+    if n_tasks:
+        pool_size = min(pool_size, n_tasks)
+    return max(1, pool_size)
+
+def limit_threads(num_threads):
+    """
+    Limit the number of threads used by numerical libraries in this process
+
+    Environment variables are set so they apply to libraries loaded later (e.g. the
+    Fabber model libraries) and to Fabber executables run as subprocesses. Libraries
+    already loaded by Numpy are limited using ``threadpoolctl`` if it is installed
+    """
+    global _THREAD_LIMITS
+    for var in THREAD_ENV_VARS:
+        os.environ[var] = str(num_threads)
+    try:
+        from threadpoolctl import threadpool_limits
+        # Keep a reference so the limits remain in force
+        _THREAD_LIMITS = threadpool_limits(limits=num_threads)
+    except ImportError:
+        LOG.debug("threadpoolctl not available - thread limits only applied through environment")
+
+def _pin_worker(counter, num_threads):
+    """
+    Pin this worker process to its own set of CPUs
+
+    :param counter: Shared ``multiprocessing.Value`` used to give each worker a different slot
+    """
+    if not hasattr(os, "sched_setaffinity"):
+        LOG.debug("CPU affinity not supported on this platform")
+        return
+    cpus = sorted(os.sched_getaffinity(0))
+    with counter.get_lock():
+        slot = counter.value
+        counter.value += 1
+    start = (slot * num_threads) % len(cpus)
+    os.sched_setaffinity(0, [cpus[(start + idx) % len(cpus)] for idx in range(min(num_threads, len(cpus)))])
+
+class Cancelled(Exception):
+    """
+    Raised in a worker process when the run has been cancelled
+    """
+
+def _check_cancelled():
+    """
+    Raise ``Cancelled`` if the coordinating process has cancelled the run
+    """
+    if _CANCEL_EVENT is not None and _CANCEL_EVENT.is_set():
+        raise Cancelled("Fabber run was cancelled")
+
+def _kill_children():
+    """
+    Terminate subprocesses of this worker, e.g. Fabber executables left
+    running by a cancelled fit. Requires ``psutil``
+    """
+    try:
+        import psutil
+    except ImportError:
+        LOG.debug("psutil not available - Fabber subprocesses will run to completion")
+        return
+    for child in psutil.Process().children(recursive=True):
+        try:
+            child.terminate()
+        except psutil.Error:
+            pass
+
+def _init_worker(num_threads, pin_counter=None, initializer=None, cancel_event=None):
+    """
+    Initializer for worker processes which applies thread limits and CPU pinning
+    """
+    global _CANCEL_EVENT
+    _CANCEL_EVENT = cancel_event
+    limit_threads(num_threads)
+    if pin_counter is not None:
+        _pin_worker(pin_counter, num_threads)
+    if initializer is not None:
+        initializer()
+
+def make_pool(n_tasks, max_workers=None, cpu_budget=None, threads_per_worker=1, pin_workers=False, initializer=None,
+              cancel_event=None):
+    """
+    Create a pool of worker processes respecting a CPU budget
+
+    :param pin_workers: If True, each worker is pinned to its own set of ``threads_per_worker`` CPUs
+    :param initializer: Optional additional initializer function for the workers
+    :param cancel_event: Optional ``multiprocessing.Event`` which is set to cancel the run. Workers
+                         stop at their next progress update, or before starting a chunk
+    :return: ``multiprocessing.Pool``
+    """
+    threads_per_worker = max(1, int(threads_per_worker or 1))
+    pool_size = get_pool_size(n_tasks, max_workers, cpu_budget, threads_per_worker)
+    pin_counter = multiprocessing.Value("i", 0) if pin_workers else None
+    LOG.debug("Starting %i workers with %i threads each", pool_size, threads_per_worker)
+    return multiprocessing.Pool(pool_size, initializer=_init_worker,
+                                initargs=(threads_per_worker, pin_counter, initializer, cancel_event))
+
+def _make_fabber_progress_cb(worker_id, queue, variant=0, num_variants=1):
+    """
+    Closure which can be used as a progress callback for the C API. Puts the
+    number of voxels processed onto the queue
+
+    When a worker runs several option variants in turn (parameter sweep) the
+    progress is reported as a fraction of the work for all variants. If the run
+    has been cancelled ``Cancelled`` is raised to abort the fit
+    """
+    def _progress_cb(voxel, nvoxels):
+        _check_cancelled()
+        voxel += variant * nvoxels
+        nvoxels *= num_variants
+        percent = int(100*float(voxel)/nvoxels)
+        if percent != _progress_cb.last_percent:
+            _progress_cb.last_percent = percent
+            queue.put((worker_id, voxel, nvoxels))
+
+    _progress_cb.last_percent = 0
+    return _progress_cb
+
+class _VoxelTimer(object):
+    """
+    Progress callback wrapper which records when each voxel was completed so a map
+    of the fitting time for each voxel can be produced
+    """
+    def __init__(self, progress_cb):
+        self._progress_cb = progress_cb
+        self._times = []
+
+    def __call__(self, voxel, nvoxels):
+        self._times.append((time.time(), float(voxel) / nvoxels))
+        self._progress_cb(voxel, nvoxels)
+
+    def get_map(self, mask, start, end, per_voxel=True):
+        """
+        Get the fitting time for each voxel
+
+        Fabber fits voxels in Fortran order. The time between progress updates is
+        divided between the voxels completed in that time. If ``per_voxel`` is False
+        or there were no progress updates the total time is divided evenly
+
+        :return: Numpy array with the same shape as ``mask``
+        """
+        voxels = np.flatnonzero(mask.ravel(order="F"))
+        runtime = np.zeros(mask.size, dtype=np.float32)
+        times = self._times if per_voxel else []
+        prev_time, prev_done = start, 0
+        for timestamp, fraction in times + [(end, 1.0)]:
+            done = int(round(fraction * len(voxels)))
+            if done > prev_done:
+                runtime[voxels[prev_done:done]] = (timestamp - prev_time) / (done - prev_done)
+                prev_time, prev_done = timestamp, done
+        return runtime.reshape(mask.shape, order="F")
+
+def _run_fabber(worker_id, queue, options, main_data, roi, *add_data):
+    """
+    Function to run Fabber in a multiprocessing environment
+
+    The ``variants`` option may contain a sequence of option dictionaries which
+    are applied in turn to the base options, so the same data chunk can be fitted
+    under several option settings (parameter sweep) while loading the data and API
+    only once. The output is a list of ``FabberRun`` objects, one for each variant.
+    Each has a ``stats`` attribute containing the number of voxels fitted, the time
+    taken to load the API, the fitting time, start and end timestamps and the peak
+    memory of the worker process
+
+    Unless the ``retry-failed`` option is False, voxels which cause the fit to fail
+    are isolated and the outputs for the remaining voxels retained - see
+    ``_run_isolating_failures``. The ``retry-options`` option may give a dictionary
+    of fallback options to use when refitting failed voxels.
+
+    Only a bounded summary of each Fabber log is returned, with warnings aggregated
+    by type (``run.log_summary``). If the ``log-dir`` option is set the full logs
+    are written to files in that directory. The voxels affected by each type of
+    warning are located in the chunk, and if the ``save-warning-mask`` option is set
+    an additional output ``WARNING_OUTPUT`` gives the number of warnings for each voxel.
+
+    If the ``save-runtime-map`` option is set, an additional output ``RUNTIME_OUTPUT``
+    gives the approximate fitting time for each voxel. Where voxels had to be
+    isolated after a failure the chunk fitting time is divided evenly instead.
+
+    Chunks fitted on remote worker nodes are dispatched by the coordinating process
+    instead - see ``quantiphyse_fabber.remote``
+
+    If the run is cancelled (see ``make_pool``) the fit is aborted at the next
+    progress update and a ``Cancelled`` exception is returned. Where workers are
+    shared between runs, the ``cancel-event`` option gives an event which cancels
+    only this run instead
+    """
+    global _CANCEL_EVENT
+    from fabber import FabberRun
+    log_dir = None
+    pool_cancel_event = _CANCEL_EVENT
+    try:
+        _CANCEL_EVENT = options.pop("cancel-event", None) or pool_cancel_event
+        # Chunks still queued when the run is cancelled are not started
+        _check_cancelled()
+        indir = options.pop("indir", None)
+        if indir:
+            os.chdir(indir)
+
+        variants = options.pop("variants", None) or [{}]
+        retry_failed = options.pop("retry-failed", True)
+        retry_options = options.pop("retry-options", None)
+        save_runtime = options.pop("save-runtime-map", False)
+        log_dir = options.pop("log-dir", None)
+        save_warnings = options.pop("save-warning-mask", False)
+        if np.count_nonzero(roi) == 0:
+            # Ignore runs with no voxel. Return placeholder objects
+            LOG.debug("No voxels")
+            return worker_id, True, [FabberRun({}, "") for _ in variants]
+
+        options["data"] = main_data
+        options["mask"] = roi
+        if len(add_data) % 2 != 0:
+            raise Exception("Additional data has odd-numbered length %i - should be sequence of key then value" % len(add_data))
+        n = 0
+        while n < len(add_data):
+            options[add_data[n]] = add_data[n+1]
+            n += 2
+
+        start = time.time()
+        api = get_api(options.pop("fabber-dirs", ()), options.pop("model-group", None))
+        api_load_time = time.time() - start
+        runs = []
+        for idx, variant in enumerate(variants):
+            run_options = dict(options)
+            run_options.update(variant)
+            progress_cb = _make_fabber_progress_cb(worker_id, queue, idx, len(variants))
+            if save_runtime:
+                progress_cb = _VoxelTimer(progress_cb)
+            start = time.time()
+            if retry_failed:
+                run = _run_isolating_failures(api, run_options, progress_cb, retry_options)
+            else:
+                run = api.run(run_options, progress_cb=progress_cb)
+            end = time.time()
+            if save_runtime:
+                run.data[RUNTIME_OUTPUT] = progress_cb.get_map(roi, start, end, not getattr(run, "isolated", False))
+            run.log_summary = summarise_log(run.log, get_log_file(log_dir, worker_id, idx if len(variants) > 1 else None))
+            run.log = run.log_summary.format()
+            # When failed voxels were isolated the log is from a fit to a subset of the
+            # voxels so its voxel numbers cannot be located
+            warning_mask = run.log_summary.locate_voxels(np.zeros_like(roi) if getattr(run, "isolated", False) else roi,
+                                                         save_warnings)
+            if save_warnings:
+                run.data[WARNING_OUTPUT] = warning_mask
+            run.stats = {
+                "voxels" : int(np.count_nonzero(roi)),
+                "api-load-time" : api_load_time,
+                "fit-time" : end - start,
+                "start-time" : start,
+                "end-time" : end,
+                "peak-rss" : peak_rss(),
+            }
+            runs.append(run)
+        return worker_id, True, runs
+    except Cancelled as exc:
+        _kill_children()
+        return worker_id, False, exc
+    except:
+        import traceback
+        traceback.print_exc()
+        exc = sys.exc_info()[1]
+        if getattr(exc, "log", None):
+            # Failure logs can also be huge
+            exc.log = summarise_log(exc.log, get_log_file(log_dir, worker_id)).format()
+        return worker_id, False, exc
+    finally:
+        _CANCEL_EVENT = pool_cancel_event
+
+class _ChunkFailed(Exception):
+    """
+    Raised to stop isolating failed voxels when the whole chunk appears to be failing
+    """
+
+def _run_isolating_failures(api, options, progress_cb=None, retry_options=None):
+    """
+    Run Fabber, isolating voxels which cause the fit to fail
+
+    If the fit fails the unmasked voxels are split in half and each half is fitted
+    separately, recursively, until the failing voxels are isolated. Single voxels
+    which still fail are refitted with ``retry_options`` (if given) applied, and
+    otherwise marked in the ``FAILED_OUTPUT`` mask. Outputs for all other voxels
+    are retained.
+
+    If ``MAX_ISOLATED_FAILURES`` voxels fail before any part of the chunk has been
+    fitted successfully, the failure probably does not depend on the data (e.g.
+    invalid options) so the original exception is raised. It is also raised if no
+    voxels could be fitted at all.
+
+    :return: ``FabberRun`` object
+    """
+    from fabber import FabberException, FabberRun
+    mask = options["mask"]
+    nvoxels = int(np.count_nonzero(mask))
+    state = {"done" : 0, "fitting" : nvoxels, "runs" : [], "errors" : [], "retried" : 0}
+    failed = np.zeros(mask.shape, dtype=np.int32)
+
+    def _progress_cb(done, total):
+        # Backends report progress in different units, e.g. the command line
+        # backend reports percent, so convert to voxels of the current fit
+        voxel = int(float(done) / total * state["fitting"]) if total else 0
+        if progress_cb is not None:
+            progress_cb(state["done"] + voxel, nvoxels)
+
+    def _fit(sub_mask, sub_options):
+        _check_cancelled()
+        state["fitting"] = int(np.count_nonzero(sub_mask))
+        run = api.run(dict(sub_options, mask=sub_mask), progress_cb=_progress_cb)
+        state["runs"].append((run, sub_mask))
+        state["done"] += int(np.count_nonzero(sub_mask))
+
+    def _voxel_mask(voxels):
+        sub_mask = np.zeros(mask.shape, dtype=mask.dtype)
+        sub_mask.flat[voxels] = 1
+        return sub_mask
+
+    def _isolate(voxels):
+        try:
+            _fit(_voxel_mask(voxels), options)
+            return
+        except FabberException as exc:
+            error = exc
+
+        if len(voxels) > 1:
+            for half in np.array_split(voxels, 2):
+                _isolate(half)
+            return
+
+        if retry_options:
+            try:
+                _fit(_voxel_mask(voxels), dict(options, **retry_options))
+                state["retried"] += 1
+                return
+            except FabberException as exc:
+                error = exc
+        failed.flat[voxels] = 1
+        state["errors"].append(str(error))
+        state["done"] += 1
+        if not state["runs"] and len(state["errors"]) >= MAX_ISOLATED_FAILURES:
+            raise _ChunkFailed()
+
+    try:
+        return api.run(options, progress_cb=_progress_cb)
+    except FabberException as exc:
+        error = exc
+
+    LOG.debug("Fit failed: %s - isolating failed voxels", error)
+    try:
+        voxels = np.flatnonzero(mask)
+        if len(voxels) > 1:
+            for half in np.array_split(voxels, 2):
+                _isolate(half)
+        elif retry_options:
+            _isolate(voxels)
+    except _ChunkFailed:
+        raise error
+
+    if not state["runs"]:
+        raise error
+
+    data = {}
+    for run, sub_mask in state["runs"]:
+        for key, value in run.data.items():
+            if key not in data:
+                data[key] = np.zeros(value.shape, dtype=value.dtype)
+            data[key][sub_mask > 0] = value[sub_mask > 0]
+
+    log = state["runs"][0][0].log
+    if state["retried"]:
+        log += "\nWARNING: %i voxels were fitted using fallback options\n" % state["retried"]
+    if state["errors"]:
+        data[FAILED_OUTPUT] = failed
+        log += "\nWARNING: %i voxels could not be fitted: %s\n" % (len(state["errors"]), state["errors"][0])
+    run = FabberRun(data, log)
+    run.isolated = True
+    return run
+
+def _evaluate_model(worker_id, queue, options, param_names, param_values, nt):
+    """
+    Function to evaluate a Fabber model in a multiprocessing environment
+
+    :param param_names: Sequence of model parameter names
+    :param param_values: 2D Numpy array of parameter values, one row for each
+                         combination of parameter values to evaluate
+    :param nt: Number of time points to evaluate
+    :return: 2D Numpy array containing the model time series for each row of ``param_values``
+    """
+    try:
+        api = get_api(options.pop("fabber-dirs", ()), options.pop("model-group", None))
+        curves = np.zeros((len(param_values), nt), dtype=np.float32)
+        for idx, values in enumerate(param_values):
+            curves[idx] = api.model_evaluate(options, dict(zip(param_names, values)), nt)
+            queue.put((worker_id, idx+1, len(param_values)))
+        return worker_id, True, curves
+    except:
+        import traceback
+        traceback.print_exc()
+        return worker_id, False, sys.exc_info()[1]
+
+def get_param_grid(param_test_values):
+    """
+    Get the combinations of parameter values needed to generate test data
+
+    Parameters with more than one test value each vary along one dimension of the
+    test data, so at most 3 are allowed. Other parameters are fixed.
+
+    :param param_test_values: Mapping from parameter name to value or sequence of values
+    :return: Tuple of parameter names, 2D Numpy array of parameter values with one row for
+             each combination in C-order of the dimensions, sequence of the parameter names
+             for each of the 3 dimensions (None if the dimension does not vary) and
+             the number of values along each dimension
+    """
+    fixed_params, dim_params, dim_values = [], [], []
+    for param, values in param_test_values.items():
+        if not isinstance(values, (list, tuple)):
+            values = [values,]
+        if len(values) == 1:
+            fixed_params.append((param, values[0]))
+        else:
+            dim_params.append(param)
+            dim_values.append(values)
+
+    if len(dim_params) > 3:
+        raise ValueError("Test data can only have up to 3 varying parameters, you supplied %i" % len(dim_params))
+
+    dim_sizes = [len(values) for values in dim_values] + [1, ] * (3 - len(dim_params))
+    param_names = [param for param, _ in fixed_params] + dim_params
+    combinations = itertools.product(*[values for values in dim_values])
+    param_values = np.array([[value for _, value in fixed_params] + list(combination) for combination in combinations], dtype=np.float32)
+    dim_params += [None, ] * (3 - len(dim_params))
+    return param_names, param_values, dim_params, dim_sizes
+
+def make_test_data(curves, dim_params, dim_sizes, patchsize, noise=0, num_repeats=1, seed=None, param_rois=False):
+    """
+    Build test data from model evaluations for each combination of parameter values
+
+    :param curves: 2D Numpy array of model time series in the order returned by ``get_param_grid``
+    :param patchsize: Size of the cubic patch of voxels for each combination
+    :param noise: Standard deviation of Gaussian noise
+    :param num_repeats: Number of noise realisations to generate from the same clean data
+    :return: Dictionary containing ``clean`` data, a list of noisy ``data`` for each realisation
+             and if requested ``param-rois`` mapping varying parameter names to ROIs labelling
+             each patch with the index of the parameter value (starting at 1)
+    """
+    # Replicate each model curve over its patch
+    clean_data = curves.reshape(list(dim_sizes) + [curves.shape[1],])
+    for axis in range(3):
+        clean_data = np.repeat(clean_data, patchsize, axis=axis)
+
+    ret = {"clean" : clean_data, "data" : []}
+    random_state = np.random.RandomState(seed)
+    for _ in range(num_repeats):
+        if noise is not None and noise > 0:
+            ret["data"].append(clean_data + random_state.normal(0, noise, clean_data.shape))
+        else:
+            ret["data"].append(clean_data)
+
+    if param_rois:
+        ret["param-rois"] = {}
+        for axis, param in enumerate(dim_params):
+            if param is not None:
+                labels = np.repeat(np.arange(1, dim_sizes[axis]+1), patchsize)
+                labels_shape = [1, 1, 1]
+                labels_shape[axis] = len(labels)
+                ret["param-rois"][param] = np.broadcast_to(labels.reshape(labels_shape), clean_data.shape[:3]).astype(np.int32)
+    return ret
+
+def get_bounding_box(mask):
+    """
+    :return: Tuple of slices describing the smallest sub-array containing all unmasked voxels
+    """
+    slices = []
+    for dim in range(3):
+        axes = tuple([i for i in range(3) if i != dim])
+        nonzero = np.any(mask, axis=axes)
+        bb_start, bb_end = np.where(nonzero)[0][[0, -1]]
+        slices.append(slice(bb_start, bb_end+1))
+    return tuple(slices)
+
+def get_voxel_time(key):
+    """
+    :param key: Identifies the type of fit, e.g. tuple of model and method
+    :return: Estimated fitting time per voxel in seconds from previous runs, or None if not known
+    """
+    return _VOXEL_TIMES.get(key, None)
+
+def update_voxel_time(key, runs):
+    """
+    Update the estimated fitting time per voxel from the stats of completed runs
+
+    The estimate is an exponential moving average so it tracks changes in the data
+    and options between runs while smoothing out variation
+    """
+    stats = [run.stats for run in runs if getattr(run, "stats", None) and run.stats["voxels"] > 0]
+    voxels = sum([stat["voxels"] for stat in stats])
+    if voxels > 0:
+        voxel_time = sum([stat["fit-time"] for stat in stats]) / voxels
+        previous = _VOXEL_TIMES.get(key, None)
+        if previous is not None:
+            voxel_time = VOXEL_TIME_WEIGHT * voxel_time + (1 - VOXEL_TIME_WEIGHT) * previous
+        _VOXEL_TIMES[key] = voxel_time
+
+def get_columns(mask):
+    """
+    Get the columns of voxels (i.e. voxels with the same x and y coordinate) which
+    contain unmasked voxels. Columns are the unit of work for non-spatial fitting
+
+    :return: Tuple of 1D array of column indices in the flattened x-y plane, 1D array
+             of the number of unmasked voxels in each column
+    """
+    counts = np.count_nonzero(mask.reshape((mask.shape[0] * mask.shape[1], -1)), axis=1)
+    columns = np.flatnonzero(counts)
+    return columns, counts[columns]
+
+def screen_voxels(data, mask):
+    """
+    Find unmasked voxels which cannot be usefully fitted
+
+    Voxels are excluded if their signal contains NaN or infinite values, is all zero
+    or (for timeseries data) is constant
+
+    :param data: 3D or 4D Numpy array
+    :param mask: 3D Numpy array of unmasked voxels
+    :return: Integer Numpy array with the same shape as ``mask`` containing the reason
+             for excluding each voxel (see ``SCREEN_REASONS``) and zero elsewhere
+    """
+    unmasked = mask > 0
+    signal = data[unmasked].reshape((np.count_nonzero(unmasked), -1))
+    reasons = np.zeros(len(signal), dtype=np.int32)
+    finite = np.all(np.isfinite(signal), axis=1)
+    zero = finite & ~np.any(signal, axis=1)
+    reasons[~finite] = 1
+    reasons[zero] = 2
+    if signal.shape[1] > 1:
+        reasons[finite & ~zero & np.all(signal == signal[:, :1], axis=1)] = 3
+    screened = np.zeros(mask.shape, dtype=np.int32)
+    screened[unmasked] = reasons
+    return screened
+
+def get_screening_summary(screened):
+    """
+    :param screened: Screening output as returned by ``screen_voxels``
+    :return: Description of the number of voxels excluded for each reason
+    """
+    counts = ["%i with %s" % (np.count_nonzero(screened == reason), desc)
+              for reason, desc in sorted(SCREEN_REASONS.items()) if np.any(screened == reason)]
+    return "Excluded %i voxels from fitting: %s\n" % (np.count_nonzero(screened), ", ".join(counts))
+
+def dedupe_voxels(data, mask, add_data=()):
+    """
+    Find unmasked voxels with identical data, so each distinct voxel need only be fitted once
+
+    Voxels are identical if their signal and additional data (e.g. image priors)
+    are identical byte for byte
+
+    :param data: 3D or 4D Numpy array
+    :param mask: 3D Numpy array of unmasked voxels
+    :param add_data: Sequence of additional voxel data arrays with the same spatial shape
+    :return: Tuple of index of the first unmasked voxel with each distinct set of data,
+             index of the distinct voxel for each unmasked voxel
+    """
+    unmasked = mask > 0
+    n_voxels = np.count_nonzero(unmasked)
+    voxel_bytes = [np.ascontiguousarray(arr[unmasked]).reshape((n_voxels, -1)).view(np.uint8)
+                   for arr in [data] + list(add_data)]
+    voxel_bytes = np.ascontiguousarray(np.concatenate(voxel_bytes, axis=1))
+    keys = voxel_bytes.view(np.dtype((np.void, voxel_bytes.shape[1]))).ravel()
+    _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    return first, inverse.ravel()
+
+def pack_voxels(arr, mask, first):
+    """
+    :return: Data for the distinct voxels selected by ``dedupe_voxels``, with shape
+             (number of distinct voxels, 1, 1, ...) so it can be fitted like a volume
+    """
+    voxel_data = arr[mask > 0][first]
+    return voxel_data.reshape((len(first), 1, 1) + voxel_data.shape[1:])
+
+def unpack_voxels(packed, mask, inverse):
+    """
+    Copy the output for each distinct voxel to all the voxels with the same data
+
+    :param packed: Output for the distinct voxels, with shape as returned by ``pack_voxels``
+    :return: Numpy array with the same spatial shape as ``mask``
+    """
+    packed = packed.reshape((packed.shape[0],) + packed.shape[3:])
+    unpacked = np.zeros(mask.shape + packed.shape[1:], dtype=packed.dtype)
+    unpacked[mask > 0] = packed[inverse]
+    return unpacked
+
+def get_regions(mask):
+    """
+    Find the labelled regions in a multi-label mask
+
+    :param mask: 3D Numpy array of region labels, zero outside the regions
+    :return: Tuple of sorted region labels, index of the first unmasked voxel in each region,
+             index of the region for each unmasked voxel
+    """
+    labels, first, inverse = np.unique(mask[mask > 0], return_index=True, return_inverse=True)
+    return labels, first, inverse.ravel()
+
+def average_regions(arr, mask, inverse, n_regions):
+    """
+    Average voxel data within each region
+
+    :param arr: 3D or 4D Numpy array with the same spatial shape as ``mask``
+    :param inverse: Index of the region for each unmasked voxel, as returned by ``get_regions``
+    :return: Mean data in each region, with shape (number of regions, 1, 1, ...) so it can be
+             fitted like a volume
+    """
+    voxel_data = arr[mask > 0]
+    extra_shape = voxel_data.shape[1:]
+    voxel_data = voxel_data.reshape((voxel_data.shape[0], -1))
+    n_values = voxel_data.shape[1]
+    # Sum every value of every region in a single pass by giving each (region, value) pair its own bin
+    bins = (inverse[:, np.newaxis] * n_values + np.arange(n_values)).ravel()
+    sums = np.bincount(bins, weights=voxel_data.ravel(), minlength=n_regions * n_values)
+    counts = np.bincount(inverse, minlength=n_regions)
+    means = sums.reshape((n_regions, n_values)) / counts[:, np.newaxis]
+    return means.reshape((n_regions, 1, 1) + extra_shape)
+
+def get_pilot_mask(data, mask, n_voxels=PILOT_VOXELS, n_strata=PILOT_STRATA, seed=0):
+    """
+    Select a random sample of unmasked voxels for a pilot run
+
+    Voxels are divided into strata by quantiles of their mean signal and
+    each stratum is sampled in proportion to its size, so the sample covers
+    the range of signal in the data
+
+    :param data: 3D or 4D Numpy array
+    :param mask: 3D Numpy array of unmasked voxels
+    :param n_voxels: Number of voxels to sample
+    :return: Mask with the same shape as ``mask`` containing only the sampled voxels
+    """
+    voxels = np.flatnonzero(mask)
+    if len(voxels) <= n_voxels:
+        return (mask > 0).astype(np.int32)
+
+    signal = np.nan_to_num(data.reshape((mask.size, -1))[voxels].mean(axis=1))
+    edges = np.percentile(signal, np.linspace(0, 100, n_strata + 1)[1:-1])
+    strata = np.digitize(signal, edges)
+    random_state = np.random.RandomState(seed)
+    sample = []
+    for stratum in range(n_strata):
+        stratum_voxels = voxels[strata == stratum]
+        n_sample = min(len(stratum_voxels), int(round(float(n_voxels) * len(stratum_voxels) / len(voxels))))
+        sample.append(random_state.choice(stratum_voxels, n_sample, replace=False))
+
+    pilot_mask = np.zeros(mask.shape, dtype=np.int32)
+    pilot_mask.flat[np.concatenate(sample)] = 1
+    return pilot_mask
+
+def schedule_chunks(voxel_counts, n_workers, voxel_time=None):
+    """
+    Divide columns of voxels into chunks which are handed to idle workers in turn
+
+    Chunk sizes decrease through the run (guided scheduling) - each chunk takes
+    a fixed fraction of the remaining work, so early chunks are large to keep
+    overheads low while the final chunks are small and the run does not wait
+    for one slow chunk at the end. The minimum chunk size is chosen from the
+    estimated time per voxel so each chunk takes at least ``MIN_CHUNK_TIME``
+
+    :param voxel_counts: Number of unmasked voxels in each column
+    :param n_workers: Number of parallel workers
+    :param voxel_time: Estimated fitting time per voxel in seconds, if known
+    :return: List of (start, end) column index ranges, one for each chunk
+    """
+    ncolumns = len(voxel_counts)
+    if n_workers <= 1 or ncolumns <= 1:
+        return [(0, ncolumns)]
+
+    if voxel_time:
+        min_voxels = max(1, int(MIN_CHUNK_TIME / voxel_time))
+    else:
+        min_voxels = MIN_CHUNK_VOXELS
+    cumulative = np.cumsum(voxel_counts)
+    total = cumulative[-1]
+    bounds, start = [], 0
+    while start < ncolumns:
+        done = cumulative[start-1] if start > 0 else 0
+        size = max(min_voxels, int(np.ceil(float(total - done) / (2 * n_workers))))
+        end = min(ncolumns, int(np.searchsorted(cumulative, done + size)) + 1)
+        bounds.append((start, end))
+        start = end
+    return bounds
+
+def split_columns(args, columns, bounds):
+    """
+    Split worker arguments into chunks of voxel columns
+
+    Numpy arrays are reshaped so each column of voxels is one row of the chunk, i.e.
+    a chunk of N columns from data with shape (X, Y, Z, ...) has shape (N, 1, Z, ...).
+    Other arguments are passed to every worker unchanged
+
+    :param columns: Column indices as returned by ``get_columns``
+    :param bounds: Chunk ranges as returned by ``schedule_chunks``
+    :return: List of argument lists, one for each chunk
+    """
+    split = []
+    for arg in args:
+        if isinstance(arg, (np.ndarray, np.generic)):
+            arg_columns = arg.reshape((arg.shape[0] * arg.shape[1], 1) + arg.shape[2:])[columns]
+            split.append([arg_columns[start:end] for start, end in bounds])
+        else:
+            split.append([arg,] * len(bounds))
+    return list(map(list, zip(*split)))
+
+def get_data_position(pos, chunk_start, columns, shape, bb_slices):
+    """
+    Convert a voxel position within a data chunk to its position in the full data
+
+    :param pos: Position tuple within the chunk
+    :param chunk_start: Index of the first column in the chunk, as returned by ``schedule_chunks``
+    :param columns: Column indices as returned by ``get_columns``, or None if the chunk is
+                    the whole bounding box
+    :param shape: 3D shape of the bounding box
+    :param bb_slices: Bounding box slices within the full data
+    :return: Position tuple in the full data
+    """
+    if columns is not None:
+        column = columns[chunk_start + pos[0]]
+        pos = (column // shape[1], column % shape[1], pos[2])
+    return tuple([int(p + bb_slice.start) for p, bb_slice in zip(pos, bb_slices)])
+
+def dedupe_args(input_args):
+    """
+    Replace the data in worker arguments with the data for distinct voxels only
+
+    :param input_args: Worker arguments - options, main data, mask then additional
+                       data as name followed by array
+    :return: Tuple of new worker arguments, tuple of distinct voxel indices as returned
+             by ``dedupe_voxels``. If there are no identical voxels the arguments are
+             returned unchanged with None
+    """
+    options, data, mask = input_args[:3]
+    first, inverse = dedupe_voxels(data, mask, input_args[4::2])
+    if len(first) == np.count_nonzero(mask):
+        return input_args, None
+
+    LOG.debug("Fitting %i distinct voxels out of %i", len(first), np.count_nonzero(mask))
+    packed_args = [options, pack_voxels(data, mask, first), np.ones((len(first), 1, 1), dtype=np.int32)]
+    for key, value in zip(input_args[3::2], input_args[4::2]):
+        packed_args += [key, pack_voxels(value, mask, first)]
+    return packed_args, (first, inverse)
+
+def region_args(input_args):
+    """
+    Replace the data in worker arguments with the mean data in each labelled region of the mask
+
+    :param input_args: Worker arguments - options, main data, mask then additional
+                       data as name followed by array
+    :return: Tuple of new worker arguments, tuple of first voxel and region indices in the
+             same form as ``dedupe_args``, region labels
+    """
+    options, data, mask = input_args[:3]
+    labels, first, inverse = get_regions(mask)
+    LOG.debug("Fitting mean data in %i regions", len(labels))
+    packed_args = [options, average_regions(data, mask, inverse, len(labels)), np.ones((len(labels), 1, 1), dtype=np.int32)]
+    for key, value in zip(input_args[3::2], input_args[4::2]):
+        packed_args += [key, average_regions(value, mask, inverse, len(labels))]
+    return packed_args, (first, inverse), labels
+
+def get_distinct_position(pos, chunk_start, columns, mask, first):
+    """
+    Convert a voxel position within a chunk of distinct voxels to the position within the
+    bounding box of the first voxel with the same data
+
+    :param mask: Mask within the bounding box
+    :param first: Index of the first unmasked voxel for each distinct voxel
+    """
+    distinct_idx = columns[chunk_start + pos[0]] if columns is not None else pos[0]
+    return tuple([int(idx[first[distinct_idx]]) for idx in np.nonzero(mask)])
+
+def summarise_warnings(worker_output, position_fn):
+    """
+    Aggregate the warnings from all chunks
+
+    :param worker_output: Sequence of lists of runs, one for each chunk
+    :param position_fn: Callable taking the chunk index and a position within the chunk
+                        and returning the position in the full data
+    :return: ``LogSummary``
+    """
+    summary = LogSummary()
+    for chunk_idx, runs in enumerate(worker_output):
+        for run in runs:
+            run_summary = getattr(run, "log_summary", None)
+            if run_summary is not None:
+                run_summary.map_voxels(lambda pos: position_fn(chunk_idx, pos))
+                summary.merge(run_summary)
+    return summary
+
+def restore_columns(recombined_data, columns, shape):
+    """
+    Put recombined voxel columns back into their original positions
+
+    :param recombined_data: Recombined chunk output with one row for each column
+    :param columns: Column indices as returned by ``get_columns``
+    :param shape: 3D shape of the data the columns were taken from
+    :return: Numpy array with 3D shape ``shape`` which is zero outside the columns
+    """
+    extra_shape = recombined_data.shape[3:]
+    full_data = np.zeros((shape[0] * shape[1], 1, shape[2]) + extra_shape, dtype=recombined_data.dtype)
+    full_data[columns] = recombined_data
+    return full_data.reshape(tuple(shape) + extra_shape)
+
+def split_args(n_workers, args):
+    """
+    Split worker arguments into chunks. Numpy arrays are split along the first axis
+    and other arguments are passed to every worker unchanged
+
+    :return: List of argument lists, one for each worker
+    """
+    split = []
+    for arg in args:
+        if isinstance(arg, (np.ndarray, np.generic)):
+            split.append(np.array_split(arg, n_workers, 0))
+        else:
+            split.append([arg,] * n_workers)
+    return list(map(list, zip(*split)))
+
+def recombine_data(data_list, chunk_shapes=None):
+    """
+    Recombine a sequence of data chunks split by ``split_args``. Chunks for which
+    there is no data (e.g. because the chunk had no unmasked voxels) are
+    given as None and treated as zero
+
+    :param chunk_shapes: Optional sequence of the 3D shape of each chunk. If not
+                         given all chunks are assumed to be the same shape
+    """
+    shape = None
+    for data_item in data_list:
+        if data_item is not None:
+            shape = data_item.shape
+    if shape is None:
+        raise RuntimeError("No data to re-combine")
+
+    if chunk_shapes is not None:
+        # Fabber may drop trailing singleton dimensions so restore the chunk shape
+        extra_shape = tuple(shape[len(chunk_shapes[0]):])
+        for data_item, chunk_shape in zip(data_list, chunk_shapes):
+            if data_item is not None and data_item.size > 0:
+                extra_shape = (data_item.size // int(np.prod(chunk_shape)),)
+                if extra_shape == (1,):
+                    extra_shape = ()
+                break
+
+    chunks = []
+    for idx, data_item in enumerate(data_list):
+        if chunk_shapes is not None:
+            chunk_shape = tuple(chunk_shapes[idx]) + extra_shape
+            if data_item is None:
+                data_item = np.zeros(chunk_shape)
+            else:
+                data_item = data_item.reshape(chunk_shape)
+        elif data_item is None:
+            data_item = np.zeros(shape)
+        chunks.append(data_item)
+    return np.concatenate(chunks, 0)
+
+def expand_data(recombined_data, shape, bb_slices):
+    """
+    The processed data was chopped out of the full data set to just include the
+    ROI - so now we need to put it back into a full size data set which is otherwise
+    zero.
+
+    :param shape: 3D shape of the full data set
+    :return: Full size Numpy array
+    """
+    if recombined_data.ndim == 2:
+        recombined_data = np.expand_dims(recombined_data, 2)
+
+    if recombined_data.ndim == 4:
+        full_data = np.zeros(list(shape) + [recombined_data.shape[3],], dtype=np.float32)
+    else:
+        full_data = np.zeros(shape, dtype=np.float32)
+    bb_slices = tuple(bb_slices)
+    full_data[bb_slices] = recombined_data.reshape(full_data[bb_slices].shape)
+    return full_data
+
+def _run_workers(worker_fn, worker_args, progress_cb=None, n_workers=None, task_sizes=None, pool=None, **pool_kwargs):
+    """
+    Run a worker function on each set of arguments in a pool of processes
+
+    :param worker_args: Sequence of argument lists, one for each task. The task ID and
+                        progress queue are added to the start of each list
+    :param progress_cb: Optional callable which will be passed the fraction of work completed
+    :param n_workers: Maximum number of worker processes. Tasks are handed to
+                      workers as they become idle
+    :param task_sizes: Optional relative size of each task, used to weight the progress
+    :param pool: Optional pool to use instead of local worker processes, e.g. ``remote.RemotePool``
+    :param pool_kwargs: CPU budget keyword arguments passed to ``make_pool``
+    :return: List of worker outputs. If any worker fails its exception is raised
+    """
+    n_tasks = len(worker_args)
+    manager = multiprocessing.Manager()
+    queue = manager.Queue()
+    if pool is None:
+        pool = make_pool(n_tasks, n_workers, **pool_kwargs)
+    try:
+        results = [pool.apply_async(worker_fn, [idx, queue] + list(args)) for idx, args in enumerate(worker_args)]
+        if not task_sizes:
+            task_sizes = [1, ] * n_tasks
+        done = [0, ] * n_tasks
+        while not all([result.ready() for result in results]):
+            time.sleep(0.1)
+            while not queue.empty():
+                worker_id, worker_done, worker_todo = queue.get()
+                done[worker_id] = task_sizes[worker_id] * float(worker_done) / worker_todo
+            if progress_cb is not None:
+                progress_cb(sum(done) / sum(task_sizes))
+
+        outputs = []
+        for result in results:
+            _, success, output = result.get()
+            if not success:
+                raise output
+            outputs.append(output)
+        if progress_cb is not None:
+            progress_cb(1)
+        return outputs
+    finally:
+        pool.terminate()
+        pool.join()
+        manager.shutdown()
+
+def run(data, mask=None, options=None, add_data=None, search_dirs=(), n_workers=None, progress_cb=None, log=None,
+        cpu_budget=None, threads_per_worker=1, pin_workers=False):
+    """
+    Run Fabber on Numpy arrays
+
+    The data is partitioned between parallel workers and recombined in the same
+    way as by ``FabberProcess``
+
+    :param data: 3D or 4D Numpy array of main input data
+    :param mask: Optional 3D mask array. If not given all voxels are fitted
+    :param options: Fabber options. Voxel data options, e.g. image priors, must be given
+                    in ``add_data`` rather than as names
+    :param add_data: Optional mapping from Fabber option name to 3D or 4D Numpy array
+    :param search_dirs: Additional directories to search for Fabber libraries
+    :param n_workers: Maximum number of parallel workers, default is the number of CPUs
+    :param progress_cb: Optional callable which will be passed the fraction of voxels completed
+    :param log: Optional stream to which the Fabber log will be written
+    :param cpu_budget: Maximum number of CPUs to use, default is all available CPUs
+    :param threads_per_worker: Number of threads each worker may use
+    :param pin_workers: If True, pin each worker to its own CPUs
+    :return: Mapping from output name (e.g. ``mean_c0``) to full size Numpy array
+
+    If the ``backend`` option is ``remote``, chunks are fitted on the worker nodes given
+    by the ``remote-hosts`` option and ``n_workers`` and the CPU options do not apply -
+    see ``quantiphyse_fabber.remote``
+    """
+    n_workers = get_pool_size(None, n_workers, cpu_budget, threads_per_worker)
+    plan = _RunPlan(data, mask, options, add_data, search_dirs, n_workers)
+    if plan.remote is not None:
+        from .remote import RemotePool
+        pool = RemotePool(**plan.remote)
+        worker_output = _run_workers(pool.run_chunk, plan.worker_args, progress_cb, task_sizes=plan.chunk_voxels, pool=pool)
+    else:
+        worker_output = _run_workers(_run_fabber, plan.worker_args, progress_cb, n_workers, plan.chunk_voxels,
+                                     cpu_budget=cpu_budget, threads_per_worker=threads_per_worker, pin_workers=pin_workers)
+    runs = [out[0] for out in worker_output]
+    update_voxel_time(plan.timing_key, runs)
+    if log is not None:
+        plan.write_log(worker_output, log)
+    return plan.get_outputs(runs)
+
+class _RunPlan(object):
+    """
+    Division of the data for a headless run into chunks for the workers,
+    and recombination of their outputs
+    """
+
+    def __init__(self, data, mask=None, options=None, add_data=None, search_dirs=(), n_workers=1):
+        from .remote import get_backend
+        options = dict(options or {})
+        # Remote chunks are scheduled for the remote hosts rather than the local workers
+        self.remote = get_backend(options)
+        if self.remote is not None:
+            n_workers = len(self.remote["hosts"])
+        options["method"] = options.get("method", "vb")
+        options["noise"] = options.get("noise", "white")
+        options["fabber-dirs"] = list(search_dirs) + [FABBER_DIR,]
+        if mask is None:
+            mask = np.ones(data.shape[:3], dtype=np.int32)
+
+        self.shape = mask.shape
+        self.bb_slices = get_bounding_box(mask)
+        self.mask_bb = mask[self.bb_slices]
+        data_bb = data[self.bb_slices]
+        self.screened = None
+        if options.pop("screen-voxels", True):
+            screened = screen_voxels(data_bb, self.mask_bb)
+            if np.any(screened):
+                self.screened = screened
+                self.mask_bb = np.where(screened > 0, 0, self.mask_bb)
+                if not np.any(self.mask_bb):
+                    raise ValueError("No voxels left to fit after screening - " + get_screening_summary(screened))
+        input_args = [options, data_bb, self.mask_bb]
+        for key, value in (add_data or {}).items():
+            input_args.append(key)
+            input_args.append(np.asarray(value)[self.bb_slices])
+
+        self.distinct, self.regions = None, None
+        region_mode, dedupe = options.pop("region-mode", False), options.pop("dedupe-voxels", False)
+        if region_mode:
+            if options["method"] == "spatialvb":
+                raise ValueError("Region mode cannot be used with spatial VB")
+            input_args, self.distinct, self.regions = region_args(input_args)
+        elif dedupe and options["method"] != "spatialvb":
+            input_args, self.distinct = dedupe_args(input_args)
+
+        self.timing_key = (options.get("model", None), options["method"])
+        if options["method"] == "spatialvb":
+            # Spatial VB needs neighbouring voxels so fits the whole bounding box at once
+            self.columns, self.bounds = None, [(0, 0)]
+            self.worker_args = split_args(1, input_args)
+        else:
+            self.columns, voxel_counts = get_columns(input_args[2])
+            self.bounds = schedule_chunks(voxel_counts, n_workers, get_voxel_time(self.timing_key))
+            self.worker_args = split_columns(input_args, self.columns, self.bounds)
+        self.fit_shape = input_args[2].shape
+        self.chunk_shapes = [args[2].shape for args in self.worker_args]
+        self.chunk_voxels = [max(1, np.count_nonzero(args[2])) for args in self.worker_args]
+
+    def get_position(self, chunk_idx, pos):
+        """
+        :return: Position in the full data of a voxel position within a chunk
+        """
+        if self.distinct is not None:
+            pos = get_distinct_position(pos, self.bounds[chunk_idx][0], self.columns, self.mask_bb, self.distinct[0])
+            return tuple([int(p + bb_slice.start) for p, bb_slice in zip(pos, self.bb_slices)])
+        return get_data_position(pos, self.bounds[chunk_idx][0], self.columns, self.mask_bb.shape, self.bb_slices)
+
+    def write_log(self, worker_output, log):
+        """
+        Write the log of the first chunk and a summary of warnings from all chunks to a stream
+        """
+        for runs in worker_output:
+            if runs[0].log:
+                log.write(runs[0].log)
+                break
+        if self.screened is not None:
+            log.write("\n" + get_screening_summary(self.screened))
+        summary = summarise_warnings(worker_output, self.get_position)
+        if summary.warnings:
+            log.write("\nWarning summary for all chunks:\n\n" + summary.format_warnings())
+
+    def get_outputs(self, runs):
+        """
+        :param runs: ``FabberRun`` for each chunk, or None for chunks which have not been fitted
+        :return: Mapping from output name to full size Numpy array. Voxels in chunks which
+                 have not been fitted are zero
+        """
+        data_keys = []
+        for run in runs:
+            if run is not None:
+                data_keys += [key for key in run.data if key not in data_keys]
+        outputs = {}
+        for key in data_keys:
+            recombined = recombine_data([run.data.get(key, None) if run is not None else None for run in runs],
+                                        self.chunk_shapes)
+            if self.columns is not None:
+                recombined = restore_columns(recombined, self.columns, self.fit_shape)
+            if self.distinct is not None:
+                recombined = unpack_voxels(recombined, self.mask_bb, self.distinct[1])
+            outputs[key] = expand_data(recombined, self.shape, self.bb_slices)
+        if self.screened is not None:
+            outputs[SCREENED_OUTPUT] = expand_data(self.screened, self.shape, self.bb_slices)
+        return outputs
+
+def generate_test_data(options, param_test_values, nt=10, num_voxels=1000, noise=0, num_repeats=1,
+                       seed=None, param_rois=False, search_dirs=(), n_workers=None, progress_cb=None):
+    """
+    Generate test data by evaluating a Fabber model on specified parameter values
+    with optional noise
+
+    The model is evaluated once for each combination of parameter values in parallel
+    workers, as for ``FabberTestDataProcess``
+
+    :return: Dictionary as returned by ``make_test_data``
+    """
+    options = dict(options)
+    options["fabber-dirs"] = list(search_dirs) + [FABBER_DIR,]
+    patchsize = int(np.floor(num_voxels ** (1. / 3) + 0.5))
+    param_names, param_values, dim_params, dim_sizes = get_param_grid(param_test_values)
+    if n_workers is None:
+        n_workers = multiprocessing.cpu_count()
+    n_workers = max(1, min(n_workers, len(param_values)))
+    worker_args = split_args(n_workers, [options, param_names, param_values, nt])
+    curves = np.concatenate(_run_workers(_evaluate_model, worker_args, progress_cb), 0)
+    return make_test_data(curves, dim_params, dim_sizes, patchsize, noise, num_repeats, seed, param_rois)
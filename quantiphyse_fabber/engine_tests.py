@@ -0,0 +1,533 @@
+"""
+Tests of the Fabber engine which do not require Qt or the Quantiphyse GUI
+
+Copyright (c) 2016-2017 University of Oxford, Martin Craig
+"""
+import os
+import sys
+import unittest
+import subprocess
+
+import numpy as np
+
+#: Modules which must not be imported when the plugin is registered
+HEAVY_MODULES = ["numpy", "fabber", "PySide2", "quantiphyse"]
+
+class _PercentApi(object):
+    """
+    Stand-in Fabber API which reports progress in percent, as the command line
+    API does, and fails if any unmasked voxel contains NaN
+    """
+    def run(self, options, progress_cb=None):
+        from fabber import FabberException, FabberRun
+        mask = options["mask"]
+        if np.any(np.isnan(options["data"][mask > 0])):
+            raise FabberException("Numerical problems")
+        for percent in range(0, 101, 10):
+            progress_cb(percent, 100)
+        return FabberRun({"mean" : np.nan_to_num(options["data"][..., 0]) * (mask > 0)}, "")
+
+def _worker_limits(_):
+    """
+    :return: PID, thread limit and CPU affinity of a pool worker
+    """
+    affinity = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else None
+    return os.getpid(), os.environ.get("OMP_NUM_THREADS", None), affinity
+
+class FabberImportTest(unittest.TestCase):
+
+    def _import_plugin(self):
+        """
+        Import the plugin package in a fresh interpreter
+
+        :return: List of names of modules loaded
+        """
+        code = "; ".join([
+            "import sys",
+            "import quantiphyse_fabber",
+            "manifest = quantiphyse_fabber.QP_MANIFEST",
+            "print(' '.join(sys.modules))",
+        ])
+        env = dict(os.environ)
+        pkgdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env["PYTHONPATH"] = os.pathsep.join([pkgdir, env.get("PYTHONPATH", "")])
+        output = subprocess.check_output([sys.executable, "-c", code], env=env).decode("utf-8").splitlines()
+        return output[0].split() if output else []
+
+    def test_import_lazy(self):
+        """ Registering the plugin does not import the widgets, tests or processes """
+        modules = self._import_plugin()
+        self.assertEqual([module for module in modules if module.startswith("quantiphyse_fabber.")], [])
+
+    def test_import_light(self):
+        """ Registering the plugin does not import heavy dependencies """
+        modules = self._import_plugin()
+        for heavy_module in HEAVY_MODULES:
+            self.assertFalse(heavy_module in modules, "%s imported on registration" % heavy_module)
+
+    def test_manifest_names(self):
+        """ Process names are available from the manifest without importing the processes """
+        from . import QP_MANIFEST
+        processes = QP_MANIFEST["processes"]
+        self.assertEqual([p.PROCESS_NAME for p in processes], ["Fabber", "FabberSimStudy"])
+
+class FabberEngineTest(unittest.TestCase):
+
+    def setUp(self):
+        random_state = np.random.RandomState(0)
+        tpts = np.arange(10)
+        self.data = 3 + 2*tpts + random_state.normal(0, 0.5, size=(5, 5, 5, 10))
+        self.mask = np.zeros((5, 5, 5), dtype=np.int32)
+        self.mask[1:4, 1:4, 1:4] = 1
+        self.options = {"model" : "poly", "degree" : 2, "save-mean" : True}
+
+    def test_remote_backend(self):
+        """ Fitting on local stand-in worker servers gives the same output as local workers """
+        from . import engine
+        from .remote import LocalWorkers
+        local_output = engine.run(self.data, self.mask, self.options)
+        with LocalWorkers(2, authkey="test") as workers:
+            # First host is not running so chunks sent to it must be retried
+            options = dict(self.options, backend="remote", **{
+                "remote-hosts" : ["localhost:1"] + workers.hosts,
+                "remote-authkey" : "test",
+            })
+            remote_output = engine.run(self.data, self.mask, options)
+        self.assertEqual(sorted(local_output.keys()), sorted(remote_output.keys()))
+        for key in local_output:
+            self.assertTrue(np.allclose(local_output[key], remote_output[key]))
+
+    def test_remote_plan(self):
+        """ Remote chunks are scheduled for the number of remote hosts, not the local workers """
+        from unittest import mock
+        from . import engine
+        data = np.random.RandomState(0).normal(size=(20, 20, 4, 10))
+        options = dict(self.options, backend="remote", **{
+            "remote-hosts" : ["node1:5000", "node2:5000", "node3:5000"],
+            "remote-authkey" : "test",
+        })
+        # Chunk sizes depend on voxel times recorded by earlier runs, so start without any
+        with mock.patch.dict(engine._VOXEL_TIMES, clear=True):
+            plan = engine._RunPlan(data, None, options, n_workers=1)
+        self.assertEqual(plan.remote["hosts"], [("node1", 5000), ("node2", 5000), ("node3", 5000)])
+        self.assertTrue(len(plan.worker_args) > 1)
+        self.assertFalse("backend" in plan.worker_args[0][0])
+
+    def test_remote_host_availability(self):
+        """ Chunks are sent to whichever remote host is free, and failed hosts are not used again """
+        from .remote import RemotePool
+        hosts = [("node1", 5000), ("node2", 5000)]
+        pool = RemotePool(hosts, b"test")
+        try:
+            self.assertEqual(pool._acquire([]), hosts[0])
+            self.assertEqual(pool._acquire([]), hosts[1])
+            pool._release(hosts[1])
+            self.assertEqual(pool._acquire([]), hosts[1])
+            pool._release(hosts[0], failed=True)
+            # The only host left is busy so a chunk which failed on it has nowhere to go
+            self.assertEqual(pool._acquire([hosts[1]]), None)
+        finally:
+            pool.terminate()
+
+    def test_isolation_progress(self):
+        """ Progress reported in percent is converted to voxels while isolating failed voxels """
+        from . import engine
+        data = np.array(self.data)
+        data[2, 2, 2, 0] = np.nan
+        progress = []
+        run = engine._run_isolating_failures(_PercentApi(), {"data" : data, "mask" : self.mask},
+                                             lambda done, todo: progress.append(float(done) / todo))
+        self.assertEqual(max(progress), 1)
+        self.assertEqual(progress, sorted(progress))
+        self.assertEqual(run.data[engine.FAILED_OUTPUT][2, 2, 2], 1)
+        self.assertEqual(np.count_nonzero(run.data[engine.FAILED_OUTPUT]), 1)
+        self.assertTrue(np.allclose(run.data["mean"][self.mask > 0], np.nan_to_num(data[..., 0][self.mask > 0])))
+
+    def _submit_fit(self, loop, executor, *args):
+        """
+        Submit a fit to an executor from the running event loop
+        """
+        fit = loop.create_future()
+        loop.call_soon(lambda: fit.set_result(executor.submit(*args)))
+        return loop.run_until_complete(fit)
+
+    @unittest.skipIf(sys.version_info < (3, 7), "Requires Python 3.7")
+    def test_aio_fit(self):
+        """ Awaiting a fit submitted to an executor gives the same output as engine.run """
+        import asyncio
+        from . import engine
+        from .aio import FabberExecutor
+        output = engine.run(self.data, self.mask, self.options)
+        loop = asyncio.new_event_loop()
+        executor = FabberExecutor(n_workers=2)
+        try:
+            fit = self._submit_fit(loop, executor, self.data, self.mask, self.options)
+            aio_output = loop.run_until_complete(asyncio.wait_for(fit, 60))
+        finally:
+            loop.run_until_complete(executor.close())
+            loop.close()
+        self.assertTrue(fit.done())
+        self.assertEqual(fit.progress, 1)
+        self.assertEqual(sorted(output.keys()), sorted(aio_output.keys()))
+        for key in output:
+            self.assertTrue(np.allclose(output[key], aio_output[key]))
+
+    @unittest.skipIf(sys.version_info < (3, 7), "Requires Python 3.7")
+    def test_aio_cancel(self):
+        """ Cancelling a fit signals its workers, and other fits on the same executor are unaffected """
+        import asyncio
+        from .aio import FabberExecutor
+        loop = asyncio.new_event_loop()
+        executor = FabberExecutor(n_workers=1)
+        try:
+            cancelled_fit = self._submit_fit(loop, executor, self.data, self.mask, self.options)
+            fit = self._submit_fit(loop, executor, self.data, self.mask, self.options)
+            cancelled_fit.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                loop.run_until_complete(asyncio.wait_for(cancelled_fit, 60))
+            self.assertTrue(cancelled_fit._cancel_event.is_set())
+            output = loop.run_until_complete(asyncio.wait_for(fit, 60))
+            self.assertTrue("mean_c0" in output)
+            self.assertFalse(fit._cancel_event.is_set())
+        finally:
+            loop.run_until_complete(executor.close())
+            loop.close()
+
+    def test_sweep_variants(self):
+        """ Each variant of a parameter sweep gives the same output as fitting it separately """
+        from multiprocessing.dummy import Queue
+        from . import engine
+        queue = Queue()
+        variants = [{"degree" : 1}, {"degree" : 2}]
+        _, success, runs = engine._run_fabber(0, queue, dict(self.options, variants=variants), self.data, self.mask)
+        self.assertTrue(success)
+        self.assertEqual(len(runs), len(variants))
+        for variant, run in zip(variants, runs):
+            output = engine.run(self.data, self.mask, dict(self.options, **variant))
+            self.assertTrue(np.allclose(run.data["mean_c0"], output["mean_c0"]))
+        self.assertTrue("mean_c2" in runs[1].data and "mean_c2" not in runs[0].data)
+        # Progress is reported as a fraction of the work for all variants
+        progress = []
+        while not queue.empty():
+            _, done, todo = queue.get()
+            progress.append(float(done) / todo)
+        self.assertEqual(progress, sorted(progress))
+        self.assertEqual(progress[-1], 1)
+
+    def test_generate_test_data(self):
+        """ Test data evaluated in parallel chunks matches the model, with independent noise realisations """
+        from . import engine
+        options = {"model" : "poly", "degree" : 1}
+        param_test_values = {"c0" : [1, 2, 3], "c1" : [0.5, 1]}
+        test_data = engine.generate_test_data(options, param_test_values, nt=5, num_voxels=8, noise=0.1,
+                                              num_repeats=2, seed=0, param_rois=True, n_workers=3)
+        clean = test_data["clean"]
+        self.assertEqual(clean.shape, (6, 4, 2, 5))
+        api = engine.get_api()
+        for c0_idx, c0 in enumerate(param_test_values["c0"]):
+            for c1_idx, c1 in enumerate(param_test_values["c1"]):
+                curve = api.model_evaluate(options, {"c0" : c0, "c1" : c1}, 5)
+                self.assertTrue(np.allclose(clean[c0_idx*2, c1_idx*2, 0], curve))
+        self.assertEqual(test_data["param-rois"]["c0"][4, 0, 0], 3)
+        self.assertEqual(test_data["param-rois"]["c1"][0, 2, 0], 2)
+        # Noise realisations share the clean data but not the noise
+        self.assertEqual(len(test_data["data"]), 2)
+        noise = [data - clean for data in test_data["data"]]
+        self.assertTrue(all([abs(np.std(realisation) - 0.1) < 0.05 for realisation in noise]))
+        self.assertFalse(np.allclose(noise[0], noise[1]))
+
+    def test_schedule_chunks(self):
+        """ Chunks cover every column once, get smaller through the run and are split and restored correctly """
+        from . import engine
+        random_state = np.random.RandomState(0)
+        mask = (random_state.random_sample((40, 40, 10)) < 0.7).astype(np.int32)
+        columns, counts = engine.get_columns(mask)
+        bounds = engine.schedule_chunks(counts, 4)
+        self.assertEqual(bounds[0][0], 0)
+        self.assertEqual(bounds[-1][1], len(columns))
+        self.assertTrue(all([end == start for (_, end), (start, _) in zip(bounds[:-1], bounds[1:])]))
+        sizes = [np.sum(counts[start:end]) for start, end in bounds]
+        self.assertTrue(len(bounds) > 4)
+        self.assertTrue(sizes[0] > sizes[-2])
+        self.assertTrue(min(sizes[:-1]) >= engine.MIN_CHUNK_VOXELS)
+        # Slow voxels give smaller minimum chunks
+        self.assertTrue(len(engine.schedule_chunks(counts, 4, voxel_time=engine.MIN_CHUNK_TIME)) > len(bounds))
+
+        data = random_state.normal(size=(40, 40, 10, 3))
+        chunks = engine.split_columns([data, mask], columns, bounds)
+        self.assertEqual(len(chunks), len(bounds))
+        self.assertEqual(sum([np.count_nonzero(chunk_mask) for _, chunk_mask in chunks]), np.count_nonzero(mask))
+        recombined = np.concatenate([chunk_data for chunk_data, _ in chunks], 0)
+        restored = engine.restore_columns(recombined, columns, mask.shape)
+        self.assertTrue(np.array_equal(restored[mask > 0], data[mask > 0]))
+
+    def test_log_summary(self):
+        """ Long logs are summarised in bounded form with warnings counted, and the full log is kept on disk """
+        import tempfile
+        import shutil
+        from . import logs
+        lines = ["Iteration %i" % idx for idx in range(logs.HEAD_LINES * 2)]
+        lines += ["WARNING: Numerical problems in voxel %i" % (idx + 1) for idx in range(500)]
+        log = "\n".join(lines)
+        tempdir = tempfile.mkdtemp()
+        try:
+            log_file = logs.get_log_file(tempdir, 3)
+            summary = logs.summarise_log(log, log_file)
+            with open(log_file) as logfile:
+                self.assertEqual(logfile.read(), log)
+        finally:
+            shutil.rmtree(tempdir)
+        self.assertEqual(summary.lines, len(lines))
+        self.assertEqual(len(summary.head), logs.HEAD_LINES)
+        self.assertEqual(len(summary.warnings), 1)
+        warning = summary.sorted_warnings()[0]
+        self.assertEqual(warning["count"], 500)
+        self.assertEqual(len(warning["examples"]), logs.MAX_EXAMPLES)
+        text = summary.format()
+        self.assertTrue(len(text) < len(log) / 2)
+        self.assertTrue("500 x WARNING: Numerical problems in voxel 1" in text)
+        self.assertTrue(os.path.abspath(log_file) in text)
+
+    def test_warning_summary(self):
+        """ Warnings from all chunks are aggregated by type with voxel counts and positions in the full data """
+        from . import engine, logs
+
+        class _Run(object):
+            """ Chunk output with a log summary, as returned by the workers """
+            def __init__(self, log, mask):
+                self.log_summary = logs.summarise_log(log)
+                self.warning_mask = self.log_summary.locate_voxels(mask, True)
+
+        mask = np.ones((4, 2, 2), dtype=np.int32)
+        # Fabber numbers voxels from 1 in Fortran order within each chunk
+        worker_output = [
+            [_Run("WARNING: Numerical problems in voxel 1\nWARNING: Numerical problems in voxel 3\n", mask[:2])],
+            [_Run("WARNING: Numerical problems in voxel 2\nWARNING: Failed to converge in voxel 1\n", mask[2:])],
+        ]
+        self.assertEqual(worker_output[0][0].warning_mask[0, 1, 0], 1)
+        self.assertEqual(np.count_nonzero(worker_output[0][0].warning_mask), 2)
+        summary = engine.summarise_warnings(worker_output, lambda chunk_idx, pos: (pos[0] + 2*chunk_idx,) + tuple(pos[1:]))
+        numerical, converge = summary.sorted_warnings()
+        self.assertEqual((numerical["count"], numerical["voxels"]), (3, 3))
+        self.assertEqual(numerical["example-voxels"], [(0, 0, 0), (0, 1, 0), (3, 0, 0)])
+        self.assertEqual((converge["count"], converge["voxels"]), (1, 1))
+        self.assertEqual(converge["example-voxels"], [(2, 0, 0)])
+        self.assertTrue("(3,0,0)" in summary.format_warnings())
+
+    def test_runtime_map(self):
+        """ Runtime map gives the fitting time for each voxel, and is zero outside the mask """
+        import time
+        from unittest import mock
+        from multiprocessing.dummy import Queue
+        from . import engine
+
+        class _SlowApi(object):
+            """ Takes longer to fit voxels with a high signal, fitting voxels in Fortran order as Fabber does """
+            def run(self, options, progress_cb=None):
+                from fabber import FabberRun
+                voxels = np.flatnonzero(options["mask"].ravel(order="F"))
+                signal = options["data"][..., 0].ravel(order="F")
+                for idx, voxel in enumerate(voxels):
+                    if signal[voxel] > 50:
+                        time.sleep(0.02)
+                    progress_cb(idx + 1, len(voxels))
+                return FabberRun({}, "")
+
+        data = np.array(self.data)
+        data[2, ..., 0] = 100
+        with mock.patch.object(engine, "get_api", lambda *args: _SlowApi()):
+            options = dict(self.options, **{"save-runtime-map" : True})
+            _, success, runs = engine._run_fabber(0, Queue(), options, data, self.mask)
+        self.assertTrue(success)
+        runtime = runs[0].data[engine.RUNTIME_OUTPUT]
+        self.assertEqual(runtime.shape, self.mask.shape)
+        self.assertTrue(np.all(runtime[self.mask == 0] == 0))
+        slow = np.logical_and(self.mask > 0, data[..., 0] > 50)
+        self.assertEqual(np.count_nonzero(slow), 9)
+        self.assertTrue(np.all(runtime[slow] >= 0.015))
+        self.assertTrue(np.all(runtime[np.logical_and(self.mask > 0, ~slow)] < 0.015))
+        self.assertAlmostEqual(float(np.sum(runtime)), runs[0].stats["fit-time"], delta=0.01)
+
+    def test_cancel(self):
+        """ Cancelling stops a running fit at the next progress update, and chunks not yet started are skipped """
+        import threading
+        from unittest import mock
+        from multiprocessing.dummy import Queue
+        from . import engine
+
+        class _CancelApi(object):
+            """ Cancels the run part way through the fit """
+            def __init__(self, cancel_event):
+                self.cancel_event = cancel_event
+                self.voxels = 0
+
+            def run(self, options, progress_cb=None):
+                nvoxels = np.count_nonzero(options["mask"])
+                for voxel in range(nvoxels):
+                    if voxel == nvoxels // 3:
+                        self.cancel_event.set()
+                    progress_cb(voxel, nvoxels)
+                    self.voxels += 1
+                raise AssertionError("Fit was not cancelled")
+
+        cancel_event = threading.Event()
+        api = _CancelApi(cancel_event)
+        with mock.patch.object(engine, "get_api", lambda *args: api):
+            options = dict(self.options, **{"cancel-event" : cancel_event})
+            _, success, output = engine._run_fabber(0, Queue(), options, self.data, self.mask)
+            self.assertFalse(success)
+            self.assertTrue(isinstance(output, engine.Cancelled))
+            self.assertEqual(api.voxels, np.count_nonzero(self.mask) // 3)
+
+            # Chunk started after cancellation
+            api.voxels = 0
+            options = dict(self.options, **{"cancel-event" : cancel_event})
+            _, success, output = engine._run_fabber(1, Queue(), options, self.data, self.mask)
+            self.assertTrue(isinstance(output, engine.Cancelled))
+            self.assertEqual(api.voxels, 0)
+        # The cancel event only applies to the chunk it was given for
+        self.assertTrue(engine._CANCEL_EVENT is None)
+
+    def test_pilot_mask(self):
+        """ Pilot sample contains the requested number of unmasked voxels """
+        from . import engine
+        pilot_mask = engine.get_pilot_mask(self.data, self.mask, 10)
+        self.assertTrue(abs(np.count_nonzero(pilot_mask) - 10) <= engine.PILOT_STRATA)
+        self.assertFalse(np.any(pilot_mask[self.mask == 0]))
+
+    def test_screening(self):
+        """ Voxels with NaN, zero or constant signal are excluded and not fitted """
+        from . import engine
+        data = np.array(self.data)
+        data[1, 1, 1, 3] = np.nan
+        data[2, 2, 2] = 0
+        data[3, 3, 3] = 7
+        output = engine.run(data, self.mask, self.options)
+        screened = output[engine.SCREENED_OUTPUT]
+        self.assertEqual(screened[1, 1, 1], 1)
+        self.assertEqual(screened[2, 2, 2], 2)
+        self.assertEqual(screened[3, 3, 3], 3)
+        self.assertEqual(np.count_nonzero(screened), 3)
+        self.assertEqual(output["mean_c0"][2, 2, 2], 0)
+
+    def test_dedupe(self):
+        """ Voxels with identical data are fitted once and get the same output as fitting every voxel """
+        from . import engine
+        data = np.array(self.data)
+        data[:, :, 2:] = data[:, :, 1:2]
+        output = engine.run(data, self.mask, self.options)
+        dedupe_output = engine.run(data, self.mask, dict(self.options, **{"dedupe-voxels" : True}))
+        self.assertTrue(np.allclose(output["mean_c0"], dedupe_output["mean_c0"]))
+
+    def test_region_mode(self):
+        """ Region mode gives the fit to the mean data of each label in every voxel of the label """
+        from . import engine
+        labels = np.array(self.mask)
+        labels[2:4] = 2
+        labels[self.mask == 0] = 0
+        output = engine.run(self.data, labels, dict(self.options, **{"region-mode" : True}))
+        for label in (1, 2):
+            mean_data = np.mean(self.data[labels == label], axis=0)[np.newaxis, np.newaxis, np.newaxis, :]
+            mean_output = engine.run(mean_data, None, self.options)
+            self.assertTrue(np.allclose(output["mean_c0"][labels == label], mean_output["mean_c0"][0, 0, 0]))
+        self.assertFalse(np.any(output["mean_c0"][labels == 0]))
+
+    def test_model_index(self):
+        """ Model index gives the same models and methods as the Fabber API, and is reused once saved """
+        import tempfile
+        import shutil
+        from . import engine
+        from .index import ModelIndex
+        tempdir = tempfile.mkdtemp()
+        try:
+            index_file = os.path.join(tempdir, "index.json")
+            api = engine.get_api()
+            index = ModelIndex(index_file=index_file)
+            self.assertEqual(sorted(index.get_models()), sorted(api.get_models()))
+            self.assertEqual(sorted(index.get_methods()), sorted(api.get_methods()))
+            self.assertTrue(os.path.isfile(index_file))
+            index = ModelIndex(index_file=index_file)
+            self.assertEqual(sorted(index.get_models()), sorted(api.get_models()))
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_model_index_options(self):
+        """ Model index returns options with a description for each category requested, as the Fabber API does """
+        import tempfile
+        import shutil
+        from unittest import mock
+        from . import index
+
+        class _OptionsApi(object):
+            """ Returns options in the same form as the Fabber API """
+            def get_models(self, model_group=None):
+                return ["poly"]
+
+            def get_options(self, generic=None, method=None, model=None):
+                descs = [desc for desc, requested in (("method", method), ("model", model), ("generic", generic)) if requested]
+                return tuple([[{"name" : "degree"}]] + descs)
+
+        tempdir = tempfile.mkdtemp()
+        try:
+            index_file = os.path.join(tempdir, "index.json")
+            with mock.patch.object(index, "get_api", lambda *args: _OptionsApi()):
+                model_index = index.ModelIndex(index_file=index_file)
+                opts = model_index.get_options(generic=True, method="vb", model="poly")
+                self.assertEqual(opts, ([{"name" : "degree"}], "method", "model", "generic"))
+                self.assertEqual(model_index.get_options(method="vb"), ([{"name" : "degree"}], "method"))
+            # Saved results are returned in the same form
+            model_index = index.ModelIndex(index_file=index_file)
+            self.assertEqual(model_index.get_options(generic=True, method="vb", model="poly"), opts)
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_get_api_model_group(self):
+        """ Only the executable for the model group used is given to the API, or all groups if it is not found """
+        from unittest import mock
+        import fabber
+        from . import engine
+
+        model_exes = {"asl" : "/fsl/bin/fabber_asl", "dsc" : "/fsl/bin/fabber_dsc"}
+        found = ("/fsl/lib/libfabbercore_shared.so", "/fsl/bin/fabber", {}, model_exes)
+        with mock.patch.object(fabber, "find_fabber", lambda *args, **kwargs: found), \
+             mock.patch.object(fabber, "FabberCl") as fabber_cl, \
+             mock.patch.object(fabber, "Fabber") as fabber_all:
+            engine.get_api(["/fsl"], "ASL")
+            fabber_cl.assert_called_once_with(core_exe="/fsl/bin/fabber", model_exes={"asl" : "/fsl/bin/fabber_asl"})
+            engine.get_api(["/fsl"], "/fsl/lib/libfabber_models_dsc.so")
+            fabber_cl.assert_called_with(core_exe="/fsl/bin/fabber", model_exes={"dsc" : "/fsl/bin/fabber_dsc"})
+            self.assertFalse(fabber_all.called)
+
+            engine.get_api(["/fsl"], "cest")
+            fabber_all.assert_called_once_with("/fsl")
+            engine.get_api(["/fsl"])
+            self.assertEqual(fabber_all.call_count, 2)
+            self.assertEqual(fabber_cl.call_count, 2)
+
+    def test_cpu_budget(self):
+        """ Workers are limited to the CPU budget, with thread limits and optional pinning applied in each worker """
+        from . import engine
+        self.assertEqual(engine.get_pool_size(10, cpu_budget=8, threads_per_worker=2), 4)
+        self.assertEqual(engine.get_pool_size(10, max_workers=3, cpu_budget=8, threads_per_worker=2), 3)
+        self.assertEqual(engine.get_pool_size(2, cpu_budget=8), 2)
+        self.assertEqual(engine.get_pool_size(10, cpu_budget=1, threads_per_worker=4), 1)
+
+        pool = engine.make_pool(8, cpu_budget=4, threads_per_worker=2, pin_workers=True)
+        try:
+            limits = pool.map(_worker_limits, range(8))
+        finally:
+            pool.close()
+            pool.join()
+        self.assertTrue(len(set([pid for pid, _, _ in limits])) <= 2)
+        self.assertEqual(set([num_threads for _, num_threads, _ in limits]), set(["2"]))
+        if hasattr(os, "sched_getaffinity"):
+            cpus = sorted(os.sched_getaffinity(0))
+            affinities = dict([(pid, tuple(affinity)) for pid, _, affinity in limits])
+            for affinity in affinities.values():
+                self.assertEqual(len(affinity), min(2, len(cpus)))
+            if len(cpus) >= 4:
+                # Each worker has its own CPUs
+                self.assertEqual(len(set(affinities.values())), len(affinities))
+
+if __name__ == '__main__':
+    unittest.main()
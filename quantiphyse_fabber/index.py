@@ -0,0 +1,170 @@
+"""
+Quantiphyse: Persistent index of Fabber models
+
+Listing model groups, models, methods and their options requires running
+the Fabber executables for every installed model group, which is slow when
+many model groups are installed. ``ModelIndex`` stores the results in a JSON
+file keyed on the path, modification time and size of each Fabber library or
+executable, so queries are answered from the index and Fabber is only run again
+when a library changes or a new query is made.
+
+The index file is ``~/.quantiphyse/fabber_model_index.json`` unless
+the ``FABBER_MODEL_INDEX`` environment variable is set.
+
+Copyright (c) 2016-2017 University of Oxford, Martin Craig
+"""
+
+import os
+import json
+import logging
+
+from .engine import get_api
+
+LOG = logging.getLogger(__name__)
+
+#: Environment variable used to override the location of the index file
+INDEX_FILE_ENV = "FABBER_MODEL_INDEX"
+
+#: Default location of the index file
+DEFAULT_INDEX_FILE = os.path.join(os.path.expanduser("~"), ".quantiphyse", "fabber_model_index.json")
+
+#: Version of the index file format. Indexes with a different version are rebuilt
+INDEX_VERSION = 1
+
+def _get_stat(path):
+    """
+    :return: List of modification time and size of a file, or None if it does not exist
+    """
+    try:
+        stat = os.stat(path)
+        return [stat.st_mtime, stat.st_size]
+    except (OSError, TypeError):
+        return None
+
+class ModelIndex(object):
+    """
+    Index of the model groups, models, methods and options provided by
+    the Fabber libraries found in a set of search directories
+
+    Query results are cached for each Fabber library or executable and discarded
+    if the file's modification time or size changes
+    """
+
+    def __init__(self, search_dirs=(), index_file=None):
+        from fabber import find_fabber
+        if index_file is None:
+            index_file = os.environ.get(INDEX_FILE_ENV, DEFAULT_INDEX_FILE)
+        self.search_dirs = tuple(search_dirs)
+        self.index_file = index_file
+        _, self.core_exe, self.model_libs, self.model_exes = find_fabber(*self.search_dirs)
+        self._entries = self._load()
+
+    def get_model_groups(self):
+        """
+        :return: Sequence of model group names
+        """
+        return sorted(set(self.model_libs.keys()) | set(self.model_exes.keys()))
+
+    def get_models(self, model_group=None):
+        """
+        :param model_group: If specified, return only models in this group
+        :return: Sequence of model names
+        """
+        if model_group is not None:
+            return self._get_group_models(model_group.lower())
+        models = []
+        for group in sorted(self.model_exes.keys()):
+            models += [model for model in self._get_group_models(group) if model not in models]
+        return models
+
+    def get_methods(self):
+        """
+        :return: Sequence of inference method names
+        """
+        return self._query(self.core_exe, "methods", lambda: get_api(self.search_dirs).get_methods())
+
+    def get_options(self, generic=None, method=None, model=None):
+        """
+        Get known options for a method or model, or generic options
+
+        Takes the same arguments and returns the same output as the
+        Fabber API ``get_options`` method
+        """
+        model_group = None
+        path = self.core_exe
+        if model:
+            model_group = self.get_model_group(model)
+            if model_group is not None:
+                path = self.model_exes[model_group]
+
+        def _get_options():
+            # Options followed by a description for each of method, model and generic if requested
+            return list(get_api(self.search_dirs, model_group).get_options(generic=generic, method=method, model=model))
+
+        key = "options:%s:%s:%s" % (generic, method, model)
+        return tuple(self._query(path, key, _get_options))
+
+    def get_model_group(self, model):
+        """
+        :return: Name of the model group containing ``model``, or None if not found
+        """
+        for group in sorted(self.model_exes.keys()):
+            if model in self._get_group_models(group):
+                return group
+        return None
+
+    def _get_group_models(self, group):
+        if group not in self.model_exes:
+            return []
+        return self._query(self.model_exes[group], "models",
+                           lambda: get_api(self.search_dirs, group).get_models(model_group=group))
+
+    def _query(self, path, key, query_fn):
+        """
+        Return a cached query result for a Fabber library or executable, running
+        the query if it is not in the index or the file has changed
+        """
+        stat = _get_stat(path)
+        if stat is None:
+            return query_fn()
+
+        path = os.path.abspath(path)
+        entry = self._entries.get(path, None)
+        if entry is None or entry["stat"] != stat:
+            entry = {"stat" : stat, "results" : {}}
+            self._entries[path] = entry
+
+        if key not in entry["results"]:
+            LOG.debug("Updating Fabber model index: %s (%s)", key, path)
+            entry["results"][key] = query_fn()
+            self._save()
+        return entry["results"][key]
+
+    def _load(self):
+        try:
+            with open(self.index_file, "r") as index_file:
+                index = json.load(index_file)
+            if index.get("version", None) == INDEX_VERSION:
+                return index["entries"]
+        except (IOError, OSError, ValueError, KeyError, AttributeError):
+            pass
+        return {}
+
+    def _save(self):
+        # Failing to save the index is not an error - queries will just be repeated next time
+        try:
+            index_dir = os.path.dirname(self.index_file)
+            if index_dir and not os.path.isdir(index_dir):
+                os.makedirs(index_dir)
+            # Write to a temporary file first so other processes never see a partial index
+            tmp_file = "%s.%i.tmp" % (self.index_file, os.getpid())
+            with open(tmp_file, "w") as index_file:
+                json.dump({"version" : INDEX_VERSION, "entries" : self._entries}, index_file)
+            if hasattr(os, "replace"):
+                os.replace(tmp_file, self.index_file)
+            else:
+                if os.path.exists(self.index_file):
+                    os.remove(self.index_file)
+                os.rename(tmp_file, self.index_file)
+        except (IOError, OSError) as exc:
+            LOG.warning("Failed to save Fabber model index %s: %s", self.index_file, exc)
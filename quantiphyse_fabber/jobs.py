@@ -0,0 +1,245 @@
+"""
+Quantiphyse: Session job queue for Fabber runs
+
+Fabber runs started while others are running are queued so the total number
+of CPUs used by all runs stays within a budget (by default all available CPUs).
+Runs are started in order of priority, and in the order they were submitted for
+runs with the same priority. A run is started as soon as there are enough free
+CPUs for at least one of its workers, with fewer workers if necessary, so small
+runs can be interleaved with large ones.
+
+The CPUs of a cancelled run can be held until its workers have actually
+exited, so runs started afterwards do not oversubscribe the machine.
+
+Copyright (c) 2016-2017 University of Oxford, Martin Craig
+"""
+
+import logging
+import itertools
+import threading
+
+from PySide2 import QtCore
+
+from . import engine
+
+LOG = logging.getLogger(__name__)
+
+#: Named priorities. Lower values are started first
+PRIORITIES = {"interactive" : 0, "normal" : 10, "bulk" : 20}
+
+def get_priority(priority):
+    """
+    :param priority: Name of priority from ``PRIORITIES``, integer priority or None for normal priority
+    :return: Integer priority
+    """
+    if priority is None:
+        return PRIORITIES["normal"]
+    elif str(priority).lower() in PRIORITIES:
+        return PRIORITIES[str(priority).lower()]
+    try:
+        return int(priority)
+    except ValueError:
+        raise ValueError("Unknown job priority: %s - must be an integer or one of %s" % (priority, ", ".join(sorted(PRIORITIES))))
+
+class Job(object):
+    """
+    A Fabber run in the job queue
+
+    :ivar process: Process being run
+    :ivar name: Description of the job
+    :ivar cpus: Number of CPUs requested
+    :ivar allocated: Number of CPUs allocated when the job was started
+    :ivar priority: Integer priority
+    :ivar status: ``QUEUED``, ``RUNNING``, ``STOPPING`` (finished but CPUs still held) or ``FINISHED``
+    :ivar progress: Fraction of the job completed
+    """
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    STOPPING = "stopping"
+    FINISHED = "finished"
+
+    def __init__(self, process, start_fn, cpus, threads_per_worker=1, priority=None, name=""):
+        """
+        :param process: Process being run. Its ``sig_progress`` and ``sig_finished`` signals are used to
+                        track the job
+        :param start_fn: Callable which starts the job, taking the number of CPUs allocated to it
+        :param cpus: Number of CPUs requested
+        :param threads_per_worker: Number of CPUs used by each worker - at least this many must be free to start
+        """
+        self.process = process
+        self.name = name
+        self.cpus = max(1, int(cpus))
+        self.threads_per_worker = max(1, int(threads_per_worker))
+        self.allocated = 0
+        self.priority = get_priority(priority)
+        self.status = Job.QUEUED
+        self.progress = 0.0
+        self._start_fn = start_fn
+
+class JobQueue(QtCore.QObject):
+    """
+    Queue of Fabber runs sharing a CPU budget
+
+    Jobs are started, finished and released in the GUI thread. Changes to the
+    queue are made with a lock held as its state may be read from other threads
+    """
+
+    #: Emitted when a job is added, started, finishes or reports progress
+    sig_changed = QtCore.Signal()
+
+    def __init__(self, cpu_budget=None):
+        QtCore.QObject.__init__(self)
+        self.cpu_budget = cpu_budget
+        self._queued = []
+        self._running = []
+        self._held = set()
+        self._counter = itertools.count()
+        self._lock = threading.RLock()
+
+    @property
+    def jobs(self):
+        """
+        :return: List of running jobs followed by queued jobs in the order they will be started
+        """
+        with self._lock:
+            return list(self._running) + [job for _, _, job in sorted(self._queued, key=lambda item: item[:2])]
+
+    @property
+    def free_cpus(self):
+        """
+        :return: Number of CPUs in the budget not allocated to running or stopping jobs
+        """
+        budget = self.cpu_budget if self.cpu_budget else engine.get_available_cpus()
+        with self._lock:
+            return budget - sum([job.allocated for job in self._running])
+
+    def submit(self, job, run_now=False):
+        """
+        Add a job to the queue
+
+        :param run_now: If True the job is started immediately regardless of the CPU
+                        budget, e.g. for synchronous (batch) runs
+        """
+        LOG.debug("Submitting job %s: priority=%i, cpus=%i", job.name, job.priority, job.cpus)
+        if run_now:
+            with self._lock:
+                self._allocate(job, max(1, min(job.cpus, self.free_cpus)))
+            self._start([job])
+        else:
+            with self._lock:
+                self._queued.append((job.priority, next(self._counter), job))
+            self.sig_changed.emit()
+            self._start_next()
+
+    def remove(self, process):
+        """
+        Remove queued jobs for a process, e.g. when it is cancelled before starting
+        """
+        with self._lock:
+            self._queued = [item for item in self._queued if item[2].process is not process]
+        self.sig_changed.emit()
+
+    def hold(self, process):
+        """
+        Keep the CPUs allocated to a process's running job when it finishes, until
+        ``release`` is called. Used when a run is cancelled, as its workers may still
+        be running until they stop or are terminated
+
+        :return: True if the process has a running job whose CPUs will be held
+        """
+        with self._lock:
+            if not any([job.process is process for job in self._running]):
+                return False
+            self._held.add(process)
+            return True
+
+    def release(self, process):
+        """
+        Free the CPUs held for a process's job once its workers have exited. This may
+        start the next job so must be called in the GUI thread
+        """
+        with self._lock:
+            self._held.discard(process)
+            stopped = [job for job in self._running if job.process is process and job.status == Job.STOPPING]
+        for job in stopped:
+            self._free(job)
+
+    def _start_next(self):
+        """
+        Start queued jobs in priority order while there are enough free CPUs. A job which
+        cannot start blocks lower priority jobs so large jobs are not starved
+        """
+        started = []
+        with self._lock:
+            while self._queued:
+                item = min(self._queued, key=lambda item: item[:2])
+                job = item[2]
+                free_cpus = self.free_cpus
+                if self._running and free_cpus < job.threads_per_worker:
+                    break
+                self._queued.remove(item)
+                self._allocate(job, max(job.threads_per_worker, min(job.cpus, free_cpus)))
+                started.append(job)
+        self._start(started)
+
+    def _allocate(self, job, cpus):
+        """
+        Allocate CPUs to a job and track its progress. Called with the lock held
+        """
+        LOG.debug("Starting job %s with %i CPUs", job.name, cpus)
+        job.status = Job.RUNNING
+        job.allocated = cpus
+        self._running.append(job)
+
+        def _progress(progress):
+            job.progress = progress
+            self.sig_changed.emit()
+
+        def _finished(*_):
+            job.process.sig_progress.disconnect(_progress)
+            job.process.sig_finished.disconnect(_finished)
+            self._finished(job)
+
+        job.process.sig_progress.connect(_progress)
+        job.process.sig_finished.connect(_finished)
+
+    def _start(self, started):
+        """
+        Start jobs which have been allocated CPUs. Called without the lock held as
+        synchronous runs do not return until they have finished
+        """
+        for job in started:
+            self.sig_changed.emit()
+            job._start_fn(job.allocated)
+
+    def _finished(self, job):
+        LOG.debug("Job finished: %s", job.name)
+        with self._lock:
+            stopping = job.process in self._held
+            if stopping:
+                LOG.debug("Holding CPUs until workers have stopped: %s", job.name)
+                job.status = Job.STOPPING
+        if stopping:
+            self.sig_changed.emit()
+        else:
+            self._free(job)
+
+    def _free(self, job):
+        with self._lock:
+            job.status = Job.FINISHED
+            if job in self._running:
+                self._running.remove(job)
+        self.sig_changed.emit()
+        self._start_next()
+
+_JOB_QUEUE = None
+
+def get_job_queue():
+    """
+    :return: Job queue shared by all Fabber runs in the session
+    """
+    global _JOB_QUEUE
+    if _JOB_QUEUE is None:
+        _JOB_QUEUE = JobQueue()
+    return _JOB_QUEUE
@@ -0,0 +1,182 @@
+"""
+Quantiphyse: Bounded handling of Fabber logs
+
+Fabber logs can be very large, e.g. when every voxel reports numerical problems.
+Workers therefore only return a bounded summary of each log - the first lines
+of the log together with warnings aggregated by type - and optionally write
+the full log to a file.
+
+Copyright (c) 2016-2017 University of Oxford, Martin Craig
+"""
+
+import os
+import re
+
+import numpy as np
+
+#: Number of lines from the start of the log included in the summary
+HEAD_LINES = 200
+
+#: Number of example lines kept for each type of warning
+MAX_EXAMPLES = 3
+
+# Lines which are reported as warnings
+_WARNING_RE = re.compile(r"warning|error|exception|numerical|converge|\bnan\b|\binf\b", re.I)
+
+# Numbers are removed from warning lines to identify the type of warning
+_NUMBER_RE = re.compile(r"[-+]?\d+(\.\d*)?([eE][-+]?\d+)?")
+
+# Voxel number in a warning line. Fabber numbers voxels from 1
+_VOXEL_RE = re.compile(r"voxel\s*:?\s*(\d+)", re.I)
+
+class LogSummary(object):
+    """
+    Bounded summary of one or more Fabber logs
+
+    :ivar head: List of lines from the start of the log, not including warnings
+    :ivar lines: Total number of lines in the log
+    :ivar warnings: Mapping from warning type (the warning line with numbers removed)
+                    to a dictionary containing the number of occurrences (``count``),
+                    some example lines (``examples``), the number of voxels affected
+                    (``voxels``) and the positions of some of them (``example-voxels``)
+    :ivar files: List of files containing the full logs
+    """
+
+    def __init__(self, log=""):
+        self.head = []
+        self.lines = 0
+        self.warnings = {}
+        self.files = []
+        if log:
+            self.add(log)
+
+    def add(self, log):
+        """
+        Add lines from a log to the summary
+        """
+        for line in log.splitlines():
+            self.lines += 1
+            if _WARNING_RE.search(line):
+                warning_type = _NUMBER_RE.sub("#", line.strip())
+                if warning_type not in self.warnings:
+                    self.warnings[warning_type] = {"count" : 0, "examples" : [], "voxels" : 0,
+                                                   "example-voxels" : [], "voxel-numbers" : set()}
+                warning = self.warnings[warning_type]
+                warning["count"] += 1
+                if len(warning["examples"]) < MAX_EXAMPLES:
+                    warning["examples"].append(line.strip())
+                match = _VOXEL_RE.search(line)
+                if match:
+                    warning["voxel-numbers"].add(int(match.group(1)))
+            elif len(self.head) < HEAD_LINES:
+                self.head.append(line)
+
+    def locate_voxels(self, mask, warning_mask=False):
+        """
+        Find the voxels affected by each type of warning
+
+        Voxel numbers are only meaningful for the data the log came from, so this
+        must be called before summaries from different data chunks are merged
+
+        :param mask: Mask used for the fit
+        :param warning_mask: If True, return a mask of the number of warnings for each voxel
+        :return: Integer Numpy array with the same shape as ``mask`` if ``warning_mask`` is True
+        """
+        # Fabber fits voxels in Fortran order
+        voxels = np.flatnonzero(mask.ravel(order="F"))
+        counts = np.zeros(mask.size, dtype=np.int32)
+        for warning in self.warnings.values():
+            numbers = np.array(sorted(warning.pop("voxel-numbers", ())), dtype=np.int64)
+            numbers = numbers[(numbers >= 1) & (numbers <= len(voxels))]
+            indices = voxels[numbers - 1]
+            warning["voxels"] += len(indices)
+            warning["example-voxels"] += [tuple([int(pos) for pos in np.unravel_index(idx, mask.shape, order="F")])
+                                          for idx in indices[:MAX_EXAMPLES - len(warning["example-voxels"])]]
+            counts[indices] += 1
+        if warning_mask:
+            return counts.reshape(mask.shape, order="F")
+
+    def map_voxels(self, position_fn):
+        """
+        Convert the example voxel positions, e.g. from data chunk to full data coordinates
+
+        :param position_fn: Callable taking a position tuple and returning the new position
+        """
+        for warning in self.warnings.values():
+            warning["example-voxels"] = [position_fn(pos) for pos in warning["example-voxels"]]
+
+    def merge(self, other):
+        """
+        Add the warnings from another summary to this one
+        """
+        self.lines += other.lines
+        self.files += other.files
+        for warning_type, other_warning in other.warnings.items():
+            if warning_type not in self.warnings:
+                self.warnings[warning_type] = {"count" : 0, "examples" : [], "voxels" : 0, "example-voxels" : []}
+            warning = self.warnings[warning_type]
+            warning["count"] += other_warning["count"]
+            warning["voxels"] += other_warning["voxels"]
+            warning["examples"] += other_warning["examples"][:MAX_EXAMPLES - len(warning["examples"])]
+            warning["example-voxels"] += other_warning["example-voxels"][:MAX_EXAMPLES - len(warning["example-voxels"])]
+
+    def format(self):
+        """
+        :return: Summary as a string suitable for including in the log
+        """
+        text = "\n".join(self.head) + "\n"
+        if self.lines > len(self.head) + sum([warning["count"] for warning in self.warnings.values()]):
+            text += "... (%i lines in full log)\n" % self.lines
+        if self.warnings:
+            text += "\nWarnings:\n"
+            for warning in self.sorted_warnings():
+                text += "  %i x %s\n" % (warning["count"], warning["examples"][0])
+        if self.files:
+            text += "\nFull log: %s\n" % ", ".join(self.files)
+        return text
+
+    def format_warnings(self):
+        """
+        :return: Table of warnings with counts and example voxels as a string
+        """
+        text = "Warning\tCount\tVoxels\tExample voxels\n"
+        for warning in self.sorted_warnings():
+            text += "%s\t%i\t%i\t%s\n" % (warning["examples"][0], warning["count"], warning["voxels"],
+                                         " ".join(["(%s)" % ",".join([str(pos) for pos in voxel])
+                                                   for voxel in warning["example-voxels"]]))
+        return text
+
+    def sorted_warnings(self):
+        """
+        :return: List of warnings, most frequent first
+        """
+        return sorted(self.warnings.values(), key=lambda warning: -warning["count"])
+
+def summarise_log(log, log_file=None):
+    """
+    Summarise a Fabber log, optionally writing the full log to a file
+
+    :param log: Full log as a string
+    :param log_file: Optional path to write the full log to. Missing directories are created
+    :return: ``LogSummary``
+    """
+    summary = LogSummary(log)
+    if log_file:
+        log_dir = os.path.dirname(log_file)
+        if log_dir and not os.path.isdir(log_dir):
+            os.makedirs(log_dir)
+        with open(log_file, "w") as logfile:
+            logfile.write(log)
+        summary.files.append(os.path.abspath(log_file))
+    return summary
+
+def get_log_file(log_dir, worker_id, variant=None):
+    """
+    :return: Path of the file used for the full log of a chunk, or None if ``log_dir`` is not set
+    """
+    if not log_dir:
+        return None
+    name = "fabber_chunk%04i" % worker_id
+    if variant is not None:
+        name += "_variant%i" % variant
+    return os.path.join(log_dir, name + ".log")
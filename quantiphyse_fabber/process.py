@@ -4,68 +4,115 @@ Quantiphyse: Process implementations for Fabber plugin
 Copyright (c) 2016-2017 University of Oxford, Martin Craig
 """
 
-import sys
 import os
 import re
+import json
 import logging
 import math
+import time
+import weakref
+import threading
+import itertools
+import collections
+import multiprocessing
+import multiprocessing.dummy
 
 import numpy as np
 
+from PySide2 import QtCore
+
 from quantiphyse.data import DataGrid
+from quantiphyse.data.extras import MatrixExtra
 from quantiphyse.processes import Process
+from quantiphyse.processes.process import _worker_initialize
 from quantiphyse.utils import get_plugins, QpException
 
+from . import engine, jobs, remote
+from .engine import _run_fabber, _evaluate_model, peak_rss
+from .index import ModelIndex
+
 LOG = logging.getLogger(__name__)
 
 # Maximum size of Fabber log that we are prepared to handle
 MAX_LOG_SIZE=100000
 
-def _make_fabber_progress_cb(worker_id, queue):
-    """ 
-    Closure which can be used as a progress callback for the C API. Puts the 
-    number of voxels processed onto the queue
-    """
-    def _progress_cb(voxel, nvoxels):
-        percent = int(100*float(voxel)/nvoxels)
-        if percent != _progress_cb.last_percent:
-            _progress_cb.last_percent = percent
-            queue.put((worker_id, voxel, nvoxels))
+#: Time in seconds allowed for workers to stop after a run is cancelled before they are terminated
+CANCEL_GRACE_PERIOD = 2.0
+
+#: Interval in seconds between checks for the workers of a cancelled run to stop
+CANCEL_POLL_INTERVAL = 0.1
+
+#: Name of ROI output marking the voxels fitted before a run was cancelled
+PARTIAL_OUTPUT = "fabber_completed"
 
-    _progress_cb.last_percent = 0
-    return _progress_cb
+#: Maximum memory in bytes used to keep resampled additional data between runs
+RESAMPLE_CACHE_SIZE = 512 * 1024 * 1024
 
-def _run_fabber(worker_id, queue, options, main_data, roi, *add_data):
+class _ResampleCache(object):
     """
-    Function to run Fabber in a multiprocessing environment
+    Cache of additional data items (e.g. image priors) resampled onto the grid
+    of the main data, so repeated runs do not resample the same data again
+
+    Entries are identified by the data object, its raw Numpy array and the target
+    grid. Weak references are used so cached entries do not keep data items alive,
+    and entries for data which has been removed or replaced are never returned.
+    The least recently used entries are evicted when the cache grows beyond
+    ``max_bytes``. Note that in-place changes to a data item's array are not detected
     """
-    from fabber import FabberRun
-    try:
-        indir = options.pop("indir")
-        if indir:
-            os.chdir(indir)
-
-        if np.count_nonzero(roi) == 0:
-            # Ignore runs with no voxel. Return placeholder object
-            LOG.debug("No voxels")
-            return worker_id, True, FabberRun({}, "")
-    
-        options["data"] = main_data
-        options["mask"] = roi
-        if len(add_data) % 2 != 0:
-            raise Exception("Additional data has odd-numbered length %i - should be sequence of key then value" % len(add_data))
-        n = 0
-        while n < len(add_data):
-            options[add_data[n]] = add_data[n+1]
-            n += 2
-            
-        api = FabberProcess.api(options.pop("model-group", None))
-        run = api.run(options, progress_cb=_make_fabber_progress_cb(worker_id, queue))
-        return worker_id, True, run
-    except:
-        import traceback
-        traceback.print_exc()
-        return worker_id, False, sys.exc_info()[1]
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._entries = collections.OrderedDict()
+
+    def get(self, qpdata, grid):
+        """
+        :return: Numpy array of ``qpdata`` resampled onto ``grid``
+        """
+        raw = qpdata.raw()
+        if qpdata.grid.matches(grid):
+            return raw
+
+        key = (id(qpdata), id(raw), tuple(grid.shape), np.asarray(grid.affine).tobytes())
+        entry = self._entries.pop(key, None)
+        if entry is not None and entry[0]() is qpdata and entry[1]() is raw:
+            LOG.debug("Using cached resampled data for %s", qpdata.name)
+            self._entries[key] = entry
+            return entry[2]
+        elif entry is not None:
+            self.nbytes -= entry[2].nbytes
+
+        resampled = qpdata.resample(grid).raw()
+        self._purge()
+        if resampled.nbytes <= self.max_bytes:
+            while self._entries and self.nbytes + resampled.nbytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.nbytes -= evicted[2].nbytes
+            self._entries[key] = (weakref.ref(qpdata), weakref.ref(raw), resampled)
+            self.nbytes += resampled.nbytes
+        return resampled
+
+    def _purge(self):
+        """
+        Remove entries for data items which no longer exist
+        """
+        for key, entry in list(self._entries.items()):
+            if entry[0]() is None or entry[1]() is None:
+                del self._entries[key]
+                self.nbytes -= entry[2].nbytes
+
+    def clear(self):
+        """
+        Remove all entries
+        """
+        self._entries.clear()
+        self.nbytes = 0
+
+# Resampled data is shared between all runs in the session
+_RESAMPLE_CACHE = _ResampleCache(RESAMPLE_CACHE_SIZE)
+
+# Model indexes for each set of search directories
+_MODEL_INDEXES = {}
 
 class FabberProcess(Process):
     """
@@ -73,6 +120,54 @@ class FabberProcess(Process):
 
     Note the static methods - these are so they can be called by other plugins which
     can obtain a reference to the FabberProcess class only 
+
+    The ``cpu-budget``, ``threads-per-worker`` and ``pin-workers`` options control the
+    number of CPUs used - see ``_get_cpu_options``
+
+    A parameter sweep can be requested using the ``sweep`` option, which maps option
+    names to a list of values. Every combination of values is fitted, sharing the
+    input data and worker processes, and the outputs of each combination are
+    suffixed with the option values used. The mean free energy of each combination
+    is reported in the log and as a table extra named by ``sweep-output``
+
+    Voxels which cause Fabber to fail are isolated by refitting smaller chunks, and
+    optionally retried with the fallback options given in ``retry-options``. Voxels
+    which still fail are marked in the ``fabber_failed`` ROI and the results for all
+    other voxels are kept. Set ``retry-failed`` to False to fail the whole run instead
+
+    Workers return a bounded summary of the Fabber log. If ``log-dir`` is set the full
+    log for each chunk is written to a file in that directory. Warnings from all chunks
+    are aggregated by type in the log, and if ``save-warning-mask`` is set the number
+    of warnings for each voxel is output as the ``fabber_warnings`` ROI.
+
+    If ``save-runtime-map`` is set the approximate fitting time in seconds for each
+    voxel is output as ``fabber_runtime``
+
+    If ``pilot`` is set (to True or a number of voxels) only a stratified random sample
+    of the unmasked voxels is fitted, and the wall time, peak memory and output size of
+    the full run are predicted from it - see ``_log_pilot_report``. Outputs of the
+    pilot run are only added, suffixed with ``_pilot``, if ``save-pilot`` is set
+
+    Voxels whose signal contains NaN or infinite values, is all zero or is constant
+    are excluded from the fit and marked in the ``fabber_screened`` ROI with the reason
+    (see ``engine.SCREEN_REASONS``). Set ``screen-voxels`` to False to fit them anyway
+
+    If ``dedupe-voxels`` is set, voxels with identical signal and additional data (e.g.
+    synthetic or heavily quantized data) are only fitted once and the outputs copied to
+    all of them. This is not done for spatial VB or pilot runs
+
+    If ``region-mode`` is set the ROI is treated as a set of labelled regions. The mean
+    data in each region is fitted once and the outputs painted back into every voxel of
+    the region. The mean parameter values for each region are also added as a table
+    extra named by ``region-output``
+
+    Runs are queued with other Fabber runs in the session so they share the available
+    CPUs, in order of their ``priority`` - see ``quantiphyse_fabber.jobs``. Runs using
+    the remote backend (``backend: remote``) fit chunks on the ``remote-hosts`` instead,
+    one chunk per host at a time, and are not queued - see ``quantiphyse_fabber.remote``
+
+    When the run is cancelled workers stop at their next progress update - see ``cancel``.
+    If ``keep-partial`` is set the outputs of chunks which had already completed are kept
     """
 
     PROCESS_NAME = "Fabber"
@@ -81,24 +176,67 @@ class FabberProcess(Process):
         Process.__init__(self, ivm, worker_fn=_run_fabber, **kwargs)
         self.grid = None
         self.data_items = []
+        self.variants = [{}]
+        self.sweep_results = []
+        self.max_workers = None
+        self.cpu_budget = None
+        self.threads_per_worker = 1
+        self.pin_workers = False
+        self.columns = None
+        self.profile = {}
+        self.pilot = None
+        self.pilot_report = None
+        self.keep_partial = False
+        self.screened = None
+        self.distinct = None
+        self.regions = None
+        self._cancel_event = None
+        self._queued_args = None
+        self.priority = None
+        self.remote = None
+        self._local_worker_fn = self._worker_fn
     
     @staticmethod
     def get_model_group_name(lib):
         """ Get the model group name from a library name"""
-        match = re.match(r".*fabber_models_(.+)\..+", lib, re.I)
-        if match:
-            return match.group(1).lower()
-        else:
-            return lib.lower()
+        return engine.get_model_group_name(lib)
 
     @staticmethod
     def api(model_group=None):
         """
         Return a Fabber API object
         """
-        from fabber import Fabber
-        search_dirs = get_plugins(key="fabber-dirs")
-        return Fabber(*search_dirs)
+        return engine.get_api(get_plugins(key="fabber-dirs"), model_group)
+
+    @staticmethod
+    def model_index():
+        """
+        Return the persistent index of installed Fabber models
+        """
+        search_dirs = tuple(get_plugins(key="fabber-dirs"))
+        if search_dirs not in _MODEL_INDEXES:
+            _MODEL_INDEXES[search_dirs] = ModelIndex(search_dirs)
+        return _MODEL_INDEXES[search_dirs]
+
+    @staticmethod
+    def get_model_groups():
+        """ Get the names of installed model groups """
+        return FabberProcess.model_index().get_model_groups()
+
+    @staticmethod
+    def get_models(model_group=None):
+        """ Get the names of installed models, optionally only those in a model group """
+        return FabberProcess.model_index().get_models(model_group)
+
+    @staticmethod
+    def get_methods():
+        """ Get the names of installed inference methods """
+        return FabberProcess.model_index().get_methods()
+
+    @staticmethod
+    def get_options(generic=None, method=None, model=None):
+        """ Get known options for a model or method, or generic options """
+        return FabberProcess.model_index().get_options(generic=generic, method=method, model=model)
 
     def run(self, options):
         """
@@ -106,6 +244,9 @@ class FabberProcess(Process):
 
         FIXME need to be able to pass matrix options as actual matrices
         """
+        self._start_profile()
+        phase_start = time.time()
+
         # Take a copy of the options dict and then clean it out to avoid
         # warnings in batch mode. Fabber logfile will warn about unusued
         # options itself
@@ -129,6 +270,15 @@ class FabberProcess(Process):
         if not self.output_rename:
             self.output_rename = {}
 
+        # Maximum number of parallel workers - default is one for each CPU
+        max_workers = options.pop("num-workers", None)
+        self._get_cpu_options(options)
+        try:
+            self.remote = remote.get_backend(options)
+        except ValueError as exc:
+            raise QpException(str(exc))
+        self.keep_partial = bool(options.pop("keep-partial", False))
+
         # Set some defaults
         options["method"] = options.get("method", "vb")
         options["noise"] = options.get("noise", "white")
@@ -138,15 +288,52 @@ class FabberProcess(Process):
             if options[key] is None:
                 options[key] = True
 
+        # Parameter sweep - each worker fits every combination of the swept option values
+        self.variants = self._get_sweep_variants(options.pop("sweep", None))
+        self.sweep_output = options.pop("sweep-output", "sweep_free_energy")
+        self.sweep_results = []
+        if len(self.variants) > 1:
+            # Free energy is required to compare the variants
+            options["save-free-energy"] = True
+            options["variants"] = self.variants
+
         # Pass our input directory - this is used as the working directory so file names
         # can be passed relative to it
         options["indir"] = self.indir
+        options["fabber-dirs"] = get_plugins(key="fabber-dirs")
+        phase_start = self._profile_phase("options", phase_start)
 
         # Use smallest sub-array of the data which contains all unmasked voxels
-        self.bb_slices = roi.get_bounding_box()
+        self.bb_slices = tuple(roi.get_bounding_box())
         self.debug("Using bounding box: %s", self.bb_slices)
-        data_bb = data.raw()[tuple(self.bb_slices)]
-        mask_bb = roi.raw()[tuple(self.bb_slices)]
+        data_bb = data.raw()[self.bb_slices]
+        mask_bb = roi.raw()[self.bb_slices]
+        phase_start = self._profile_phase("bounding-box", phase_start)
+
+        # Exclude voxels which cannot be usefully fitted, e.g. containing NaN
+        self.screened = None
+        if options.pop("screen-voxels", True):
+            screened = engine.screen_voxels(data_bb, mask_bb)
+            if np.any(screened):
+                self.screened = screened
+                mask_bb = np.where(screened > 0, 0, mask_bb)
+                self.log(engine.get_screening_summary(screened))
+                if not np.any(mask_bb):
+                    raise QpException("No voxels left to fit - " + engine.get_screening_summary(screened))
+            phase_start = self._profile_phase("screening", phase_start)
+
+        # Pilot run fits a sample of voxels to estimate the cost of the full run
+        self.pilot = options.pop("pilot", None)
+        self.save_pilot = options.pop("save-pilot", False)
+        self.pilot_report = None
+        if self.pilot:
+            n_pilot = engine.PILOT_VOXELS if self.pilot is True else int(self.pilot)
+            if n_pilot < 1:
+                raise QpException("Number of pilot voxels must be at least 1")
+            self.full_mask_bb = mask_bb
+            mask_bb = engine.get_pilot_mask(data_bb, mask_bb, n_pilot)
+            phase_start = self._profile_phase("pilot-sampling", phase_start)
+        self.mask_bb = mask_bb
 
         # Pass in input data. To enable the multiprocessing module to split our volumes
         # up automatically we have to pass the arguments as a single list. This consists of
@@ -155,28 +342,213 @@ class FabberProcess(Process):
 
         # Determine which of the options should be treated as data sets and add them to the input args
         api = self.api(options.get("model-group", None))
-        known_options = api.get_options(generic=True, model=options.get("model", None), method=options.get("method", None))[0]
+        phase_start = self._profile_phase("api-load", phase_start)
+        known_options = FabberProcess.get_options(generic=True, model=options.get("model", None), method=options.get("method", None))[0]
+        for key in self.variants[0]:
+            if key == "model-group" or api.is_data_option(key, known_options):
+                raise QpException("Fabber option '%s' cannot be included in a parameter sweep" % key)
+
         for key in list(options.keys()):
             if api.is_data_option(key, known_options):
                 data_option = self.ivm.data.get(options[key], None)
                 if data_option is not None:
-                    extra_data = data_option.resample(data.grid).raw()[self.bb_slices]
+                    phase_start = self._profile_phase("options", phase_start)
+                    extra_data = _RESAMPLE_CACHE.get(data_option, data.grid)[self.bb_slices]
                     input_args.append(key)
                     input_args.append(extra_data)
                     options.pop(key)
+                    phase_start = self._profile_phase("resampling", phase_start)
                 else:
                     raise QpException("Fabber option '%s' expected data item but data set '%s' not found" % (key, options[key]))
-    
-        if options["method"] == "spatialvb":
+        phase_start = self._profile_phase("options", phase_start)
+
+        methods = [variant.get("method", options["method"]) for variant in self.variants]
+        self.distinct, self.regions = None, None
+        self.region_output = options.pop("region-output", "region_params")
+        region_mode, dedupe = options.pop("region-mode", False), options.pop("dedupe-voxels", False)
+        if region_mode:
+            if "spatialvb" in methods:
+                raise QpException("Region mode cannot be used with spatial VB")
+            elif self.pilot:
+                raise QpException("Region mode cannot be used with a pilot run")
+            input_args, self.distinct, self.regions = engine.region_args(input_args)
+            self.log("Fitting mean data in %i regions containing %i voxels\n" % (len(self.regions), np.count_nonzero(mask_bb)))
+            self._profile_phase("region-averaging", phase_start)
+        elif dedupe:
+            if "spatialvb" in methods:
+                self.log("Not removing duplicate voxels as spatial VB needs neighbouring voxels\n")
+            elif self.pilot:
+                self.log("Not removing duplicate voxels for pilot run\n")
+            else:
+                input_args, self.distinct = engine.dedupe_args(input_args)
+                if self.distinct is not None:
+                    self.log("Fitting %i distinct voxels out of %i\n" % (len(self.distinct[0]), np.count_nonzero(mask_bb)))
+                self._profile_phase("dedupe", phase_start)
+        self._start_chunks(input_args, input_args[2], methods, max_workers, (options.get("model", None), options["method"]))
+
+    def _get_cpu_options(self, options):
+        """
+        Get the options which control how many CPUs and threads the workers use
+
+        ``cpu-budget`` is the maximum number of CPUs to use (default all available),
+        ``threads-per-worker`` is the number of threads each worker may use (default 1)
+        and ``pin-workers`` pins each worker to its own CPUs. The number of workers
+        is limited so the total number of threads stays within the budget.
+
+        ``priority`` is the priority of the run in the session job queue (``interactive``,
+        ``normal``, ``bulk`` or an integer) - see ``quantiphyse_fabber.jobs``. Pilot runs
+        have interactive priority by default
+        """
+        try:
+            self.priority = jobs.get_priority(options.pop("priority", "interactive" if options.get("pilot", None) else None))
+        except ValueError as exc:
+            raise QpException(str(exc))
+        self.cpu_budget = options.pop("cpu-budget", None)
+        self.threads_per_worker = int(options.pop("threads-per-worker", 1))
+        self.pin_workers = bool(options.pop("pin-workers", False))
+        if self.threads_per_worker < 1:
+            raise QpException("Number of threads per worker must be at least 1")
+        if self.cpu_budget is not None:
+            self.cpu_budget = int(self.cpu_budget)
+            if self.cpu_budget < 1:
+                raise QpException("CPU budget must be at least 1")
+            if self.cpu_budget > engine.get_available_cpus():
+                self.warn("CPU budget %i is larger than the number of available CPUs (%i)" % (self.cpu_budget, engine.get_available_cpus()))
+
+    def _start_chunks(self, input_args, mask, methods, max_workers, timing_key, allocated=None):
+        """
+        Divide the unmasked voxels into chunks and start the background workers
+
+        The run is submitted to the session job queue and the workers are started
+        when there are free CPUs, unless ``allocated`` gives the CPUs already allocated
+        to the run by the job queue, e.g. for an earlier phase of the run. Unless spatial
+        VB is used, the data is divided into chunks of voxel columns which get smaller
+        through the run. Chunks are handed to workers as they become idle so the run is
+        not held up by a single slow chunk. Chunk sizes are chosen using the time per voxel observed in previous runs of the same model and method
+        """
+        if self.remote is not None:
+            # Remote chunks do not use local CPUs - one chunk is fitted on each host at a time
+            self.max_workers = len(self.remote["hosts"])
+        else:
+            self.max_workers = engine.get_pool_size(None, max_workers, self.cpu_budget, self.threads_per_worker)
+        self.timing_key = timing_key
+        self.mask_shape = mask.shape
+        if "spatialvb" in methods:
             # Spatial VB will not work properly in parallel
-            n_workers = 1
+            self.columns, self.chunk_bounds = None, None
+            n_chunks = 1
         else:
-            # Run one worker for each slice
-            n_workers = data_bb.shape[0]
+            self.columns, voxel_counts = engine.get_columns(mask)
+            self.chunk_bounds = engine.schedule_chunks(voxel_counts, self.max_workers, engine.get_voxel_time(timing_key))
+            n_chunks = len(self.chunk_bounds)
+        self.debug("Fitting %i voxels in %i chunks using up to %i workers", np.count_nonzero(mask), n_chunks, self.max_workers)
+        self.voxels_todo = np.count_nonzero(mask)
+        self.voxels_done = [0, ] * n_chunks
+        self.profile["summary"].update({"voxels" : int(self.voxels_todo), "chunks" : n_chunks, "workers" : self.max_workers})
+        self.chunk_received = [None, ] * n_chunks
+        self._queued_args = (input_args, n_chunks)
+        self.job_submitted = time.time()
+        self.status = Process.RUNNING
+        if self.remote is not None:
+            self._start_queued(None)
+            return
+        elif allocated is not None:
+            self._start_queued(allocated)
+            return
+        job = jobs.Job(self, self._start_queued, self.max_workers * self.threads_per_worker,
+                       self.threads_per_worker, self.priority, name="%s: %s" % (self.PROCESS_NAME, timing_key[0]))
+        jobs.get_job_queue().submit(job, run_now=getattr(self, "_sync", False))
+
+    def _start_queued(self, cpus):
+        """
+        Start the workers when the job queue has allocated CPUs to the run
+
+        :param cpus: Number of CPUs allocated, or None for remote runs which do not use the job queue
+        """
+        if self.status != Process.RUNNING:
+            return
+        if cpus is not None:
+            self.max_workers = max(1, min(self.max_workers, cpus // self.threads_per_worker))
+        self.profile["summary"].update({"workers" : self.max_workers, "job-queue-time" : time.time() - self.job_submitted})
+        input_args, n_chunks = self._queued_args
+        self._queued_args = None
+        self.chunk_submitted = time.time()
+        try:
+            self.start_bg(input_args, n_workers=n_chunks)
+        except Exception as exc:
+            # Not called from execute() so failures must be reported here
+            self.status = Process.FAILED
+            self.exception = exc
+            self._complete()
+
+    def _init_multiproc(self, num_tasks):
+        # Limit the number of worker processes and their threads to the CPU
+        # budget - chunks are queued until a worker is free
+        if not self._multiproc:
+            return Process._init_multiproc(self, num_tasks)
+        if self.remote is not None:
+            # Remote chunks are dispatched by threads in this process
+            self._cancel_event = threading.Event()
+            pool = remote.RemotePool(cancel_event=self._cancel_event, **self.remote)
+            self._worker_fn = pool.run_chunk
+            return pool, multiprocessing.dummy.Queue()
+        self._worker_fn = self._local_worker_fn
+        queue = multiprocessing.Manager().Queue()
+        self._cancel_event = multiprocessing.Event()
+        pool = engine.make_pool(num_tasks, self.max_workers, self.cpu_budget, self.threads_per_worker,
+                                self.pin_workers, initializer=_worker_initialize, cancel_event=self._cancel_event)
+        return pool, queue
+
+    def cancel(self):
+        """
+        Cancel the run
+
+        Workers are signalled to abort their fit at the next progress update and chunks
+        which have not started are skipped. Workers which have not stopped after
+        ``CANCEL_GRACE_PERIOD`` seconds are terminated. The CPUs allocated to the run
+        by the job queue are not freed until the workers have exited. If ``keep-partial``
+        was set, the outputs of chunks which had completed are added, with the voxels
+        they contain marked in the ``fabber_completed`` ROI
+        """
+        if self.status == Process.RUNNING:
+            job_queue = jobs.get_job_queue()
+            job_queue.remove(self)
+            self._queued_args = None
+            if self._cancel_event is not None:
+                self._cancel_event.set()
+            if self._pool is not None:
+                held = job_queue.hold(self)
+                thread = threading.Thread(target=self._stop_workers, args=(self._pool, held))
+                thread.daemon = True
+                thread.start()
+            if self.keep_partial and self._worker_output:
+                self._add_partial_output(list(self._worker_output))
+        Process.cancel(self)
+        # Release input and output data promptly rather than when the process is deleted
+        self.mask_bb = None
+        self.full_mask_bb = None
+
+    def _stop_workers(self, pool, held):
+        """
+        Wait for the workers of a cancelled run to return their chunks, terminate any
+        which have not stopped within the grace period and release the run's CPUs
+        once all have exited. Called in a background thread
+        """
+        deadline = time.time() + CANCEL_GRACE_PERIOD
+        while time.time() < deadline and None in getattr(self, "chunk_received", []):
+            time.sleep(CANCEL_POLL_INTERVAL)
+        pool.terminate()
+        pool.join()
+        if held:
+            # Releasing the CPUs may start the next job, which must be done in the GUI thread
+            self.metaObject().invokeMethod(self, "_release_cpus", QtCore.Qt.QueuedConnection)
 
-        self.voxels_todo = np.count_nonzero(mask_bb)
-        self.voxels_done = [0, ] * n_workers
-        self.start_bg(input_args, n_workers=n_workers)
+    @QtCore.Slot()
+    def _release_cpus(self):
+        """
+        Free the CPUs held in the job queue for a cancelled run
+        """
+        jobs.get_job_queue().release(self)
 
     def timeout(self, queue):
         """
@@ -186,52 +558,125 @@ class FabberProcess(Process):
         while not queue.empty():
             worker_id, done, todo = queue.get()
             if worker_id < len(self.voxels_done):
-                self.voxels_done[worker_id] = float(done) / todo
+                self.voxels_done[worker_id] = self.chunk_voxels[worker_id] * float(done) / todo
             else:
                 self.warn("Fabber: Id=%i in timeout (max %i)" % (worker_id, len(self.voxels_done)))
-        complete = sum(self.voxels_done) / len(self.voxels_done)
+        complete = sum(self.voxels_done) / max(1, sum(self.chunk_voxels))
         self.sig_progress.emit(complete)
 
+    def split_args(self, n_workers, args):
+        """
+        Split worker arguments into the chunks chosen by ``_start_chunks``
+        """
+        phase_start = time.time()
+        if self.columns is None:
+            split = engine.split_args(n_workers, args)
+        else:
+            split = engine.split_columns(args, self.columns, self.chunk_bounds)
+        # Arguments are options, data, mask, ...
+        self.chunk_shapes = [worker_args[2].shape for worker_args in split]
+        self.chunk_voxels = [np.count_nonzero(worker_args[2]) for worker_args in split]
+        self.chunk_bytes = [_get_nbytes(worker_args) for worker_args in split]
+        self._profile_phase("chunking", phase_start)
+        return [[worker_id, self._queue] + worker_args for worker_id, worker_args in enumerate(split)]
+
+    def _worker_finished_cb(self, result):
+        # Record when each chunk's output arrived for the IPC timing in the profile
+        worker_id = result[0]
+        if worker_id < len(self.chunk_received):
+            self.chunk_received[worker_id] = time.time()
+        Process._worker_finished_cb(self, result)
+
+    def _get_data_position(self, chunk_idx, pos):
+        """
+        :return: Position in the full data of a voxel position within a chunk
+        """
+        chunk_start = self.chunk_bounds[chunk_idx][0] if self.columns is not None else 0
+        if self.distinct is not None:
+            pos = engine.get_distinct_position(pos, chunk_start, self.columns, self.mask_bb, self.distinct[0])
+            return tuple([int(p + bb_slice.start) for p, bb_slice in zip(pos, self.bb_slices)])
+        return engine.get_data_position(pos, chunk_start, self.columns, self.mask_shape, self.bb_slices)
+
+    def recombine_data(self, data_list):
+        """
+        Recombine worker output in the same way as the headless engine
+        """
+        recombined_data = engine.recombine_data(data_list, getattr(self, "chunk_shapes", None))
+        if self.columns is not None:
+            recombined_data = engine.restore_columns(recombined_data, self.columns, self.mask_shape)
+        if self.distinct is not None:
+            recombined_data = engine.unpack_voxels(recombined_data, self.mask_bb, self.distinct[1])
+        return recombined_data
+
     def finished(self, worker_output):
         """ 
         Add output data to the IVM and set the log 
         """
         if self.status == Process.SUCCEEDED:
-            # Only include log from first process to avoid multiple repetitions
-            for out in worker_output:
+            engine.update_voxel_time(self.timing_key, list(itertools.chain(*worker_output)))
+            self._profile_chunks(worker_output)
+
+            # Only include log from first process to avoid multiple repetitions. Workers
+            # only return a summary of the log but it is still bounded in case of
+            # very long lines
+            for out in itertools.chain(*worker_output):
                 if out and  hasattr(out, "log") and len(out.log) > 0:
-                    # If there was a problem the log could be huge and full of 
-                    # nan messages. So chop it off at some 'reasonable' point
                     self.log(out.log[:MAX_LOG_SIZE])
                     if len(out.log) > MAX_LOG_SIZE:
                         self.log("WARNING: Log was too large - truncated at %i chars" % MAX_LOG_SIZE)
                     break
+            summary = engine.summarise_warnings(worker_output, self._get_data_position)
+            if summary.warnings:
+                self.log("\nWarning summary for all chunks:\n\n" + summary.format_warnings())
+            log_files = [log_file for out in itertools.chain(*worker_output)
+                         for log_file in getattr(getattr(out, "log_summary", None), "files", [])]
+            if len(log_files) > 1:
+                self.log("\nFull logs for %i chunks written to %s\n" % (len(log_files), os.path.dirname(log_files[0])))
             first = True
-            data_keys = []
             self.data_items = []
-            for out in worker_output:
-                if out.data: 
-                    data_keys = out.data.keys()
-            for key in data_keys:
-                self.debug("Recombining data item: %s" % key)
-                recombined_data = self.recombine_data([o.data.get(key, None) for o in worker_output])
-                name = self.output_rename.get(key, key)
-                if key is not None:
-                    self.data_items.append(name)
-                    if recombined_data.ndim == 2:
-                        recombined_data = np.expand_dims(recombined_data, 2)
-
-                    # The processed data was chopped out of the full data set to just include the
-                    # ROI - so now we need to put it back into a full size data set which is otherwise
-                    # zero.
-                    if recombined_data.ndim == 4:
-                        shape4d = list(self.grid.shape) + [recombined_data.shape[3],]
-                        full_data = np.zeros(shape4d, dtype=np.float32)
-                    else:
-                        full_data = np.zeros(self.grid.shape, dtype=np.float32)
-                    full_data[self.bb_slices] = recombined_data.reshape(full_data[self.bb_slices].shape)
-                    self.ivm.add(full_data, grid=self.grid, name=name, make_current=first, roi=False)
-                    first = False
+            pilot_outputs = []
+            region_params = []
+            for idx, variant in enumerate(self.variants):
+                variant_output = [runs[idx] for runs in worker_output]
+                suffix = self._get_variant_suffix(variant)
+                # Not all chunks produce every output, e.g. the failed voxel mask
+                data_keys = []
+                for out in variant_output:
+                    data_keys += [key for key in out.data if key not in data_keys]
+                for key in data_keys:
+                    self.debug("Recombining data item: %s" % key)
+                    phase_start = time.time()
+                    recombined_data = self.recombine_data([o.data.get(key, None) for o in variant_output])
+                    phase_start = self._profile_phase("recombination", phase_start)
+                    name = self.output_rename.get(key, key) + suffix
+                    if self.pilot:
+                        pilot_outputs.append(recombined_data)
+                        if not self.save_pilot:
+                            continue
+                        name += "_pilot"
+                    if key in engine.ROI_OUTPUTS:
+                        full_data = self._add_output_data(recombined_data, name, False, roi=True)
+                        if key == engine.FAILED_OUTPUT:
+                            self.warn("Fabber: %i voxels could not be fitted - see %s" % (np.count_nonzero(full_data), name))
+                    elif key is not None:
+                        full_data = self._add_output_data(recombined_data, name, first)
+                        first = False
+                        if key == "freeEnergy" and len(self.variants) > 1:
+                            free_energy = full_data[self.bb_slices][self.mask_bb > 0]
+                            self.sweep_results.append(dict(variant, **{"freeEnergy" : float(np.mean(free_energy))}))
+                        if self.regions is not None and key.startswith("mean_"):
+                            region_params.append((name, recombined_data[self.mask_bb > 0][self.distinct[0]]))
+                    self._profile_phase("ivm-insertion", phase_start)
+
+            if self.screened is not None and not self.pilot:
+                self._add_output_data(self.screened, engine.SCREENED_OUTPUT, False, roi=True)
+            if self.sweep_results:
+                self._log_sweep_results()
+            if region_params:
+                self._add_region_results(region_params)
+            if self.pilot:
+                self._log_pilot_report(worker_output, pilot_outputs)
+            self._log_profile()
         else:
             # Include the log of the first failed process
             for out in worker_output:
@@ -239,56 +684,673 @@ class FabberProcess(Process):
                     self.log(out.log)
                     break
 
+    def _add_partial_output(self, worker_output):
+        """
+        Add the outputs of chunks which completed before the run was cancelled
+
+        :param worker_output: Output of each chunk, None for chunks which did not complete
+        """
+        done = [runs is not None for runs in worker_output]
+        if not any(done) or self.columns is None:
+            return
+
+        self.data_items = []
+        for idx, variant in enumerate(self.variants):
+            variant_output = [runs[idx] if runs is not None else None for runs in worker_output]
+            suffix = self._get_variant_suffix(variant)
+            data_keys = []
+            for out in variant_output:
+                if out is not None:
+                    data_keys += [key for key in out.data if key not in data_keys]
+            for key in data_keys:
+                recombined_data = self.recombine_data([out.data.get(key, None) if out is not None else None
+                                                       for out in variant_output])
+                self._add_output_data(recombined_data, self.output_rename.get(key, key) + suffix, False,
+                                      roi=key in engine.ROI_OUTPUTS)
+
+        completed = self.recombine_data([np.ones(shape[:3], dtype=np.int32) if chunk_done else None
+                                         for shape, chunk_done in zip(self.chunk_shapes, done)])
+        completed = self._add_output_data(completed * (self.mask_bb > 0), PARTIAL_OUTPUT, False, roi=True)
+        self.warn("Fabber run cancelled - outputs only include the %i voxels in %s" % (np.count_nonzero(completed), PARTIAL_OUTPUT))
+
+    def _start_profile(self):
+        """
+        Start recording the performance profile for a run
+
+        The profile contains the time spent in each phase of the run, statistics
+        for each chunk and a summary. Times are in seconds
+        """
+        self.profile = {"phases" : {}, "chunks" : [], "summary" : {}}
+        self.profile_start = time.time()
+
+    def _profile_phase(self, phase, start):
+        """
+        Add the time since ``start`` to a phase of the profile
+
+        :return: Current time, so consecutive phases can be chained
+        """
+        now = time.time()
+        phases = self.profile["phases"]
+        phases[phase] = phases.get(phase, 0) + now - start
+        return now
+
+    def _profile_chunks(self, worker_output):
+        """
+        Add statistics for each chunk to the profile
+
+        Queue time is from submitting the chunk until the worker starts fitting
+        it, which includes waiting for a free worker and transferring the input.
+        Return time is from the end of fitting until the output is received
+        """
+        self._profile_phase("fitting", self.chunk_submitted)
+        chunks = []
+        for worker_id, runs in enumerate(worker_output):
+            stats = [run.stats for run in runs if getattr(run, "stats", None)]
+            chunk = {
+                "voxels" : int(self.chunk_voxels[worker_id]),
+                "input-bytes" : self.chunk_bytes[worker_id],
+                "output-bytes" : sum([_get_nbytes(run.data.values()) for run in runs]),
+                "fit-time" : sum([stat["fit-time"] for stat in stats]),
+            }
+            if stats:
+                chunk["api-load-time"] = stats[0]["api-load-time"]
+                chunk["queue-time"] = stats[0]["start-time"] - self.chunk_submitted
+                if self.chunk_received[worker_id] is not None:
+                    chunk["return-time"] = self.chunk_received[worker_id] - stats[-1]["end-time"]
+            chunks.append(chunk)
+
+        fit_times = [chunk["fit-time"] for chunk in chunks]
+        self.profile["chunks"] = chunks
+        self.profile["summary"].update({
+            "chunk-fit-time" : {"total" : sum(fit_times), "max" : max(fit_times), "mean" : float(np.mean(fit_times))},
+            "chunk-api-load-time" : sum([chunk.get("api-load-time", 0) for chunk in chunks]),
+            "chunk-return-time" : max([chunk.get("return-time", 0) for chunk in chunks]),
+            "input-bytes" : sum([chunk["input-bytes"] for chunk in chunks]),
+            "output-bytes" : sum([chunk["output-bytes"] for chunk in chunks]),
+        })
+
+    def _log_profile(self):
+        """
+        Write the performance profile to the log as JSON. Per-chunk statistics are
+        only included in the ``profile`` attribute
+        """
+        self.profile["summary"]["total-time"] = time.time() - self.profile_start
+        report = {"phases" : self.profile["phases"], "summary" : self.profile["summary"]}
+        self.log("\nPerformance profile:\n%s\n" % json.dumps(report, indent=2, sort_keys=True, default=float))
+
+    def _log_pilot_report(self, worker_output, pilot_outputs):
+        """
+        Predict the cost of fitting all unmasked voxels from a pilot run and write it to the log
+
+        The prediction assumes the fitting time per voxel and the worker memory used per
+        voxel of input and output are the same as for the pilot sample. Output size is for
+        uncompressed data. The report is stored in the ``pilot_report`` attribute. Times
+        are in seconds and sizes in bytes
+        """
+        runs = [run for run in itertools.chain(*worker_output) if getattr(run, "stats", None)]
+        pilot_voxels = max(1, int(self.voxels_todo))
+        total_voxels = int(np.count_nonzero(self.full_mask_bb))
+        voxel_time = sum([run.stats["fit-time"] for run in runs]) / pilot_voxels
+        api_load_time = max([run.stats["api-load-time"] for run in runs] + [0])
+        worker_rss = max([run.stats["peak-rss"] or 0 for run in runs] + [0])
+        # Chunks contain whole columns of voxels so memory is estimated per voxel position
+        chunk_sizes = [int(np.prod(shape[:3])) for shape in self.chunk_shapes]
+        position_bytes = float(sum(self.chunk_bytes) + self.profile["summary"].get("output-bytes", 0)) / sum(chunk_sizes)
+
+        # Largest chunk of the full run determines the worker memory needed
+        if self.columns is None:
+            n_parallel, max_chunk_size = 1, self.full_mask_bb.size
+        else:
+            _, voxel_counts = engine.get_columns(self.full_mask_bb)
+            bounds = engine.schedule_chunks(voxel_counts, self.max_workers, voxel_time)
+            n_parallel = min(self.max_workers, len(bounds))
+            max_chunk_size = max([end - start for start, end in bounds]) * self.full_mask_bb.shape[2]
+
+        grid_voxels = int(np.prod(self.grid.shape))
+        output_bytes = 0
+        for output in pilot_outputs:
+            n_vols = int(np.prod(output.shape[3:])) if output.ndim > 3 else 1
+            output_bytes += grid_voxels * n_vols * output.dtype.itemsize
+
+        # The main process holds both the worker outputs and the full size output data
+        worker_memory = worker_rss + position_bytes * max(0, max_chunk_size - max(chunk_sizes))
+        main_memory = (peak_rss() or 0) + 2 * output_bytes
+        self.pilot_report = {
+            "pilot-voxels" : pilot_voxels,
+            "total-voxels" : total_voxels,
+            "workers" : n_parallel,
+            "time-per-voxel" : voxel_time,
+            "predicted-wall-time" : api_load_time + voxel_time * total_voxels / n_parallel,
+            "predicted-peak-memory" : int(main_memory + n_parallel * worker_memory),
+            "predicted-output-bytes" : int(output_bytes),
+        }
+        self.log("\nPilot run estimate for full run:\n%s\n" % json.dumps(self.pilot_report, indent=2, sort_keys=True))
+
+    def _add_output_data(self, recombined_data, name, make_current, roi=False):
+        """
+        Add a recombined output data item to the IVM
+
+        :return: Full size Numpy array which was added
+        """
+        self.data_items.append(name)
+        full_data = engine.expand_data(recombined_data, self.grid.shape, self.bb_slices)
+        if roi:
+            full_data = full_data.astype(np.int32)
+        self.ivm.add(full_data, grid=self.grid, name=name, make_current=make_current, roi=roi)
+        return full_data
+
+    def _get_sweep_variants(self, sweep):
+        """
+        :param sweep: Mapping from option name to sequence of values, or None
+        :return: List of option dictionaries, one for each combination of values
+        """
+        if not sweep:
+            return [{}]
+        elif not isinstance(sweep, dict):
+            raise QpException("Parameter sweep must be given as a mapping from option name to list of values")
+
+        keys = sorted(sweep.keys())
+        values = []
+        for key in keys:
+            key_values = sweep[key]
+            if not isinstance(key_values, (list, tuple)):
+                key_values = [key_values,]
+            if not key_values:
+                raise QpException("No values given for swept option '%s'" % key)
+            values.append(key_values)
+
+        return [dict(zip(keys, combination)) for combination in itertools.product(*values)]
+
+    def _get_variant_suffix(self, variant):
+        """
+        :return: Suffix to add to output names for a parameter sweep variant
+        """
+        if len(self.variants) == 1:
+            return ""
+        suffix = "".join(["_%s_%s" % (key, variant[key]) for key in sorted(variant.keys())])
+        return re.sub(r"[^A-Za-z0-9_]", "_", suffix)
+
+    def _log_sweep_results(self):
+        """
+        Log the free energy comparison table for a parameter sweep and add it to the IVM
+        """
+        keys = sorted(self.variants[0].keys())
+        col_headers = keys + ["Mean free energy", "Rank"]
+        ranked = sorted(self.sweep_results, key=lambda result: -result["freeEnergy"])
+        rows = []
+        for result in self.sweep_results:
+            rows.append([result[key] for key in keys] + [result["freeEnergy"], ranked.index(result) + 1])
+
+        self.log("\nParameter sweep free energy comparison:\n\n")
+        self.log("\t".join(col_headers) + "\n")
+        for row in rows:
+            self.log("\t".join([str(value) for value in row]) + "\n")
+        self.log("\nBest variant: %s\n" % ", ".join(["%s=%s" % (key, ranked[0][key]) for key in keys]))
+        self.ivm.add_extra(self.sweep_output, MatrixExtra(self.sweep_output, rows, col_headers=col_headers))
+
+    def _add_region_results(self, region_params):
+        """
+        Add the table of mean parameter values in each region to the IVM
+
+        :param region_params: Sequence of tuples of output name, value for each region
+        """
+        counts = np.bincount(self.distinct[1], minlength=len(self.regions))
+        col_headers = ["Region", "Voxels"] + [name for name, _ in region_params]
+        rows = []
+        for idx, label in enumerate(self.regions):
+            rows.append([label.item(), int(counts[idx])] + [float(values[idx]) for _, values in region_params])
+        self.ivm.add_extra(self.region_output, MatrixExtra(self.region_output, rows, col_headers=col_headers))
+
     def output_data_items(self):
         """ :return: List of names of data items Fabber is expecting to produce """
         return self.data_items
 
+class FabberPreview(object):
+    """
+    Fits the voxels around a single position in the current process, giving a quick
+    preview of the effect of the current options without running ``FabberProcess``
+
+    API objects are kept for each model group, and additional data items are
+    resampled using the same cache as ``FabberProcess``, so repeated previews
+    only pay the cost of the fit itself
+
+    ``prepare`` reads the data from the IVM so must be called in the GUI thread,
+    while ``run_prepared`` only uses the arrays it is given so the fit can be run
+    in a background thread
+    """
+
+    #: Options used by FabberProcess which are not passed to Fabber
+    PROCESS_OPTIONS = ["roi", "mask", "output-rename", "num-workers", "cpu-budget", "threads-per-worker",
+                       "pin-workers", "sweep", "sweep-output", "pilot", "save-pilot", "retry-failed",
+                       "retry-options", "log-dir", "save-warning-mask", "save-runtime-map", "backend",
+                       "remote-hosts", "remote-authkey", "keep-partial", "priority", "screen-voxels",
+                       "dedupe-voxels", "region-mode", "region-output"]
+
+    def __init__(self, ivm):
+        self.ivm = ivm
+        self._apis = {}
+
+    def fit(self, options, pos, grid=None, radius=0):
+        """
+        Fit the voxels within ``radius`` of a position
+
+        :param options: FabberProcess options. The ``data`` option must name a single data item
+        :param pos: Position of the voxel to preview
+        :param grid: Grid which ``pos`` is relative to. If not given, the grid of the main data is used
+        :param radius: Size of the neighbourhood to fit around the voxel, e.g. for spatial priors
+        :return: Dictionary containing the data (``data``) and model prediction (``modelfit``)
+                 timeseries at the voxel and the values of each model parameter (``params``),
+                 or None if the position is outside the data
+        """
+        prepared = self.prepare(options, pos, grid, radius)
+        if prepared is None:
+            return None
+        return self.run_prepared(prepared)
+
+    def prepare(self, options, pos, grid=None, radius=0):
+        """
+        Extract the data and resolve the options for a preview fit. Takes the same
+        arguments as ``fit``
+
+        :return: Tuple of API object, Fabber options containing the data arrays and the
+                 position of the voxel within the data, or None if the position is outside
+                 the data
+        """
+        options = dict(options)
+        data_name = options.pop("data", None)
+        if isinstance(data_name, (list, tuple)):
+            data_name = data_name[0] if len(data_name) == 1 else None
+        qpdata = self.ivm.data.get(data_name, None)
+        if qpdata is None:
+            raise QpException("Preview requires a single main data item")
+
+        if grid is not None and not grid.matches(qpdata.grid):
+            pos = qpdata.grid.world_to_grid(grid.grid_to_world(list(pos[:3])))
+        pos = [int(round(p)) for p in pos[:3]]
+        if any([p < 0 or p >= size for p, size in zip(pos, qpdata.grid.shape)]):
+            return None
+        slices = tuple([slice(max(0, p - radius), min(size, p + radius + 1)) for p, size in zip(pos, qpdata.grid.shape)])
+        centre = tuple([p - slc.start for p, slc in zip(pos, slices)])
+
+        for key in self.PROCESS_OPTIONS:
+            options.pop(key, None)
+        options["method"] = options.get("method", "vb")
+        options["noise"] = options.get("noise", "white")
+        options.update({"save-mean" : True, "save-model-fit" : True})
+        for key in list(options.keys()):
+            if options[key] is None:
+                options[key] = True
+
+        model_group = options.pop("model-group", None)
+        api = self._apis.get(model_group, None)
+        if api is None:
+            api = FabberProcess.api(model_group)
+            self._apis[model_group] = api
+
+        known_options = FabberProcess.get_options(generic=True, model=options.get("model", None), method=options["method"])[0]
+        for key in list(options.keys()):
+            if api.is_data_option(key, known_options):
+                data_option = self.ivm.data.get(options[key], None)
+                if data_option is None:
+                    raise QpException("Fabber option '%s' expected data item but data set '%s' not found" % (key, options[key]))
+                options[key] = np.array(_RESAMPLE_CACHE.get(data_option, qpdata.grid)[slices])
+
+        # Copies are passed to the fit so it does not share arrays with the IVM
+        main_data = np.array(qpdata.raw()[slices])
+        options["data"] = main_data
+        options["mask"] = np.ones(main_data.shape[:3], dtype=np.int32)
+        return api, options, centre
+
+    @staticmethod
+    def run_prepared(prepared):
+        """
+        Run a preview fit prepared by ``prepare``
+
+        :return: Dictionary as returned by ``fit``
+        """
+        api, options, centre = prepared
+        main_data = options["data"]
+        run = api.run(options)
+
+        params = {}
+        for key, value in run.data.items():
+            if key.startswith("mean_"):
+                params[key[5:]] = float(value[centre])
+        return {
+            "data" : main_data[centre],
+            "modelfit" : run.data["modelfit"][centre],
+            "params" : params,
+        }
+
+def _get_nbytes(items):
+    """
+    :return: Total size in bytes of the Numpy arrays in a sequence
+    """
+    return int(sum([item.nbytes for item in items if isinstance(item, np.ndarray)]))
+
+def _get_param_grid(param_test_values):
+    """
+    Get the combinations of parameter values needed to generate test data, reporting
+    invalid test values as a QpException
+    """
+    try:
+        return engine.get_param_grid(param_test_values)
+    except ValueError as exc:
+        raise QpException(str(exc))
+
+class FabberSimStudyProcess(FabberProcess):
+    """
+    Simulation study which generates test data from a Fabber model for a grid of parameter
+    values with multiple noise realisations, fits the model to it and reports the bias
+    and variance of the recovered parameters together with the fitting throughput and
+    memory use
+
+    No input data is required so this can be used as a self-contained accuracy and
+    performance regression benchmark for any installed model
+
+    The model is evaluated in parallel chunks in background workers, as by
+    ``FabberTestDataProcess``, and the fit is started when all the evaluations
+    have completed. Both phases use the same CPUs allocated by the job queue
+    """
+
+    PROCESS_NAME = "FabberSimStudy"
+
+    def __init__(self, ivm, **kwargs):
+        FabberProcess.__init__(self, ivm, **kwargs)
+        self._evaluating = False
+        self.evaluations_done = []
+
+    def run(self, options):
+        """ Generate the simulated data and start fitting it """
+        # Remaining options are passed to Fabber - clean out the original to avoid
+        # warnings in batch mode as for FabberProcess
+        new_options = options.copy()
+        for key in list(options.keys()):
+            options.pop(key)
+        options = new_options
+
+        param_test_values = options.pop("param-test-values", None)
+        self.num_voxels = int(options.pop("num-voxels", 100))
+        nt = options.pop("num-vols", 10)
+        noise = options.pop("noise", 0)
+        self.num_repeats = int(options.pop("num-repeats", 10))
+        seed = options.pop("seed", None)
+        self.output_name = options.pop("output-name", "fabber_sim_study")
+        max_workers = options.pop("num-workers", None)
+        self._get_cpu_options(options)
+
+        self._start_profile()
+        if not param_test_values:
+            raise QpException("No test values given for model parameters")
+        if self.num_repeats < 1 or self.num_voxels < 1:
+            raise QpException("Number of voxels and noise realisations must be at least 1")
+
+        options["method"] = options.get("method", "vb")
+        options["noise"] = options.get("noise", "white")
+        options["save-mean"] = True
+        for key in options.keys():
+            if options[key] is None:
+                options[key] = True
+
+        self.param_names, self.param_values, _, _ = _get_param_grid(param_test_values)
+        options["fabber-dirs"] = get_plugins(key="fabber-dirs")
+        self._sim_args = (options, nt, noise, seed, max_workers)
+
+        # Evaluate the model once for each combination of parameter values when the
+        # job queue has allocated CPUs to the run
+        self.max_workers = engine.get_pool_size(None, max_workers, self.cpu_budget, self.threads_per_worker)
+        self._evaluating = True
+        self.status = Process.RUNNING
+        job = jobs.Job(self, self._start_evaluation, self.max_workers * self.threads_per_worker,
+                       self.threads_per_worker, self.priority, name="%s: %s" % (self.PROCESS_NAME, options.get("model", None)))
+        jobs.get_job_queue().submit(job, run_now=getattr(self, "_sync", False))
+
+    def _start_evaluation(self, cpus):
+        """
+        Start evaluating the model in parallel chunks using the CPUs allocated by the job queue
+        """
+        if self.status != Process.RUNNING:
+            return
+        self._allocated = cpus
+        self.max_workers = max(1, min(self.max_workers, cpus // self.threads_per_worker))
+        options, nt, _, _, _ = self._sim_args
+        n_chunks = min(self.max_workers, len(self.param_values))
+        self.evaluations_done = [0, ] * n_chunks
+        self.chunk_received = [None, ] * n_chunks
+        self._local_worker_fn = _evaluate_model
+        try:
+            self.start_bg([options, self.param_names, self.param_values, nt], n_workers=n_chunks)
+        except Exception as exc:
+            # Not called from execute() so failures must be reported here
+            self.status = Process.FAILED
+            self.exception = exc
+            self._complete()
+            return
+
+        if getattr(self, "_sync", False) and self.status == Process.SUCCEEDED:
+            self._start_fit()
+
+    def split_args(self, n_workers, args):
+        """
+        Split the parameter values between the workers while the model is being evaluated
+        """
+        if not self._evaluating:
+            return FabberProcess.split_args(self, n_workers, args)
+        # Workers remove options so each needs its own copy when they are not run in separate processes
+        return [[worker_id, self._queue, dict(worker_args[0])] + worker_args[1:]
+                for worker_id, worker_args in enumerate(engine.split_args(n_workers, args))]
+
+    def timeout(self, queue):
+        """
+        Report the fraction of model evaluations completed while the model is being evaluated
+        """
+        if not self._evaluating:
+            return FabberProcess.timeout(self, queue)
+        if queue.empty(): return
+        while not queue.empty():
+            worker_id, done, _ = queue.get()
+            if worker_id < len(self.evaluations_done):
+                self.evaluations_done[worker_id] = done
+        self.sig_progress.emit(float(sum(self.evaluations_done)) / len(self.param_values))
+
+    def _worker_finished_cb(self, result):
+        if self._evaluating:
+            # The base class checks for missing output using 'in' which does not work
+            # for Numpy arrays, so pass each worker's model evaluations in a list
+            worker_id, success, output = result
+            result = (worker_id, success, [output] if success else output)
+        FabberProcess._worker_finished_cb(self, result)
+
+    @QtCore.Slot()
+    def _complete(self):
+        """
+        Start the fit when the model evaluation has completed. Called in the GUI thread
+        """
+        if self._evaluating and self.status == Process.SUCCEEDED:
+            self._start_fit()
+        else:
+            FabberProcess._complete(self)
+
+    def _start_fit(self):
+        """
+        Generate the simulated data from the model evaluations and start fitting it
+        """
+        options, nt, noise, seed, max_workers = self._sim_args
+        self._evaluating = False
+        self._local_worker_fn = _run_fabber
+        curves = np.concatenate([output[0] for output in self._worker_output], 0)
+        timer = getattr(self, "_timer", None)
+        if timer is not None:
+            timer.cancel()
+        pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.close()
+
+        # Simulated data has one row of voxels for each combination and noise realisation. Voxels
+        # are fitted independently so there is no need for a spatial arrangement
+        ncombinations = len(self.param_values)
+        data = np.repeat(curves, self.num_repeats * self.num_voxels, axis=0)
+        if noise is not None and noise > 0:
+            data += np.random.RandomState(seed).normal(0, noise, data.shape).astype(np.float32)
+        data = data.reshape((ncombinations * self.num_repeats, self.num_voxels, 1, nt))
+        mask = np.ones(data.shape[:3], dtype=np.int32)
+
+        options["indir"] = self.indir
+        self.fit_start = time.time()
+        try:
+            self._start_chunks([options, data, mask], mask, [options["method"]], max_workers,
+                               (options.get("model", None), options["method"]), allocated=self._allocated)
+        except Exception as exc:
+            # Not called from execute() so failures must be reported here
+            self.status = Process.FAILED
+            self.exception = exc
+            FabberProcess._complete(self)
+
+    def finished(self, worker_output):
+        """
+        Calculate bias and variance of the fitted parameters and performance metrics
+        """
+        if self.status != Process.SUCCEEDED:
+            return
+
+        fit_time = time.time() - self.fit_start
+        runs = [out[0] for out in worker_output]
+        ncombinations = len(self.param_values)
+
+        # Voxels which could not be fitted are excluded from the statistics
+        failed = [run.data.get(engine.FAILED_OUTPUT, None) for run in runs]
+        if any([chunk is not None for chunk in failed]):
+            failed = self.recombine_data(failed).reshape((ncombinations, -1)) > 0
+        else:
+            failed = np.zeros((ncombinations, self.num_repeats * self.num_voxels), dtype=bool)
+
+        col_headers = self.param_names + ["Parameter", "True value", "Mean estimate", "Bias", "Variance"]
+        rows = []
+        self.results = {"parameters" : [], "failed-voxels" : int(np.count_nonzero(failed))}
+        for idx, param in enumerate(self.param_names):
+            estimates = self.recombine_data([run.data.get("mean_%s" % param, None) for run in runs])
+            estimates = estimates.reshape((ncombinations, -1))
+            for values, param_estimates, param_failed in zip(self.param_values, estimates, failed):
+                param_estimates = param_estimates[~param_failed]
+                true_value = float(values[idx])
+                mean = float(np.mean(param_estimates))
+                variance = float(np.var(param_estimates))
+                rows.append([float(value) for value in values] + [param, true_value, mean, mean - true_value, variance])
+                self.results["parameters"].append({
+                    "values" : dict(zip(self.param_names, [float(value) for value in values])),
+                    "param" : param,
+                    "true" : true_value,
+                    "mean" : mean,
+                    "bias" : mean - true_value,
+                    "variance" : variance,
+                })
+
+        worker_rss = [run.stats["peak-rss"] for run in runs if getattr(run, "stats", None) and run.stats["peak-rss"] is not None]
+        self.results["performance"] = {
+            "voxels" : self.voxels_todo,
+            "fit-time" : fit_time,
+            "voxels-per-second" : self.voxels_todo / fit_time if fit_time > 0 else 0,
+            "worker-fit-time" : sum([run.stats["fit-time"] for run in runs if getattr(run, "stats", None)]),
+            "worker-peak-rss" : max(worker_rss) if worker_rss else None,
+            "peak-rss" : peak_rss(),
+        }
+
+        self.log("\nSimulation study: %i parameter combinations, %i noise realisations, %i voxels each\n\n"
+                 % (ncombinations, self.num_repeats, self.num_voxels))
+        if self.results["failed-voxels"]:
+            self.log("WARNING: %i voxels could not be fitted and were excluded\n\n" % self.results["failed-voxels"])
+        self.log("\t".join(col_headers) + "\n")
+        for row in rows:
+            self.log("\t".join([str(value) for value in row]) + "\n")
+        self.log("\nPerformance:\n\n")
+        for key, value in self.results["performance"].items():
+            self.log("%s: %s\n" % (key, value))
+
+        self.ivm.add_extra(self.output_name, MatrixExtra(self.output_name, rows, col_headers=col_headers))
+        perf_rows = [[key, value] for key, value in self.results["performance"].items()]
+        self.ivm.add_extra(self.output_name + "_performance",
+                           MatrixExtra(self.output_name + "_performance", perf_rows, col_headers=["Metric", "Value"]))
+
 class FabberTestDataProcess(Process):
     """
     Process which generates test data by evaluating a Fabber model on specified parameter values
     with optional noise
+
+    The model is evaluated once for each combination of parameter values, in parallel chunks
+    across worker processes. The clean signal is then replicated across each patch, so
+    multiple noise realisations (``num-repeats``) can be generated without re-evaluating
+    the model
     """
 
     PROCESS_NAME = "FabberTestData"
 
     def __init__(self, ivm, **kwargs):
-        Process.__init__(self, ivm, **kwargs)
+        Process.__init__(self, ivm, worker_fn=_evaluate_model, **kwargs)
 
     def run(self, options):
         """ Generate test data from Fabber model """
-        kwargs = {
-            "patchsize" : int(math.floor(options.pop("num-voxels", 1000) ** (1. / 3) + 0.5)),
-            "nt" : options.pop("num-vols", 10),
-            "noise" : options.pop("noise", 0),
-            "param_rois" : options.pop("save-rois", False),
-        }
+        self.patchsize = int(math.floor(options.pop("num-voxels", 1000) ** (1. / 3) + 0.5))
+        nt = options.pop("num-vols", 10)
+        self.noise = options.pop("noise", 0)
+        self.param_rois = options.pop("save-rois", False)
+        self.num_repeats = int(options.pop("num-repeats", 1))
+        self.seed = options.pop("seed", None)
+        n_workers = options.pop("num-workers", multiprocessing.cpu_count())
         param_test_values = options.pop("param-test-values", None)
-        output_name = options.pop("output-name", "fabber_test_data")
+        self.output_name = options.pop("output-name", "fabber_test_data")
         grid_data_name = options.pop("grid", None)
 
         if not param_test_values:
             raise QpException("No test values given for model parameters")
+        if self.num_repeats < 1:
+            raise QpException("Number of noise realisations must be at least 1")
 
-        api = FabberProcess.api(options.pop("model-group", None))
-        from fabber import generate_test_data
-        test_data = generate_test_data(api, options, param_test_values, **kwargs)
-        
-        data = test_data["data"]
-        self.debug("Data shape: %s", data.shape)
+        param_names, param_values, self.dim_params, self.dim_sizes = _get_param_grid(param_test_values)
+        shape = [size * self.patchsize for size in self.dim_sizes]
+        self.debug("Data shape: %s", shape)
 
         if grid_data_name is None:
-            grid = DataGrid(data.shape[:3], np.identity(4))
+            self.grid = DataGrid(shape, np.identity(4))
         else:
             grid_data = self.ivm.data.get(grid_data_name, None)
             if grid_data is None:
                 raise QpException("Data not found for output grid: %s" % grid_data_name)
-            grid = grid_data.grid
+            self.grid = grid_data.grid
 
-        self.ivm.add(data, name=output_name, grid=grid, make_current=True)
+        options["fabber-dirs"] = get_plugins(key="fabber-dirs")
+        n_workers = max(1, min(n_workers, len(param_values)))
+        self.evals_done = [0, ] * n_workers
+        self.start_bg([options, param_names, param_values, nt], n_workers=n_workers)
+
+    def timeout(self, queue):
+        """
+        Check the queue and emit sig_progress
+        """
+        if queue.empty(): return
+        while not queue.empty():
+            worker_id, done, todo = queue.get()
+            if worker_id < len(self.evals_done):
+                self.evals_done[worker_id] = float(done) / todo
+        self.sig_progress.emit(sum(self.evals_done) / len(self.evals_done))
+
+    def finished(self, worker_output):
+        """
+        Replicate the model evaluations into patches, add noise and add the output to the IVM
+        """
+        if self.status != Process.SUCCEEDED:
+            return
+
+        curves = np.concatenate(worker_output, 0)
+        test_data = engine.make_test_data(curves, self.dim_params, self.dim_sizes, self.patchsize, self.noise,
+                                          self.num_repeats, self.seed, self.param_rois)
+        for rep, data in enumerate(test_data["data"]):
+            if self.num_repeats == 1:
+                name = self.output_name
+            else:
+                name = "%s_%i" % (self.output_name, rep+1)
+            self.ivm.add(data, name=name, grid=self.grid, make_current=(rep == 0))
 
-        clean_data = test_data.get("clean", None)
-        if clean_data is not None:
-            self.ivm.add(clean_data, name="%s_clean" % output_name, grid=grid, make_current=False)
+        self.ivm.add(test_data["clean"], name="%s_clean" % self.output_name, grid=self.grid, make_current=False)
 
         for param, param_roi in test_data.get("param-rois", {}).items():
-            self.ivm.add(param_roi, name="%s_roi_%s" % (output_name, param), grid=grid)
+            self.ivm.add(param_roi, name="%s_roi_%s" % (self.output_name, param), grid=self.grid)
@@ -0,0 +1,347 @@
+"""
+Quantiphyse: Remote execution backend for Fabber
+
+Voxel chunks can be fitted on other machines by running a Fabber worker
+server on each node::
+
+    python -m quantiphyse_fabber.remote --port 5000 --authkey secret
+
+and selecting the remote backend in the Fabber options::
+
+    backend: remote
+    remote-hosts: [node1:5000, node2:5000]
+    remote-authkey: secret
+
+Chunks are dispatched from the coordinating process by a ``RemotePool``
+with one dispatching thread for each host, so the number of chunks fitted
+at once is set by the number of hosts rather than the local CPUs. Each chunk
+is sent to the next free host over a TCP connection. Progress is streamed
+back while the chunk is being fitted and the outputs are returned when it
+completes. If a host cannot be reached or drops the connection it is not used
+again for the run and the chunk is retried on another host. Errors raised by
+Fabber itself (e.g. invalid options) are not retried.
+
+Remote nodes load models from their own Fabber installation, so the same
+model libraries must be installed on every node. ``LocalWorkers`` starts
+servers on the local machine which is useful for testing.
+
+Copyright (c) 2016-2017 University of Oxford, Martin Craig
+"""
+
+import sys
+import os
+import logging
+import argparse
+import threading
+import multiprocessing
+import multiprocessing.pool
+from multiprocessing.connection import Listener, Client
+
+from .engine import _run_fabber, Cancelled, FABBER_DIR
+
+LOG = logging.getLogger(__name__)
+
+#: Environment variable used for the authentication key if not given in the options
+AUTHKEY_ENV = "FABBER_REMOTE_AUTHKEY"
+
+#: Options which only apply to the coordinating machine and are not sent to remote nodes
+LOCAL_OPTIONS = ["backend", "remote-hosts", "remote-authkey", "indir", "fabber-dirs"]
+
+#: Interval in seconds at which dispatching threads waiting for a host check for cancellation
+HOST_WAIT_INTERVAL = 0.1
+
+class _ConnectionQueue(object):
+    """
+    Stand-in for the progress queue used by local workers, which
+    sends progress updates back to the coordinator
+    """
+    def __init__(self, conn):
+        self._conn = conn
+
+    def put(self, item):
+        self._conn.send(("progress", item))
+
+def parse_host(host):
+    """
+    :param host: Host specification, either ``host:port`` or a ``(host, port)`` sequence
+    :return: Tuple of host name, port number
+    """
+    if isinstance(host, (list, tuple)):
+        return str(host[0]), int(host[1])
+    hostname, sep, port = str(host).rpartition(":")
+    if not sep or not hostname:
+        raise ValueError("Remote host must be given as host:port - got '%s'" % host)
+    return hostname, int(port)
+
+def _get_authkey(authkey):
+    if authkey is None:
+        authkey = os.environ.get(AUTHKEY_ENV, None)
+    if not authkey:
+        raise ValueError("Authentication key required for remote Fabber workers - set remote-authkey or %s" % AUTHKEY_ENV)
+    if not isinstance(authkey, bytes):
+        authkey = authkey.encode("utf-8")
+    return authkey
+
+def get_backend(options):
+    """
+    Remove the backend options from a set of Fabber options
+
+    :return: None for the local backend, or ``RemotePool`` keyword arguments (hosts
+             and authentication key) for the remote backend
+    """
+    backend = options.pop("backend", "local")
+    hosts = options.pop("remote-hosts", None)
+    authkey = options.pop("remote-authkey", None)
+    if backend == "local":
+        return None
+    elif backend != "remote":
+        raise ValueError("Unknown Fabber backend: %s" % backend)
+
+    hosts = [parse_host(host) for host in hosts or []]
+    if not hosts:
+        raise ValueError("No remote hosts given for remote Fabber backend")
+    return {"hosts" : hosts, "authkey" : _get_authkey(authkey)}
+
+class RemotePool(object):
+    """
+    Pool which fits chunks on remote hosts, dispatched from the coordinating process
+
+    Provides the subset of the ``multiprocessing.Pool`` interface used to run
+    workers. Each chunk is run by ``run_chunk`` in one of a set of dispatching
+    threads, one for each host, and is sent to whichever host is free.
+    """
+
+    def __init__(self, hosts, authkey, cancel_event=None):
+        """
+        :param hosts: Sequence of (host, port) tuples
+        :param authkey: Authentication key as bytes
+        :param cancel_event: Optional event which is set to cancel the run
+        """
+        self.hosts = list(hosts)
+        self.authkey = authkey
+        self._cancel_event = cancel_event
+        self._free = list(self.hosts)
+        self._live = set(self.hosts)
+        self._terminated = False
+        self._cond = threading.Condition()
+        self._pool = multiprocessing.pool.ThreadPool(len(self.hosts))
+
+    def apply_async(self, func, args=(), kwds=None, callback=None, error_callback=None):
+        """
+        Run a function in a dispatching thread, normally ``run_chunk``
+        """
+        return self._pool.apply_async(func, args, kwds or {}, callback=callback, error_callback=error_callback)
+
+    def close(self):
+        self._pool.close()
+
+    def join(self):
+        self._pool.join()
+
+    def terminate(self):
+        """
+        Stop dispatching chunks. Dispatching threads stop waiting for the hosts
+        within ``HOST_WAIT_INTERVAL`` and the hosts' results are ignored
+        """
+        with self._cond:
+            self._terminated = True
+            self._cond.notify_all()
+        self._pool.terminate()
+
+    def run_chunk(self, worker_id, queue, options, main_data, roi, *add_data):
+        """
+        Fit a chunk of data on the next free remote host
+
+        Takes the same arguments as ``engine._run_fabber`` and returns the same output
+        """
+        remote_options = dict([(key, value) for key, value in options.items() if key not in LOCAL_OPTIONS])
+        tried, errors = [], []
+        while True:
+            address = self._acquire(tried)
+            if address is None:
+                break
+            tried.append(address)
+            try:
+                result = self._run_on_host(address, worker_id, queue, remote_options, main_data, roi, add_data)
+                self._release(address)
+                return result
+            except Cancelled as exc:
+                self._release(address)
+                return worker_id, False, exc
+            except (EOFError, IOError, OSError) as exc:
+                self._release(address, failed=True)
+                if self._cancelled():
+                    break
+                LOG.warning("Remote Fabber worker %s:%i failed: %s - retrying on another host", address[0], address[1], exc)
+                errors.append("%s:%i: %s" % (address[0], address[1], exc))
+
+        if self._cancelled():
+            return worker_id, False, Cancelled("Fabber run was cancelled")
+        return worker_id, False, RuntimeError("Chunk %i failed on all remote hosts\n%s" % (worker_id, "\n".join(errors)))
+
+    def _cancelled(self):
+        return self._terminated or (self._cancel_event is not None and self._cancel_event.is_set())
+
+    def _acquire(self, exclude):
+        """
+        Wait for a free host which has not already been tried
+
+        :return: (host, port) tuple, or None if there are no working hosts left to try or
+                 the run has been cancelled
+        """
+        with self._cond:
+            while not self._cancelled():
+                free = [address for address in self._free if address not in exclude]
+                if free:
+                    self._free.remove(free[0])
+                    return free[0]
+                if not self._live.difference(exclude):
+                    return None
+                self._cond.wait(HOST_WAIT_INTERVAL)
+        return None
+
+    def _release(self, address, failed=False):
+        """
+        Return a host to the pool. Hosts which failed are not used again
+        """
+        with self._cond:
+            if failed:
+                self._live.discard(address)
+            else:
+                self._free.append(address)
+            self._cond.notify_all()
+
+    def _run_on_host(self, address, worker_id, queue, options, main_data, roi, add_data):
+        conn = Client(address, authkey=self.authkey)
+        try:
+            conn.send(("run", worker_id, options, main_data, roi, add_data))
+            while True:
+                if not conn.poll(HOST_WAIT_INTERVAL):
+                    if self._cancelled():
+                        raise Cancelled("Fabber run was cancelled")
+                    continue
+                msg = conn.recv()
+                if msg[0] == "progress":
+                    queue.put(msg[1])
+                elif msg[0] == "result":
+                    return (worker_id,) + tuple(msg[1:])
+        finally:
+            conn.close()
+
+def _handle(conn, search_dirs):
+    """
+    Handle a single job request from a coordinator
+    """
+    msg = conn.recv()
+    if msg[0] == "run":
+        worker_id, options, main_data, roi, add_data = msg[1:]
+        options["fabber-dirs"] = list(search_dirs) + [FABBER_DIR,]
+        LOG.info("Fitting chunk %i (%s)", worker_id, main_data.shape)
+        _, success, output = _run_fabber(worker_id, _ConnectionQueue(conn), options, main_data, roi, *add_data)
+        conn.send(("result", success, output))
+        return True
+    elif msg[0] == "shutdown":
+        return False
+    else:
+        raise ValueError("Unknown request: %s" % str(msg[0]))
+
+def serve(address, authkey=None, search_dirs=(), ready_conn=None):
+    """
+    Run a Fabber worker server which fits chunks of data sent by a coordinator
+
+    Requests are handled one at a time - start one server for each core
+    to be used on the node.
+
+    :param address: Tuple of (host, port) to listen on. Port 0 selects a free port
+    :param authkey: Authentication key which coordinators must use
+    :param search_dirs: Additional directories to search for Fabber libraries
+    :param ready_conn: Optional connection to which the listening address is sent once ready
+    """
+    listener = Listener(tuple(address), authkey=_get_authkey(authkey))
+    LOG.info("Fabber worker listening on %s:%i", *listener.address)
+    if ready_conn is not None:
+        ready_conn.send(listener.address)
+        ready_conn.close()
+
+    try:
+        while True:
+            try:
+                conn = listener.accept()
+            except (EOFError, IOError, OSError) as exc:
+                # e.g. failed authentication
+                LOG.warning("Failed to accept connection: %s", exc)
+                continue
+            try:
+                if not _handle(conn, search_dirs):
+                    break
+            except (EOFError, IOError, OSError) as exc:
+                LOG.warning("Connection to coordinator lost: %s", exc)
+            finally:
+                conn.close()
+    finally:
+        listener.close()
+
+class LocalWorkers(object):
+    """
+    Fabber worker servers running on the local machine
+
+    Provides a stand-in for a cluster so the remote backend can be used
+    and tested without additional hardware::
+
+        with LocalWorkers(4, authkey="test") as workers:
+            options.update({"backend" : "remote", "remote-hosts" : workers.hosts,
+                            "remote-authkey" : "test"})
+    """
+
+    def __init__(self, n_workers=None, authkey=None, search_dirs=()):
+        if n_workers is None:
+            n_workers = multiprocessing.cpu_count()
+        self.authkey = authkey
+        self.hosts = []
+        self._procs = []
+        try:
+            for _ in range(n_workers):
+                parent_conn, child_conn = multiprocessing.Pipe()
+                proc = multiprocessing.Process(target=serve, args=(("localhost", 0), authkey, search_dirs, child_conn))
+                proc.daemon = True
+                proc.start()
+                self._procs.append(proc)
+                host, port = parent_conn.recv()
+                self.hosts.append("%s:%i" % (host, port))
+        except:
+            self.close()
+            raise
+
+    def close(self):
+        """
+        Stop all the worker servers
+        """
+        for proc in self._procs:
+            proc.terminate()
+            proc.join()
+        self._procs = []
+        self.hosts = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def main():
+    """
+    Command line entry point for running a worker server on a cluster node
+    """
+    parser = argparse.ArgumentParser(description="Run a Fabber worker server for remote execution")
+    parser.add_argument("--host", help="Address to listen on", default="")
+    parser.add_argument("--port", help="Port to listen on", type=int, default=5000)
+    parser.add_argument("--authkey", help="Authentication key (default: %s environment variable)" % AUTHKEY_ENV, default=None)
+    parser.add_argument("--fabber-dir", help="Additional directory to search for Fabber libraries", action="append", default=[])
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    serve((args.host, args.port), args.authkey, args.fabber_dir)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
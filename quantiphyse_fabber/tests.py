@@ -1,10 +1,231 @@
 import sys
 import time
+import json
 import unittest
 
+import numpy as np
+
+from PySide2 import QtCore
+
+from quantiphyse.data import ImageVolumeManagement, DataGrid
+from quantiphyse.processes import Process
 from quantiphyse.test.widget_test import WidgetTest
+from quantiphyse.utils import QpException
 
 from .widget import FabberModellingWidget
+from .jobs import Job, JobQueue
+from .process import FabberProcess, _ResampleCache
+
+class FabberManifestTest(unittest.TestCase):
+
+    def test_manifest_resolves(self):
+        """ Lazy manifest entries resolve to the real classes """
+        from . import QP_MANIFEST
+        from .process import FabberProcess
+        processes = QP_MANIFEST["processes"]
+        self.assertEqual([p.PROCESS_NAME for p in processes], ["Fabber", "FabberSimStudy"])
+        self.assertTrue(processes[0].resolve() is FabberProcess)
+        self.assertTrue(QP_MANIFEST["widgets"][0].resolve() is FabberModellingWidget)
+
+class _JobProcess(QtCore.QObject):
+    """
+    Stand-in for a process in the job queue with the same signals as a Quantiphyse process
+    """
+    sig_progress = QtCore.Signal(float)
+    sig_finished = QtCore.Signal(int, str, object)
+
+class JobQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = JobQueue(cpu_budget=4)
+        self.started = []
+
+    def _submit(self, name, cpus, priority=None):
+        process = _JobProcess()
+        job = Job(process, lambda allocated: self.started.append((name, allocated)), cpus, priority=priority, name=name)
+        self.queue.submit(job)
+        return job
+
+    def test_priority_order(self):
+        """ Queued jobs are started in priority order, then in the order submitted """
+        first = self._submit("first", 4)
+        self._submit("bulk", 4, "bulk")
+        self._submit("normal1", 4)
+        self._submit("interactive", 4, "interactive")
+        self._submit("normal2", 4)
+        self.assertEqual([job.name for job in self.queue.jobs], ["first", "interactive", "normal1", "normal2", "bulk"])
+        for job in self.queue.jobs:
+            job.process.sig_finished.emit(0, "", None)
+        self.assertEqual([name for name, _ in self.started], ["first", "interactive", "normal1", "normal2", "bulk"])
+        self.assertEqual(first.status, Job.FINISHED)
+        self.assertEqual(self.queue.free_cpus, 4)
+
+    def test_queue_budget(self):
+        """ Jobs start with fewer CPUs if necessary while the budget allows, and others wait """
+        self._submit("first", 3)
+        self._submit("second", 2)
+        third = self._submit("third", 1)
+        self.assertEqual(self.started, [("first", 3), ("second", 1)])
+        self.assertEqual(third.status, Job.QUEUED)
+        self.assertEqual(self.queue.free_cpus, 0)
+
+    def test_cancel_holds_cpus(self):
+        """ CPUs of a cancelled job are not reused until its workers have exited """
+        cancelled = self._submit("cancelled", 4)
+        waiting = self._submit("waiting", 4)
+        self.assertTrue(self.queue.hold(cancelled.process))
+        cancelled.process.sig_finished.emit(4, "", None)
+        self.assertEqual(cancelled.status, Job.STOPPING)
+        self.assertEqual(waiting.status, Job.QUEUED)
+        self.assertEqual(self.queue.free_cpus, 0)
+        self.queue.release(cancelled.process)
+        self.assertEqual(cancelled.status, Job.FINISHED)
+        self.assertEqual(self.started, [("cancelled", 4), ("waiting", 4)])
+
+class _Grid(object):
+    """
+    Stand-in for a data grid with the methods used by the resample cache
+    """
+    def __init__(self, shape, scale=1):
+        self.shape = shape
+        self.affine = np.identity(4) * scale
+
+    def matches(self, other):
+        return self.shape == other.shape and np.allclose(self.affine, other.affine)
+
+class _Data(object):
+    """
+    Stand-in for a data item which counts how many times it is resampled
+    """
+    def __init__(self, name, arr, grid):
+        self.name = name
+        self.arr = arr
+        self.grid = grid
+        self.resampled = 0
+
+    def raw(self):
+        return self.arr
+
+    def resample(self, grid):
+        self.resampled += 1
+        return _Data(self.name, np.zeros(grid.shape, dtype=self.arr.dtype) + self.resampled, grid)
+
+class ResampleCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.grid = _Grid((10, 10, 10))
+        self.target = _Grid((5, 5, 5), scale=2)
+        self.data = _Data("t1", np.ones((10, 10, 10), dtype=np.float32), self.grid)
+
+    def test_reuse(self):
+        """ Data is resampled once for each target grid and again only when it is replaced """
+        cache = _ResampleCache(max_bytes=1024*1024)
+        self.assertTrue(cache.get(self.data, self.grid) is self.data.arr)
+        first = cache.get(self.data, self.target)
+        self.assertTrue(cache.get(self.data, self.target) is first)
+        self.assertEqual(self.data.resampled, 1)
+        self.data.arr = np.ones((10, 10, 10), dtype=np.float32)
+        self.assertFalse(cache.get(self.data, self.target) is first)
+        self.assertEqual(self.data.resampled, 2)
+        self.assertEqual(cache.nbytes, first.nbytes)
+
+    def test_eviction(self):
+        """ Least recently used entries are evicted to keep within the memory limit """
+        nbytes = np.zeros(self.target.shape, dtype=np.float32).nbytes
+        cache = _ResampleCache(max_bytes=nbytes * 2)
+        other = _Data("m0", np.ones((10, 10, 10), dtype=np.float32), self.grid)
+        third = _Data("pd", np.ones((10, 10, 10), dtype=np.float32), self.grid)
+        for data in (self.data, other, self.data, third, self.data):
+            cache.get(data, self.target)
+        self.assertEqual((self.data.resampled, other.resampled, third.resampled), (1, 1, 1))
+        cache.get(other, self.target)
+        self.assertEqual(other.resampled, 2)
+        self.assertTrue(cache.nbytes <= cache.max_bytes)
+
+class FabberBenchmarkTest(unittest.TestCase):
+
+    def test_ipc_volume(self):
+        """ Volume of data returned from the workers is measured, and grows with the size of the output """
+        from .benchmark import run_case
+        app = QtCore.QCoreApplication.instance()
+        if app is None:
+            app = QtCore.QCoreApplication(sys.argv)
+        random_state = np.random.RandomState(0)
+        results = []
+        for size in (4, 8):
+            data = random_state.normal(size=(size, size, size, 10))
+            results.append(run_case(app, data, np.ones(data.shape[:3], dtype=np.int32), "vb", 1))
+        self.assertEqual([result["status"] for result in results], ["success", "success"])
+        self.assertTrue(results[0]["ipc-out-bytes"] > results[0]["voxels"] * 4)
+        self.assertTrue(results[1]["ipc-out-bytes"] > results[0]["ipc-out-bytes"] * 4)
+        self.assertTrue(results[1]["ipc-in-bytes"] > results[0]["ipc-in-bytes"] * 4)
+
+class FabberProcessTest(unittest.TestCase):
+
+    def setUp(self):
+        grid = DataGrid((5, 5, 5), np.identity(4))
+        data = 3 + 2 * np.arange(10, dtype=np.float32) + np.random.RandomState(0).normal(0, 0.1, (5, 5, 5, 10))
+        mask = np.zeros((5, 5, 5), dtype=np.int32)
+        mask[1:4, 1:4, 1:4] = 1
+        self.ivm = ImageVolumeManagement()
+        self.ivm.add(data, grid=grid, name="data")
+        self.ivm.add(mask, grid=grid, name="mask", roi=True)
+        self.options = {"data" : "data", "roi" : "mask", "model" : "poly", "degree" : 2, "save-mean" : True}
+
+    def _run(self, **options):
+        """
+        Run Fabber synchronously with the default options updated by ``options``
+        """
+        process = FabberProcess(self.ivm, sync=True)
+        process.execute(dict(self.options, **options))
+        return process
+
+    def test_profile(self):
+        """ Run profile records each phase and chunk, and the summary is written to the log as JSON """
+        process = self._run()
+        self.assertEqual(process.status, Process.SUCCEEDED)
+        profile = process.profile
+        for phase in ("options", "api-load", "chunking", "fitting", "recombination", "ivm-insertion"):
+            self.assertTrue(profile["phases"][phase] >= 0, phase)
+        self.assertEqual(sum([chunk["voxels"] for chunk in profile["chunks"]]), 27)
+        self.assertEqual(profile["summary"]["input-bytes"], sum([chunk["input-bytes"] for chunk in profile["chunks"]]))
+        self.assertTrue(profile["summary"]["output-bytes"] > 0)
+        self.assertTrue(profile["summary"]["total-time"] >= profile["phases"]["fitting"])
+
+        log = process.get_log()
+        self.assertTrue("Performance profile:" in log)
+        report, _ = json.JSONDecoder().raw_decode(log.split("Performance profile:")[1].strip())
+        self.assertEqual(sorted(report.keys()), ["phases", "summary"])
+        self.assertEqual(report["summary"]["total-time"], profile["summary"]["total-time"])
+        self.assertEqual(sorted(report["phases"].keys()), sorted(profile["phases"].keys()))
+
+    def test_pilot(self):
+        """ Pilot run fits a sample of the voxels and predicts the cost of the full run """
+        process = self._run(pilot=10)
+        self.assertEqual(process.status, Process.SUCCEEDED)
+        report = process.pilot_report
+        self.assertEqual((report["pilot-voxels"], report["total-voxels"]), (10, 27))
+        self.assertTrue(report["predicted-wall-time"] >= report["time-per-voxel"] * 27 / report["workers"])
+        self.assertTrue(report["predicted-peak-memory"] > 0)
+        # Three parameter maps of the full grid
+        self.assertEqual(report["predicted-output-bytes"], 3 * 125 * 4)
+        self.assertTrue("Pilot run estimate for full run" in process.get_log())
+        self.assertFalse("mean_c0" in self.ivm.data)
+        self.assertFalse("mean_c0_pilot" in self.ivm.data)
+
+        process = self._run(pilot=10, **{"save-pilot" : True})
+        self.assertEqual(process.status, Process.SUCCEEDED)
+        self.assertFalse("mean_c0" in self.ivm.data)
+        pilot_c0 = self.ivm.data["mean_c0_pilot"].raw()
+        self.assertEqual(np.count_nonzero(pilot_c0), 10)
+        self.assertEqual(np.count_nonzero(pilot_c0[self.ivm.data["mask"].raw() == 0]), 0)
+
+    def test_pilot_region_mode(self):
+        """ Region mode cannot be used for a pilot run """
+        process = self._run(pilot=10, **{"region-mode" : True})
+        self.assertEqual(process.status, Process.FAILED)
+        self.assertTrue(isinstance(process.exception, QpException))
+        self.assertTrue("pilot" in str(process.exception))
 
 class FabberWidgetTest(WidgetTest):
 
@@ -25,12 +246,27 @@ class FabberWidgetTest(WidgetTest):
         self.w.run_box.runBtn.clicked.emit()
         while not hasattr(self.w.run_box, "log"):
             self.processEvents()
-            time.sleep(2)
+            time.sleep(0.1)
         self.assertTrue("mean_c0" in self.ivm.data)
         self.assertTrue("mean_c1" in self.ivm.data)
         self.assertTrue("mean_c2" in self.ivm.data)
         self.assertTrue("modelfit" in self.ivm.data)
         self.assertFalse(self.error)
 
+    def test_preview(self):
+        """ User enables the preview, which is fitted without blocking the GUI """
+        self.ivm.add(self.data_4d, grid=self.grid, name="data_4d")
+        self.w.preview_cb.setChecked(True)
+        self.w._update_preview()
+        self.assertEqual(self.w.preview_params.text(), "Fitting preview...")
+        start = time.time()
+        while self.w._preview_running and time.time() - start < 30:
+            self.processEvents()
+            time.sleep(0.1)
+        self.processEvents()
+        self.assertFalse(self.w._preview_running)
+        self.assertTrue("c0=" in self.w.preview_params.text())
+        self.assertFalse(self.error)
+
 if __name__ == '__main__':
     unittest.main()
@@ -7,15 +7,18 @@ Copyright (c) 2016-2017 University of Oxford, Martin Craig
 
 from __future__ import division, unicode_literals, absolute_import, print_function
 
+import threading
+
 import numpy as np
 
 from PySide2 import QtGui, QtCore, QtWidgets
 
 from quantiphyse.gui.options import OptionBox, DataOption, ChoiceOption, VectorOption, NumberListOption, NumericOption, OutputNameOption, BoolOption
 from quantiphyse.gui.widgets import QpWidget, Citation, TitleWidget, RunBox, WarningBox
+from quantiphyse.gui.plot import Plot
 from quantiphyse.utils import QpException
 
-from .process import FabberProcess, FabberTestDataProcess
+from .process import FabberProcess, FabberTestDataProcess, FabberPreview
 from .dialogs import OptionsDialog, PriorsDialog
 from ._version import __version__
 
@@ -23,6 +26,9 @@ FAB_CITE_TITLE = "Variational Bayesian inference for a non-linear forward model"
 FAB_CITE_AUTHOR = "Chappell MA, Groves AR, Whitcher B, Woolrich MW."
 FAB_CITE_JOURNAL = "IEEE Transactions on Signal Processing 57(1):223-236, 2009."
 
+#: Delay in milliseconds after the cursor stops moving before a preview fit is started
+PREVIEW_DELAY_MS = 200
+
 class FabberWidget(QpWidget):
     """
     Widget for running Fabber model fitting
@@ -57,7 +63,7 @@ class FabberWidget(QpWidget):
         self.vbox.addWidget(self.warn_box)
 
     def _model_group_changed(self):
-        models = FabberProcess.api().get_models(model_group=self._fabber_options.get("model-group", None))
+        models = FabberProcess.get_models(model_group=self._fabber_options.get("model-group", None))
         self.debug("Models: %s", models)
         self.options.option("model").setChoices(models)
       
@@ -74,7 +80,7 @@ class FabberWidget(QpWidget):
         Given a set of Fabber options, replace those that should be data items with a Numpy array
         """
         options = dict(self._fabber_options)
-        known_options = api.get_options(generic=True, model=options.get("model", None), method=options.get("method", None))[0]
+        known_options = FabberProcess.get_options(generic=True, model=options.get("model", None), method=options.get("method", None))[0]
         for key in options:
             if api.is_data_option(key, known_options):
                 # Just provide a placeholder
@@ -96,7 +102,7 @@ class FabberWidget(QpWidget):
     def _show_model_options(self):
         model = self._fabber_options["model"]
         dlg = OptionsDialog(self, ivm=self.ivm, rundata=self._fabber_options, desc_first=True)
-        opts, desc = FabberProcess.api().get_options(model=model)
+        opts, desc = FabberProcess.get_options(model=model)
         self.debug("Model options: %s", opts)
         dlg.set_title("Forward Model: %s" % model, desc)
         dlg.set_options(opts)
@@ -106,7 +112,7 @@ class FabberWidget(QpWidget):
     def _show_method_options(self):
         method = self._fabber_options["method"]
         dlg = OptionsDialog(self, ivm=self.ivm, rundata=self._fabber_options, desc_first=True)
-        opts, desc = FabberProcess.api().get_options(method=method)
+        opts, desc = FabberProcess.get_options(method=method)
         # Ignore prior options which have their own dialog
         opts = [o for o in opts if "PSP_byname" not in o["name"] and o["name"] != "param-spatial-priors"]
         dlg.set_title("Inference method: %s" % method, desc)
@@ -120,7 +126,7 @@ class FabberWidget(QpWidget):
         dlg.ignore("model", "method", "output", "data", "mask", "data<n>", "overwrite", "help",
                    "listmodels", "listmethods", "link-to-latest", "data-order", "dump-param-names",
                    "loadmodels")
-        opts, _ = FabberProcess.api().get_options()
+        opts, _ = FabberProcess.get_options()
         dlg.set_options(opts)
         dlg.fit_width()
         dlg.exec_()
@@ -152,6 +158,9 @@ class FabberModellingWidget(FabberWidget):
     Widget for running Fabber model fitting
     """
 
+    #: Emitted from the preview thread with the preview result and the exception if it failed
+    sig_preview_done = QtCore.Signal(object, object)
+
     def __init__(self, **kwargs):
         super(FabberModellingWidget, self).__init__(name="Fabber", icon="fabber", group="Fabber",
                                                     desc="Fabber Bayesian model fitting", **kwargs)
@@ -180,19 +189,135 @@ class FabberModellingWidget(FabberWidget):
         model_opts_btn.clicked.connect(self._show_model_options)
         edit_priors_btn.clicked.connect(self._show_prior_options)
         options_btn.clicked.connect(self._show_general_options)
+
+        preview_box = QtWidgets.QGroupBox("Preview")
+        preview_vbox = QtWidgets.QVBoxLayout()
+        preview_box.setLayout(preview_vbox)
+        self.preview_cb = QtWidgets.QCheckBox("Preview fit at cursor position")
+        self.preview_cb.stateChanged.connect(self._preview_changed)
+        preview_vbox.addWidget(self.preview_cb)
+        self.preview_plot = Plot(clear_btn=False, opts_btn=False)
+        self.preview_plot.setVisible(False)
+        preview_vbox.addWidget(self.preview_plot)
+        self.preview_params = QtWidgets.QLabel()
+        self.preview_params.setWordWrap(True)
+        self.preview_params.setVisible(False)
+        preview_vbox.addWidget(self.preview_params)
+        self.vbox.insertWidget(self.vbox.indexOf(self.run_box), preview_box)
+
+        # Previews are delayed slightly so moving the cursor does not start a fit for every voxel passed.
+        # The fit runs in a background thread and only one runs at a time - if the cursor or options
+        # change while it is running another preview is started when it finishes
+        self._preview = FabberPreview(self.ivm)
+        self._preview_running = False
+        self._preview_stale = False
+        self.sig_preview_done.connect(self._preview_done)
+        self._preview_timer = QtCore.QTimer()
+        self._preview_timer.setSingleShot(True)
+        self._preview_timer.setInterval(PREVIEW_DELAY_MS)
+        self._preview_timer.timeout.connect(self._update_preview)
         
         model_groups = ["ALL"]
-        for group in FabberProcess.api().get_model_groups():
+        for group in FabberProcess.get_model_groups():
             model_groups.append(group.upper())
         self.options.option("model-group").setChoices(model_groups)
         self.options.option("model-group").value = "ALL"
         self._model_group_changed()
 
         self.options.option("model").value = "poly"
-        self.options.option("method").setChoices(FabberProcess.api().get_methods())
+        self.options.option("method").setChoices(FabberProcess.get_methods())
         self.options.option("method").value = "vb"
         self._options_changed()
 
+    def activate(self):
+        self.ivl.sig_focus_changed.connect(self._schedule_preview)
+
+    def deactivate(self):
+        self.ivl.sig_focus_changed.disconnect(self._schedule_preview)
+
+    def _options_changed(self):
+        FabberWidget._options_changed(self)
+        if hasattr(self, "_preview_timer"):
+            self._schedule_preview()
+
+    def _show_prior_options(self):
+        FabberWidget._show_prior_options(self)
+        self._schedule_preview()
+
+    def _preview_changed(self):
+        enabled = self.preview_cb.isChecked()
+        self.preview_plot.setVisible(enabled)
+        self.preview_params.setVisible(enabled)
+        self._schedule_preview()
+
+    def _schedule_preview(self, *_):
+        if self.preview_cb.isChecked():
+            self._preview_timer.start()
+
+    def _update_preview(self):
+        """
+        Start a background fit of the voxel at the cursor position with the current options
+        """
+        if self._preview_running:
+            self._preview_stale = True
+            return
+
+        self.preview_plot.clear()
+        if not self.preview_cb.isChecked() or self._fabber_options.get("data", None) is None:
+            self.preview_params.setText("")
+            return
+
+        # Spatial priors need some neighbouring voxels to have any effect
+        radius = 1 if self._fabber_options.get("method", None) == "spatialvb" else 0
+
+        # Data is extracted from the IVM here so the preview thread does not use it
+        try:
+            prepared = self._preview.prepare(self._fabber_options, self.ivl.focus(), grid=self.ivl.grid, radius=radius)
+        except Exception as exc:
+            self.preview_params.setText("Preview failed: %s" % str(exc))
+            return
+        if prepared is None:
+            self.preview_params.setText("Cursor is outside the data")
+            return
+
+        self._preview_running = True
+        self._preview_stale = False
+        self.preview_params.setText("Fitting preview...")
+        thread = threading.Thread(target=self._run_preview, args=(prepared,))
+        thread.daemon = True
+        thread.start()
+
+    def _run_preview(self, prepared):
+        """
+        Run the preview fit. Called in the preview thread
+        """
+        try:
+            preview = self._preview.run_prepared(prepared)
+            self.sig_preview_done.emit(preview, None)
+        except Exception as exc:
+            # Any failure must be reported or the preview would never run again
+            self.sig_preview_done.emit(None, exc)
+
+    def _preview_done(self, preview, exc):
+        """
+        Plot the model fit from the preview thread, or start another preview if the
+        cursor or options have changed since it was started
+        """
+        self._preview_running = False
+        if self._preview_stale:
+            self._update_preview()
+            return
+
+        self.preview_plot.clear()
+        if not self.preview_cb.isChecked():
+            self.preview_params.setText("")
+        elif exc is not None:
+            self.preview_params.setText("Preview failed: %s" % str(exc))
+        else:
+            self.preview_plot.add_line(np.atleast_1d(preview["data"]), name="Data")
+            self.preview_plot.add_line(np.atleast_1d(preview["modelfit"]), name="Model fit", line_style=QtCore.Qt.DashLine)
+            self.preview_params.setText(", ".join(["%s=%.4g" % (param, value) for param, value in sorted(preview["params"].items())]))
+
 class SimData(FabberWidget):
     """
     Widget which uses Fabber models to generate simulated data
@@ -224,13 +349,14 @@ class SimData(FabberWidget):
         self.options.add("Number of volumes (time points)", NumericOption(intonly=True, minval=1, maxval=100, default=10), key="num-vols")
         self.options.add("Voxels per patch (approx)", NumericOption(intonly=True, minval=1, maxval=10000, default=1000), key="num-voxels")
         self.options.add("Noise (Gaussian std.dev)", NumericOption(intonly=True, minval=0, maxval=1000, default=0), key="noise")
+        self.options.add("Noise realisations", NumericOption(intonly=True, minval=1, maxval=100, default=1), key="num-repeats")
         self.options.add("Output data name", OutputNameOption(initial="fabber_test_data"), key="output-name")
         self.options.add("Output noise-free data", BoolOption(), key="save-clean")
         self.options.add("Output parameter ROIs", BoolOption(), key="save-rois")
         self.options.option("model-group").sig_changed.connect(self._model_group_changed)
 
         model_groups = ["ALL"]
-        for group in FabberProcess.api().get_model_groups():
+        for group in FabberProcess.get_model_groups():
             model_groups.append(group.upper())
         self.options.option("model-group").setChoices(model_groups)
         self.options.option("model-group").value = "ALL"
@@ -269,9 +395,10 @@ class SimData(FabberWidget):
         return options
         
     def _run(self):
-        process = self.get_process()
+        # Test data is generated in the background so keep a reference to the process
+        self._process = self.get_process()
         options = self.get_options()
-        process.run(options)
+        self._process.run(options)
         
     def get_process(self):
         return FabberTestDataProcess(self.ivm)